@@ -23,14 +23,23 @@
 #    see http://www.gnu.org/licenses/.
 #
 # ##############################################################################
+from .attachments import Attachment
 from .registry import MailTemplateRegistry, Token
-from .utils import generate_email, render_email_content
+from .utils import generate_email, render_columns, render_email, render_email_content, stream_email
 from .contrib.migrations import MailTemplateMigration
+from .sending import MailJob, generate_emails_multi, send_emails
 
 __all__ = [
     'generate_email',
+    'generate_emails_multi',
+    'render_columns',
+    'render_email',
     'render_email_content',
+    'send_emails',
+    'stream_email',
     'templates',
+    'Attachment',
+    'MailJob',
     'MailTemplateMigration',
     'Token',
 ]
@@ -25,11 +25,12 @@
 # ##############################################################################
 from django.contrib import admin
 
-from osis_mail_template.models import MailTemplate
+from osis_mail_template.models import MailTemplate, MailTemplateRevision, OutboxMail
 
 
 class MailTemplateAdmin(admin.ModelAdmin):
-    list_display = ['identifier', 'language']
+    list_display = ['identifier', 'language', 'tag', 'version', 'updated_at']
+    list_filter = ['tag', 'language']
 
     @property
     def form(self):
@@ -45,4 +46,17 @@ class MailTemplateAdmin(admin.ModelAdmin):
         return MailTemplateAdminForm
 
 
+class MailTemplateRevisionAdmin(admin.ModelAdmin):
+    list_display = ['identifier', 'language', 'version', 'created_at']
+    list_filter = ['identifier', 'language']
+    readonly_fields = ['identifier', 'language', 'version', 'subject', 'body', 'created_at']
+
+
+class OutboxMailAdmin(admin.ModelAdmin):
+    list_display = ['identifier', 'language', 'status', 'attempts', 'created_at', 'sent_at']
+    list_filter = ['status', 'identifier']
+
+
 admin.site.register(MailTemplate, MailTemplateAdmin)
+admin.site.register(MailTemplateRevision, MailTemplateRevisionAdmin)
+admin.site.register(OutboxMail, OutboxMailAdmin)
@@ -25,10 +25,25 @@
 # ##############################################################################
 from django.apps import AppConfig
 from django.conf import settings
+from django.db.models.signals import post_migrate
 from django.utils.module_loading import autodiscover_modules
 from django.utils.translation import gettext_lazy as _
 
 
+def sync_mail_template_tags(sender, using=None, apps=None, **kwargs):
+    from osis_mail_template.models import MailTemplate
+
+    # Migrations may have been applied up to a state where tags are not stored (or mail templates not created yet)
+    if apps is not None:
+        try:
+            historical_model = apps.get_model('osis_mail_template', 'MailTemplate')
+        except LookupError:
+            return
+        if 'tag' not in {field.name for field in historical_model._meta.get_fields()}:
+            return
+    MailTemplate.objects.sync_tags(using=using)
+
+
 class OsisMailTemplateConfig(AppConfig):
     name = 'osis_mail_template'
     verbose_name = _("Mail templates")
@@ -37,6 +52,9 @@ class OsisMailTemplateConfig(AppConfig):
         # This loads mail_templates.py from each app for registration
         autodiscover_modules('mail_templates')
 
+        # Registered tags are copied to the database once all migrations are applied
+        post_migrate.connect(sync_mail_template_tags, sender=self)
+
         # Add custom CKEditor config
         settings.CKEDITOR_CONFIGS['osis_mail_template'] = {
             'linkShowTargetTab': False,
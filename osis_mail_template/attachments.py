@@ -0,0 +1,155 @@
+# ##############################################################################
+#
+#    OSIS stands for Open Student Information System. It's an application
+#    designed to manage the core business of higher education institutions,
+#    such as universities, faculties, institutes and professional schools.
+#    The core business involves the administration of students, teachers,
+#    courses, programs and so on.
+#
+#    Copyright (C) 2015-2021 Université catholique de Louvain (http://www.uclouvain.be)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    A copy of this license - GNU General Public License - is available
+#    at the root of the source code of this program.  If not,
+#    see http://www.gnu.org/licenses/.
+#
+# ##############################################################################
+import base64
+import hashlib
+import mimetypes
+import mmap
+import os
+from email.message import EmailMessage, MIMEPart
+from typing import Dict, Iterable, List, Union
+
+from django.utils.functional import cached_property
+
+__all__ = [
+    'Attachment',
+    'attach',
+    'to_attachments',
+]
+
+# Files from this size on are mapped in memory to be encoded, instead of being read as a whole
+MMAP_THRESHOLD = 1024 * 1024
+# Encoded by chunks of whole base64 lines (57 bytes for 76 characters)
+_CHUNK_BYTES = 57 * 1024
+
+Content = Union[bytes, bytearray, memoryview]
+
+
+class Attachment:
+    """
+    A file attached to mails, base64-encoded once (when first attached) then shared by all the messages
+
+    :param content: The content as bytes (a memoryview is not copied), or the path of a file (a str or a Path)
+    :param filename: The name of the attached file (defaults to the name of the file given as path)
+    :param mimetype: The MIME type of the content (defaults to the one guessed from the filename)
+    """
+
+    def __init__(self, content: Union[Content, str], filename: str = None, mimetype: str = None) -> None:
+        if isinstance(content, (bytes, bytearray, memoryview)):
+            self.content, self.path = content, None
+        else:
+            self.content, self.path = None, str(content)
+            filename = filename or os.path.basename(self.path)
+        self.filename = filename
+        self.mimetype = mimetype or (filename and mimetypes.guess_type(filename)[0]) or 'application/octet-stream'
+
+    def __repr__(self):
+        return '<Attachment {}>'.format(self.filename or self.mimetype)
+
+    @classmethod
+    def from_encoded(cls, encoded: str, filename: str = None, mimetype: str = None) -> 'Attachment':
+        """An attachment whose content is already encoded in base64 lines (e.g. received from another process)"""
+        attachment = cls(b'', filename, mimetype)
+        attachment.__dict__['encoded'] = encoded
+        return attachment
+
+    @staticmethod
+    def _encode(content: memoryview) -> str:
+        encoded = bytearray()
+        for start in range(0, len(content), _CHUNK_BYTES):
+            encoded += base64.encodebytes(content[start:start + _CHUNK_BYTES])
+        return encoded.decode('ascii')
+
+    @cached_property
+    def encoded(self) -> str:
+        """The content encoded in base64 lines, as written in messages"""
+        if self.path is None:
+            return self._encode(memoryview(self.content))
+        with open(self.path, 'rb') as file:
+            if os.fstat(file.fileno()).st_size < MMAP_THRESHOLD:
+                return self._encode(memoryview(file.read()))
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                content = memoryview(mapped)
+                try:
+                    return self._encode(content)
+                finally:
+                    content.release()
+
+    def as_part(self) -> MIMEPart:
+        """A new MIME part for a message, its payload being the shared encoded content"""
+        part = MIMEPart()
+        maintype, _, subtype = self.mimetype.partition('/')
+        part['Content-Type'] = '{}/{}'.format(maintype, subtype or 'octet-stream')
+        part['Content-Transfer-Encoding'] = 'base64'
+        if self.filename:
+            part.add_header('Content-Disposition', 'attachment', filename=self.filename)
+        else:
+            part['Content-Disposition'] = 'attachment'
+        part.set_payload(self.encoded)
+        return part
+
+
+def _content_key(content: Union[Content, str]):
+    """Key contents on a digest, hashing being much cheaper than the base64 encoding it spares"""
+    if isinstance(content, (bytes, bytearray, memoryview)):
+        return hashlib.sha1(content).digest()
+    return str(content)
+
+
+def to_attachments(values: Iterable, shared: Dict = None) -> List[Attachment]:
+    """
+    Get Attachment instances from attachments, paths, bytes or (filename, content[, mimetype]) tuples
+
+    :param values: The attachments of a mail
+    :param shared: Attachments already built for other mails (e.g. of the same batch), updated with the new ones,
+        so that the same content (the same path, or equal bytes) is only encoded once
+    """
+    shared = {} if shared is None else shared
+    attachments = []
+    for value in values:
+        if isinstance(value, Attachment):
+            attachments.append(value)
+            continue
+        if isinstance(value, tuple):
+            key = (value[0], _content_key(value[1])) + tuple(value[2:])
+        elif isinstance(value, (bytes, bytearray, memoryview)):
+            key = _content_key(value)
+        else:
+            key = str(value)
+        if key not in shared:
+            shared[key] = Attachment(value[1], value[0], *value[2:]) if isinstance(value, tuple) else Attachment(value)
+        attachments.append(shared[key])
+    return attachments
+
+
+def attach(msg: EmailMessage, attachments: Iterable[Attachment]) -> None:
+    """Attach files to a message, turning it into a multipart/mixed one"""
+    attachments = list(attachments)
+    if not attachments:
+        return
+    if msg.get_content_type() != 'multipart/mixed':
+        msg.make_mixed()
+    for attachment in attachments:
+        msg.attach(attachment.as_part())
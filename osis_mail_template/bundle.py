@@ -0,0 +1,277 @@
+# ##############################################################################
+#
+#    OSIS stands for Open Student Information System. It's an application
+#    designed to manage the core business of higher education institutions,
+#    such as universities, faculties, institutes and professional schools.
+#    The core business involves the administration of students, teachers,
+#    courses, programs and so on.
+#
+#    Copyright (C) 2015-2021 Université catholique de Louvain (http://www.uclouvain.be)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    A copy of this license - GNU General Public License - is available
+#    at the root of the source code of this program.  If not,
+#    see http://www.gnu.org/licenses/.
+#
+# ##############################################################################
+import gzip
+import json
+from functools import partial
+from itertools import islice
+from typing import BinaryIO, Iterable, Iterator, List, Tuple
+
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from osis_mail_template.exceptions import (
+    InvalidMailTemplateBundle,
+    UnknownLanguage,
+    UnknownMailTemplateIdentifier,
+    UnknownToken,
+)
+from osis_mail_template.models import (
+    MailTemplate,
+    MailTemplateRevision,
+    compute_content_hash,
+    get_languages,
+    get_registered_tag,
+)
+from osis_mail_template.rendering import CompiledFormat
+
+__all__ = [
+    'ImportReport',
+    'export_bundle',
+    'import_bundle',
+]
+
+BUNDLE_FORMAT = 'osis_mail_template'
+# Bump when the fields of the rows change
+BUNDLE_VERSION = 1
+
+
+def export_bundle(fileobj: BinaryIO, identifiers: Iterable[str] = None, chunk_size: int = 500) -> int:
+    """
+    Write mail templates to a gzip-compressed JSON lines bundle, streaming them from the database
+
+    The first line describes the bundle, each other one is a mail template with its content hash and the names of
+    the tokens it uses.
+
+    :param fileobj: A binary file-like object the bundle is written to
+    :param identifiers: Only export these mail templates (defaults to all)
+    :param chunk_size: The number of mail templates fetched at once from the database
+    :return: the number of exported mail templates
+    """
+    from osis_mail_template import templates
+
+    queryset = MailTemplate.objects.order_by('identifier', 'language')
+    if identifiers is not None:
+        queryset = queryset.filter(identifier__in=list(identifiers))
+    count = 0
+    with gzip.open(fileobj, 'wt', encoding='utf-8') as bundle:
+        bundle.write(json.dumps({
+            'format': BUNDLE_FORMAT,
+            'version': BUNDLE_VERSION,
+            'registry_hash': templates.get_content_hash(),
+            'exported_at': timezone.now().isoformat(),
+        }) + '\n')
+        rows = queryset.values_list('identifier', 'language', 'subject', 'body', 'content_hash', 'tag')
+        for identifier, language, subject, body, content_hash, tag in rows.iterator(chunk_size=chunk_size):
+            bundle.write(json.dumps({
+                'identifier': identifier,
+                'language': language,
+                'subject': subject,
+                'body': body,
+                'content_hash': content_hash or compute_content_hash(subject, body),
+                'tag': tag,
+                'tokens': sorted(CompiledFormat(subject).get_token_names() | CompiledFormat(body).get_token_names()),
+            }, ensure_ascii=False) + '\n')
+            count += 1
+    return count
+
+
+class ImportReport:
+    """What importing a bundle did, or would do, and the rows that could not be imported"""
+
+    def __init__(self) -> None:
+        self.inserted = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.errors = []  # type: List[Tuple[int, Exception]]
+        self.registry_hash = None
+
+    @property
+    def ok(self) -> bool:
+        return not self.errors
+
+    def __str__(self):
+        return '{} inserted, {} updated, {} unchanged, {} invalid'.format(
+            self.inserted, self.updated, self.unchanged, len(self.errors),
+        )
+
+
+def _read_rows(fileobj: BinaryIO, report: ImportReport) -> Iterator[Tuple[int, dict]]:
+    with gzip.open(fileobj, 'rt', encoding='utf-8') as bundle:
+        try:
+            header = json.loads(next(bundle, 'null'))
+        except (ValueError, OSError, EOFError) as e:
+            raise InvalidMailTemplateBundle(e)
+        if not isinstance(header, dict) or header.get('format') != BUNDLE_FORMAT:
+            raise InvalidMailTemplateBundle("missing header")
+        if header.get('version') != BUNDLE_VERSION:
+            raise InvalidMailTemplateBundle("unsupported version {}".format(header.get('version')))
+        report.registry_hash = header.get('registry_hash')
+        line_number = 1
+        try:
+            for line_number, line in enumerate(bundle, start=2):
+                try:
+                    yield line_number, json.loads(line)
+                except ValueError as e:
+                    raise InvalidMailTemplateBundle("line {}: {}".format(line_number, e))
+        except (OSError, EOFError) as e:
+            # A truncated or corrupted bundle
+            raise InvalidMailTemplateBundle("after line {}: {}".format(line_number, e))
+
+
+def _validate(row: dict) -> None:
+    from osis_mail_template import templates
+
+    try:
+        identifier, language, subject, body = row['identifier'], row['language'], row['subject'], row['body']
+    except (KeyError, TypeError) as e:
+        raise InvalidMailTemplateBundle("missing field {}".format(e))
+    if not isinstance(subject, str) or not isinstance(body, str):
+        raise InvalidMailTemplateBundle("subject and body must be strings")
+    max_length = MailTemplate._meta.get_field('subject').max_length
+    if len(subject) > max_length:
+        raise InvalidMailTemplateBundle("subject longer than {} characters".format(max_length))
+    templates.get_mail_template(identifier)
+    if language not in get_languages():
+        raise UnknownLanguage(language)
+    declared = {token.name for token in templates.get_tokens(identifier)}
+    for token in sorted(CompiledFormat(subject).get_token_names() | CompiledFormat(body).get_token_names()):
+        if token not in declared:
+            raise UnknownToken(token, identifier)
+
+
+def _import_batch(rows: List[dict], report: ImportReport) -> None:
+    from osis_mail_template import store
+
+    existing = {
+        (instance.identifier, instance.language): instance
+        for instance in MailTemplate.objects.select_for_update().filter(
+            identifier__in={row['identifier'] for row in rows},
+            language__in={row['language'] for row in rows},
+        ).only('identifier', 'language', 'version', 'content_hash')
+    }
+    changed = []
+    for row in rows:
+        content_hash = compute_content_hash(row['subject'], row['body'])
+        instance = existing.get((row['identifier'], row['language']))
+        if instance is not None and instance.content_hash == content_hash:
+            report.unchanged += 1
+        else:
+            changed.append((row, content_hash, instance))
+    if not changed:
+        return
+
+    # Versions keep increasing if a mail template is removed and created again
+    new_pairs = {(row['identifier'], row['language']) for row, _hash, instance in changed if instance is None}
+    last_versions = {}
+    if new_pairs:
+        last_versions = {
+            (identifier, language): version
+            for identifier, language, version in MailTemplateRevision.objects.filter(
+                identifier__in={identifier for identifier, _language in new_pairs},
+                language__in={language for _identifier, language in new_pairs},
+            ).values('identifier', 'language').annotate(version=Max('version')).values_list(
+                'identifier', 'language', 'version',
+            )
+        }
+
+    now = timezone.now()
+    to_create, to_update, revisions = [], [], []
+    for row, content_hash, instance in changed:
+        pair = (row['identifier'], row['language'])
+        fields = dict(
+            subject=row['subject'],
+            body=row['body'],
+            content_hash=content_hash,
+            tag=get_registered_tag(row['identifier']),
+            updated_at=now,
+        )
+        if instance is None:
+            instance = MailTemplate(identifier=pair[0], language=pair[1], version=last_versions.get(pair, 0) + 1)
+            to_create.append(instance)
+        else:
+            instance.version += 1
+            to_update.append(instance)
+        for name, value in fields.items():
+            setattr(instance, name, value)
+        revisions.append(MailTemplateRevision(
+            identifier=pair[0],
+            language=pair[1],
+            version=instance.version,
+            subject=instance.subject,
+            body=instance.body,
+        ))
+        # Bulk operations don't send signals, compiled templates shared between processes are forgotten here
+        transaction.on_commit(partial(store.forget, *pair))
+    MailTemplate.objects.bulk_create(to_create)
+    MailTemplate.objects.bulk_update(
+        to_update, ['subject', 'body', 'content_hash', 'tag', 'updated_at', 'version'],
+    )
+    MailTemplateRevision.objects.bulk_create(revisions)
+    report.inserted += len(to_create)
+    report.updated += len(to_update)
+
+
+def import_bundle(fileobj: BinaryIO, batch_size: int = 500, dry_run: bool = False) -> ImportReport:
+    """
+    Import mail templates from a bundle written by export_bundle(), streaming it by batches
+
+    Each row is validated against the registry (identifier, declared tokens) and settings.LANGUAGES. Each batch
+    is compared to the database by content hash with a single query, only the changed rows being written, with bulk
+    operations (bumping their version and keeping a revision, as saving them would). Nothing is written if any row
+    is invalid or repeats a mail template (all of them being reported), or with dry_run.
+
+    :param fileobj: A binary file-like object the bundle is read from
+    :param batch_size: The number of rows compared and written at once
+    :param dry_run: Whether to only report what would be done
+    :return: an ImportReport
+    :raises InvalidMailTemplateBundle: if the bundle can't be read
+    """
+    report = ImportReport()
+    rows = _read_rows(fileobj, report)
+    seen = set()
+    with transaction.atomic():
+        while True:
+            chunk = list(islice(rows, batch_size))
+            if not chunk:
+                break
+            batch = []
+            for line_number, row in chunk:
+                try:
+                    _validate(row)
+                    pair = (row['identifier'], row['language'])
+                    if pair in seen:
+                        raise InvalidMailTemplateBundle("duplicate mail template {} ({})".format(*pair))
+                    seen.add(pair)
+                except (InvalidMailTemplateBundle, UnknownMailTemplateIdentifier, UnknownLanguage, UnknownToken) as e:
+                    report.errors.append((line_number, e))
+                else:
+                    batch.append(row)
+            if batch:
+                _import_batch(batch, report)
+        if dry_run or report.errors:
+            transaction.set_rollback(True)
+    return report
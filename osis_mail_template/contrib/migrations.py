@@ -23,19 +23,37 @@
 #    see http://www.gnu.org/licenses/.
 #
 # ##############################################################################
+import logging
+from functools import partial
 from typing import Dict
 
 from django.conf import settings
+from django.db import transaction
 from django.db.migrations import RunPython
 
+logger = logging.getLogger(__name__)
+
 
 class MailTemplateMigration(RunPython):
-    def __init__(self, identifier: str, subjects: Dict[str, str], contents: Dict[str, str], remove_on_reverse=True):
+    def __init__(self, identifier: str, subjects: Dict[str, str], contents: Dict[str, str], remove_on_reverse=True,
+                 normalize: bool = None):
         def forward(apps, schema_editor):
-            from osis_mail_template import templates
+            from osis_mail_template import store, templates
             from osis_mail_template.exceptions import EmptyMailTemplateContent, UnknownToken
+            from osis_mail_template.normalization import is_normalization_enabled, normalize_html, saved_bytes
+            from osis_mail_template.versioning import compute_content_hash, get_registered_tag, next_version
 
             MailTemplate = apps.get_model('osis_mail_template', 'MailTemplate')
+            try:
+                MailTemplateRevision = apps.get_model('osis_mail_template', 'MailTemplateRevision')
+            except LookupError:
+                # This migration may depend on a state of osis_mail_template where templates were not versioned
+                MailTemplateRevision = None
+            # ... or where content hashes (and tags) were not stored, hashes are then computed from existing content
+            stored_fields = {field.name for field in MailTemplate._meta.get_fields()}
+            stores_hash = 'content_hash' in stored_fields
+
+            new_contents = {}
             for lang, _ in settings.LANGUAGES:
                 # Some basic validation
                 tokens = templates.get_example_values(identifier)
@@ -45,18 +63,81 @@ class MailTemplateMigration(RunPython):
                 except KeyError as e:
                     raise UnknownToken(e.args[0], identifier)
 
-                # Save the model instance
                 try:
+                    subject, body = subjects[lang], contents[lang]
+                except KeyError:  # pragma: no cover
+                    raise EmptyMailTemplateContent(identifier, lang)
+                if is_normalization_enabled() if normalize is None else normalize:
+                    original, body = body, normalize_html(body)
+                    logger.info(
+                        "Normalized mail template %s (%s): %d bytes saved",
+                        identifier, lang, saved_bytes(original, body),
+                    )
+                new_contents[lang] = (subject, body)
+
+            # Existing rows are compared by content hash in a single query, only the changed ones being written
+            queryset = MailTemplate.objects.filter(identifier=identifier, language__in=new_contents.keys())
+            if stores_hash:
+                queryset = queryset.defer('subject', 'body')
+            existing = {instance.language: instance for instance in queryset}
+
+            inserted = updated = unchanged = 0
+            for lang, (subject, body) in new_contents.items():
+                content_hash = compute_content_hash(subject, body)
+                instance = existing.get(lang)
+                if instance is not None:
+                    if stores_hash:
+                        current_hash = instance.content_hash
+                    else:
+                        current_hash = compute_content_hash(instance.subject, instance.body)
+                    if current_hash == content_hash:
+                        unchanged += 1
+                        continue
+                denormalized = {'content_hash': content_hash} if stores_hash else {}
+                if 'tag' in stored_fields:
+                    denormalized['tag'] = get_registered_tag(identifier)
+                if instance is None:
+                    inserted += 1
+                else:
+                    updated += 1
+
+                if MailTemplateRevision is None:
                     MailTemplate.objects.update_or_create(
                         identifier=identifier,
                         language=lang,
-                        defaults=dict(
-                            subject=subjects[lang],
-                            body=contents[lang],
-                        ),
+                        defaults=dict(subject=subject, body=body, **denormalized),
                     )
-                except KeyError:  # pragma: no cover
-                    raise EmptyMailTemplateContent(identifier, lang)
+                elif instance is None:
+                    # Historical models don't have the custom save(), versions and revisions are handled here
+                    instance = MailTemplate.objects.create(
+                        identifier=identifier,
+                        language=lang,
+                        subject=subject,
+                        body=body,
+                        version=next_version(MailTemplateRevision, identifier, lang),
+                        **denormalized
+                    )
+                else:
+                    instance.subject = subject
+                    instance.body = body
+                    instance.version += 1
+                    for name, value in denormalized.items():
+                        setattr(instance, name, value)
+                    instance.save()
+
+                if MailTemplateRevision is not None:
+                    MailTemplateRevision.objects.create(
+                        identifier=identifier,
+                        language=lang,
+                        version=instance.version,
+                        subject=subject,
+                        body=body,
+                    )
+                transaction.on_commit(partial(store.forget, identifier, lang))
+            logger.info(
+                "Mail template %s: %d inserted, %d updated, %d unchanged",
+                identifier, inserted, updated, unchanged,
+            )
 
         def reverse(apps, schema_editor):
             MailTemplate = apps.get_model('osis_mail_template', 'MailTemplate')
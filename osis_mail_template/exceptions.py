@@ -31,6 +31,9 @@ __all__ = [
     'UnknownMailTemplateIdentifier',
     'UnknownLanguage',
     'EmptyMailTemplateContent',
+    'InvalidMailTemplateBundle',
+    'InvalidSerializedMail',
+    'PreflightError',
 ]
 
 
@@ -72,3 +75,25 @@ class UnknownLanguage(Exception):
         super().__init__(_(
             "The language '%(language)s' is not defined in settings.LANGUAGES."
         ) % {'language': language})
+
+
+class PreflightError(Exception):
+    def __init__(self, report) -> None:
+        self.report = report
+        super().__init__(_(
+            "Some mail templates can't be rendered:\n%(report)s"
+        ) % {'report': report})
+
+
+class InvalidMailTemplateBundle(Exception):
+    def __init__(self, reason) -> None:
+        super().__init__(_(
+            "The mail template bundle is invalid: %(reason)s"
+        ) % {'reason': reason})
+
+
+class InvalidSerializedMail(Exception):
+    def __init__(self, reason) -> None:
+        super().__init__(_(
+            "The serialized mail is invalid: %(reason)s"
+        ) % {'reason': reason})
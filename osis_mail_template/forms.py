@@ -28,6 +28,7 @@ from django import forms
 from django.utils.translation import gettext_lazy as _
 
 from osis_mail_template.models import MailTemplate
+from osis_mail_template.normalization import is_normalization_enabled, normalize_html, saved_bytes
 
 
 class MailTemplateConfigureForm(forms.ModelForm):
@@ -41,8 +42,11 @@ class MailTemplateConfigureForm(forms.ModelForm):
             'body': CKEditorWidget(config_name='osis_mail_template'),
         }
 
-    def __init__(self, *args, **kwargs) -> None:
+    def __init__(self, *args, normalize: bool = None, **kwargs) -> None:
         super().__init__(*args, **kwargs)
+        # Whether the body is normalized to reduce its size, defaults to the OSIS_MAIL_TEMPLATE_NORMALIZE_HTML setting
+        self.normalize = is_normalization_enabled() if normalize is None else normalize
+        self.saved_bytes = 0
 
         # This is used in MailTemplateAdminForm
         if 'identifier' in self.fields:
@@ -71,4 +75,9 @@ class MailTemplateConfigureForm(forms.ModelForm):
         return self.check_tokens('subject')
 
     def clean_body(self):
-        return self.check_tokens('body')
+        data = self.check_tokens('body')
+        if self.normalize:
+            normalized = normalize_html(data)
+            self.saved_bytes = saved_bytes(data, normalized)
+            return normalized
+        return data
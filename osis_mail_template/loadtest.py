@@ -0,0 +1,237 @@
+# ##############################################################################
+#
+#    OSIS stands for Open Student Information System. It's an application
+#    designed to manage the core business of higher education institutions,
+#    such as universities, faculties, institutes and professional schools.
+#    The core business involves the administration of students, teachers,
+#    courses, programs and so on.
+#
+#    Copyright (C) 2015-2021 Université catholique de Louvain (http://www.uclouvain.be)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    A copy of this license - GNU General Public License - is available
+#    at the root of the source code of this program.  If not,
+#    see http://www.gnu.org/licenses/.
+#
+# ##############################################################################
+import asyncio
+import math
+import multiprocessing
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Sequence, Tuple
+
+from django.db import connection, connections
+
+__all__ = [
+    'CONCURRENCY_MODELS',
+    'MODES',
+    'LoadTestReport',
+    'load_test',
+]
+
+# How concurrent callers are simulated
+CONCURRENCY_MODELS = ('thread', 'process', 'async')
+# How each request is rendered: one message with generate_email(), or a batch of messages with generate_emails_multi()
+MODES = ('baseline', 'bulk')
+
+
+class LoadTestReport:
+    """Latencies, errors and database queries of the requests of a load test"""
+
+    def __init__(self, messages_per_request: int = 1) -> None:
+        self.messages_per_request = messages_per_request
+        self.latencies = []  # type: List[float]
+        self.errors = Counter()  # type: Counter
+        self.queries = 0
+        self.elapsed = 0.0
+
+    @property
+    def requests(self) -> int:
+        return len(self.latencies)
+
+    @property
+    def messages(self) -> int:
+        return self.requests * self.messages_per_request
+
+    @property
+    def throughput(self) -> float:
+        """The number of messages rendered per second"""
+        return self.messages / self.elapsed if self.elapsed else 0
+
+    @property
+    def queries_per_message(self) -> float:
+        return self.queries / self.messages if self.messages else 0
+
+    def percentile(self, percent: float) -> float:
+        """The latency (in seconds) under which this percentage of the requests were answered (nearest rank)"""
+        if not self.latencies:
+            return 0
+        latencies = sorted(self.latencies)
+        return latencies[max(math.ceil(percent / 100 * len(latencies)) - 1, 0)]
+
+    def add(self, latencies: List[float], errors: Dict[str, int], queries: int) -> None:
+        self.latencies.extend(latencies)
+        self.errors.update(errors)
+        self.queries += queries
+
+    def __str__(self):
+        latencies = ', '.join(
+            'p{} {:.2f}ms'.format(percent, self.percentile(percent) * 1000) for percent in (50, 95, 99)
+        )
+        return '{} messages in {:.2f}s ({:.1f}/s), {}, {:.2f} queries/message'.format(
+            self.messages, self.elapsed, self.throughput, latencies, self.queries_per_message,
+        )
+
+
+def _render_request(mode: str, jobs: list) -> Tuple[float, Dict[str, int], int]:
+    """Render the jobs of a request in the current thread, measuring its latency and counting its queries"""
+    from osis_mail_template.sending import MailJob, generate_emails_multi
+    from osis_mail_template.utils import generate_email
+
+    queries = [0]
+    errors = Counter()
+
+    def count_queries(execute, sql, params, many, context):
+        queries[0] += 1
+        return execute(sql, params, many, context)
+
+    with connection.execute_wrapper(count_queries):
+        start = time.perf_counter()
+        if mode == 'bulk':
+            rendered = 0
+            try:
+                for _, result in generate_emails_multi(MailJob(*job) for job in jobs):
+                    rendered += 1
+                    if isinstance(result, Exception):
+                        errors[type(result).__name__] += 1
+            except Exception as e:
+                # Other errors abort the batch, its remaining messages are counted as failed
+                errors[type(e).__name__] += len(jobs) - rendered
+        else:
+            for job in jobs:
+                try:
+                    generate_email(*job)
+                except Exception as e:
+                    errors[type(e).__name__] += 1
+        latency = time.perf_counter() - start
+    return latency, errors, queries[0]
+
+
+def _run_share(mode: str, requests: Sequence[list]) -> Tuple[List[float], Dict[str, int], int]:
+    """Render a share of the requests, one after the other, as a single caller would"""
+    latencies, errors, queries = [], Counter(), 0
+    try:
+        for jobs in requests:
+            latency, request_errors, request_queries = _render_request(mode, jobs)
+            latencies.append(latency)
+            errors.update(request_errors)
+            queries += request_queries
+    finally:
+        # Each thread (or process) has its own database connection
+        connection.close()
+    return latencies, errors, queries
+
+
+def _run_process_share(args: tuple) -> Tuple[List[float], Dict[str, int], int]:
+    return _run_share(*args)
+
+
+def _run_threads(mode: str, shares: List[list], report: LoadTestReport) -> None:
+    results = [None] * len(shares)
+    failures = []
+
+    def run(index):
+        try:
+            results[index] = _run_share(mode, shares[index])
+        except Exception as e:
+            failures.append(e)
+
+    threads = [threading.Thread(target=run, args=(index,)) for index in range(len(shares))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if failures:
+        # Raised in the calling thread, as with the other concurrency models
+        raise failures[0]
+    for result in results:
+        report.add(*result)
+
+
+def _run_processes(mode: str, shares: List[list], report: LoadTestReport) -> None:
+    # Forked processes must not share the database connection of the parent
+    connections.close_all()
+    with multiprocessing.get_context('fork').Pool(len(shares)) as pool:
+        for result in pool.map(_run_process_share, [(mode, share) for share in shares]):
+            report.add(*result)
+
+
+def _run_tasks(mode: str, shares: List[list], report: LoadTestReport) -> None:
+    # The ORM being synchronous, each task awaits its requests rendered in a thread pool, as an async view would
+    workers = len(shares)
+    executor = ThreadPoolExecutor(max_workers=workers)
+    loop = asyncio.new_event_loop()
+
+    async def task(share):
+        for jobs in share:
+            latency, errors, queries = await loop.run_in_executor(executor, _render_request, mode, jobs)
+            report.add([latency], errors, queries)
+
+    async def run_tasks():
+        await asyncio.gather(*[task(share) for share in shares])
+
+    def close_connection(barrier):
+        # Each worker thread waits for the others, so that each one closes its own connection
+        barrier.wait()
+        connection.close()
+
+    try:
+        loop.run_until_complete(run_tasks())
+        barrier = threading.Barrier(workers)
+        list(executor.map(close_connection, [barrier] * workers))
+    finally:
+        executor.shutdown()
+        loop.close()
+
+
+def load_test(jobs: Sequence[tuple], requests: int = 1000, concurrency: int = 8, model: str = 'thread',
+              mode: str = 'baseline', batch_size: int = 50) -> LoadTestReport:
+    """
+    Render mails from concurrent callers, measuring the latency of each request and the database queries
+
+    :param jobs: The (identifier, language, tokens, recipients) mails to render, cycled through to build the requests
+    :param requests: The total number of requests
+    :param concurrency: The number of concurrent callers (threads, processes or async tasks)
+    :param model: How callers are simulated, one of CONCURRENCY_MODELS (processes are forked, thus Unix only)
+    :param mode: How each request is rendered, one of MODES
+    :param batch_size: The number of mails of each request in the bulk mode
+    :return: a LoadTestReport of all the requests
+    """
+    if model not in CONCURRENCY_MODELS:
+        raise ValueError("Unknown concurrency model {}".format(model))
+    if mode not in MODES:
+        raise ValueError("Unknown mode {}".format(mode))
+    size = batch_size if mode == 'bulk' else 1
+    all_requests = [
+        [jobs[(index * size + offset) % len(jobs)] for offset in range(size)]
+        for index in range(requests)
+    ]
+    concurrency = max(min(concurrency, requests), 1)
+    shares = [all_requests[index::concurrency] for index in range(concurrency)]
+    report = LoadTestReport(messages_per_request=size)
+    start = time.perf_counter()
+    {'thread': _run_threads, 'process': _run_processes, 'async': _run_tasks}[model](mode, shares, report)
+    report.elapsed = time.perf_counter() - start
+    return report
@@ -0,0 +1,46 @@
+# ##############################################################################
+#
+#    OSIS stands for Open Student Information System. It's an application
+#    designed to manage the core business of higher education institutions,
+#    such as universities, faculties, institutes and professional schools.
+#    The core business involves the administration of students, teachers,
+#    courses, programs and so on.
+#
+#    Copyright (C) 2015-2021 Université catholique de Louvain (http://www.uclouvain.be)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    A copy of this license - GNU General Public License - is available
+#    at the root of the source code of this program.  If not,
+#    see http://www.gnu.org/licenses/.
+#
+# ##############################################################################
+import sys
+
+from django.core.management import BaseCommand
+
+from osis_mail_template.bundle import export_bundle
+
+
+class Command(BaseCommand):
+    help = "Export mail templates to a gzip-compressed JSON lines bundle, to be imported with import_mail_templates"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="The bundle to write (- for the standard output)")
+        parser.add_argument('identifiers', nargs='*', help="Only export these mail templates (default: all)")
+
+    def handle(self, *args, **options):
+        if options['path'] == '-':
+            export_bundle(sys.stdout.buffer, options['identifiers'] or None)
+            return
+        with open(options['path'], 'wb') as bundle:
+            count = export_bundle(bundle, options['identifiers'] or None)
+        self.stdout.write("{} mail template(s) exported to {}".format(count, options['path']))
@@ -0,0 +1,64 @@
+# ##############################################################################
+#
+#    OSIS stands for Open Student Information System. It's an application
+#    designed to manage the core business of higher education institutions,
+#    such as universities, faculties, institutes and professional schools.
+#    The core business involves the administration of students, teachers,
+#    courses, programs and so on.
+#
+#    Copyright (C) 2015-2021 Université catholique de Louvain (http://www.uclouvain.be)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    A copy of this license - GNU General Public License - is available
+#    at the root of the source code of this program.  If not,
+#    see http://www.gnu.org/licenses/.
+#
+# ##############################################################################
+import sys
+
+from django.core.management import BaseCommand, CommandError
+
+from osis_mail_template.bundle import import_bundle
+from osis_mail_template.exceptions import InvalidMailTemplateBundle
+
+
+class Command(BaseCommand):
+    help = "Import mail templates from a bundle written by export_mail_templates, only writing the changed ones"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="The bundle to read (- for the standard input)")
+        parser.add_argument('--batch-size', type=int, default=500, help="Number of rows compared and written at once")
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help="Only report what would be imported, without saving anything",
+        )
+
+    def handle(self, *args, **options):
+        from osis_mail_template import templates
+
+        try:
+            if options['path'] == '-':
+                report = import_bundle(sys.stdin.buffer, options['batch_size'], options['dry_run'])
+            else:
+                with open(options['path'], 'rb') as bundle:
+                    report = import_bundle(bundle, options['batch_size'], options['dry_run'])
+        except (InvalidMailTemplateBundle, OSError, EOFError) as e:
+            raise CommandError(e)
+
+        if report.registry_hash != templates.get_content_hash():
+            self.stdout.write(self.style.WARNING("The bundle was exported with other registered mail templates"))
+        for line_number, error in report.errors:
+            self.stderr.write("Line {}: {}".format(line_number, error))
+        if not report.ok:
+            raise CommandError("Nothing imported, {} invalid mail template(s)".format(len(report.errors)))
+        self.stdout.write("{}{}".format(report, " (dry run)" if options['dry_run'] else ""))
@@ -0,0 +1,99 @@
+# ##############################################################################
+#
+#    OSIS stands for Open Student Information System. It's an application
+#    designed to manage the core business of higher education institutions,
+#    such as universities, faculties, institutes and professional schools.
+#    The core business involves the administration of students, teachers,
+#    courses, programs and so on.
+#
+#    Copyright (C) 2015-2021 Université catholique de Louvain (http://www.uclouvain.be)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    A copy of this license - GNU General Public License - is available
+#    at the root of the source code of this program.  If not,
+#    see http://www.gnu.org/licenses/.
+#
+# ##############################################################################
+from django.core.management import BaseCommand, CommandError
+
+from osis_mail_template.loadtest import CONCURRENCY_MODELS, MODES, load_test
+from osis_mail_template.models import MailTemplate
+from osis_mail_template.rendering import engine
+from osis_mail_template.store import using_shared_cache
+
+
+class Command(BaseCommand):
+    help = "Render a mix of the registered mail templates from concurrent callers and report latencies and queries"
+
+    def add_arguments(self, parser):
+        parser.add_argument('identifiers', nargs='*', help="The mail templates to render (defaults to all)")
+        parser.add_argument('--requests', type=int, default=1000, help="Total number of requests")
+        parser.add_argument('--concurrency', type=int, default=8, help="Number of concurrent callers")
+        parser.add_argument('--model', choices=CONCURRENCY_MODELS, default='thread', help="How callers are simulated")
+        parser.add_argument(
+            '--modes',
+            nargs='+',
+            choices=MODES,
+            default=list(MODES),
+            help="Render each request as one message (baseline) or as a batch of messages (bulk)",
+        )
+        parser.add_argument('--batch-size', type=int, default=50, help="Number of messages of each bulk request")
+        parser.add_argument(
+            '--cache',
+            metavar='ALIAS',
+            help="Also run each mode sharing the compiled mail templates through this cache of settings.CACHES",
+        )
+
+    def handle(self, *args, **options):
+        from osis_mail_template import templates
+
+        identifiers = options['identifiers'] or list(templates.get_mail_templates())
+        pairs = MailTemplate.objects.filter(identifier__in=identifiers).order_by('identifier', 'language')
+        jobs = [
+            (identifier, language, templates.get_example_values(identifier), ['load-test@example.com'])
+            for identifier, language in pairs.values_list('identifier', 'language')
+        ]
+        if not jobs:
+            raise CommandError("No mail template to render")
+
+        runs = [(mode, None) for mode in options['modes']]
+        if options['cache']:
+            runs += [(mode, options['cache']) for mode in options['modes']]
+        self.stdout.write("{} requests from {} {} callers, over {} mail templates".format(
+            options['requests'], options['concurrency'], options['model'], len(jobs),
+        ))
+        self.stdout.write("{:<20}{:>12}{:>12}{:>12}{:>12}{:>12}{:>10}".format(
+            "Run", "Messages/s", "p50 (ms)", "p95 (ms)", "p99 (ms)", "Queries/msg", "Errors",
+        ))
+        for mode, cache in runs:
+            # Each run starts with no compiled mail template in the process
+            engine.clear()
+            with using_shared_cache(cache):
+                report = load_test(
+                    jobs,
+                    requests=options['requests'],
+                    concurrency=options['concurrency'],
+                    model=options['model'],
+                    mode=mode,
+                    batch_size=options['batch_size'],
+                )
+            self.stdout.write("{:<20}{:>12.1f}{:>12.2f}{:>12.2f}{:>12.2f}{:>12.2f}{:>10}".format(
+                mode + ('+' + cache if cache else ''),
+                report.throughput,
+                report.percentile(50) * 1000,
+                report.percentile(95) * 1000,
+                report.percentile(99) * 1000,
+                report.queries_per_message,
+                sum(report.errors.values()),
+            ))
+            for error, count in report.errors.items():
+                self.stdout.write(self.style.WARNING("  {}: {}".format(error, count)))
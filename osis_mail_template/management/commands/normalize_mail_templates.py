@@ -0,0 +1,65 @@
+# ##############################################################################
+#
+#    OSIS stands for Open Student Information System. It's an application
+#    designed to manage the core business of higher education institutions,
+#    such as universities, faculties, institutes and professional schools.
+#    The core business involves the administration of students, teachers,
+#    courses, programs and so on.
+#
+#    Copyright (C) 2015-2021 Université catholique de Louvain (http://www.uclouvain.be)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    A copy of this license - GNU General Public License - is available
+#    at the root of the source code of this program.  If not,
+#    see http://www.gnu.org/licenses/.
+#
+# ##############################################################################
+from django.core.management import BaseCommand
+from django.db import transaction
+
+from osis_mail_template.models import MailTemplate
+from osis_mail_template.normalization import normalize_html, saved_bytes
+
+
+class Command(BaseCommand):
+    help = "Normalize the HTML body of existing mail templates to reduce their size"
+
+    def add_arguments(self, parser):
+        parser.add_argument('identifiers', nargs='*', help="Only normalize these mail templates (default: all)")
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help="Only report the bytes that would be saved, without saving anything",
+        )
+
+    def handle(self, *args, **options):
+        queryset = MailTemplate.objects.order_by('identifier', 'language')
+        if options['identifiers']:
+            queryset = queryset.filter(identifier__in=options['identifiers'])
+
+        total = changed = 0
+        with transaction.atomic():
+            for template in queryset.iterator():
+                normalized = normalize_html(template.body)
+                saved = saved_bytes(template.body, normalized)
+                if normalized == template.body:
+                    continue
+                changed += 1
+                total += saved
+                self.stdout.write("{} ({}): {} bytes saved".format(template.identifier, template.language, saved))
+                if not options['dry_run']:
+                    # Saving bumps the version and creates a revision
+                    template.body = normalized
+                    template.save()
+        self.stdout.write("{} mail template(s) normalized, {} bytes saved{}".format(
+            changed, total, " (dry run)" if options['dry_run'] else "",
+        ))
@@ -0,0 +1,66 @@
+# ##############################################################################
+#
+#    OSIS stands for Open Student Information System. It's an application
+#    designed to manage the core business of higher education institutions,
+#    such as universities, faculties, institutes and professional schools.
+#    The core business involves the administration of students, teachers,
+#    courses, programs and so on.
+#
+#    Copyright (C) 2015-2021 Université catholique de Louvain (http://www.uclouvain.be)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    A copy of this license - GNU General Public License - is available
+#    at the root of the source code of this program.  If not,
+#    see http://www.gnu.org/licenses/.
+#
+# ##############################################################################
+import time
+
+from django.core.management import BaseCommand
+
+from osis_mail_template.sending import process_outbox
+
+
+class Command(BaseCommand):
+    help = "Render and send the pending mails of the outbox, by batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help="Number of mails processed per batch")
+        parser.add_argument('--max-attempts', type=int, default=3, help="Number of attempts before giving up a mail")
+        parser.add_argument('--pool-size', type=int, default=4, help="Number of SMTP connections to use")
+        parser.add_argument(
+            '--retry-delay',
+            type=float,
+            default=60,
+            help="Seconds before retrying a mail that failed to send, doubled with each attempt",
+        )
+        parser.add_argument(
+            '--loop',
+            action='store_true',
+            help="Keep polling the outbox for new mails instead of stopping when it is empty",
+        )
+        parser.add_argument('--sleep', type=float, default=5, help="Seconds to wait between polls with --loop")
+
+    def handle(self, *args, **options):
+        while True:
+            report = process_outbox(
+                batch_size=options['batch_size'],
+                max_attempts=options['max_attempts'],
+                pool_size=options['pool_size'],
+                retry_delay=options['retry_delay'],
+            )
+            if report.sent or report.failed:
+                self.stdout.write(str(report))
+            elif options['loop']:
+                time.sleep(options['sleep'])
+            else:
+                break
@@ -0,0 +1,107 @@
+# ##############################################################################
+#
+#    OSIS stands for Open Student Information System. It's an application
+#    designed to manage the core business of higher education institutions,
+#    such as universities, faculties, institutes and professional schools.
+#    The core business involves the administration of students, teachers,
+#    courses, programs and so on.
+#
+#    Copyright (C) 2015-2021 Université catholique de Louvain (http://www.uclouvain.be)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    A copy of this license - GNU General Public License - is available
+#    at the root of the source code of this program.  If not,
+#    see http://www.gnu.org/licenses/.
+#
+# ##############################################################################
+import cProfile
+import io
+import json
+import pstats
+
+from django.core.management import BaseCommand, CommandError
+
+from osis_mail_template.exceptions import UnknownMailTemplateIdentifier
+from osis_mail_template.models import MailTemplate
+from osis_mail_template.profiling import find_outliers, markup_stats, profile_render
+
+
+class Command(BaseCommand):
+    help = "Profile the rendering of a mail template, by phase, and compare its body with the other mail templates"
+
+    def add_arguments(self, parser):
+        parser.add_argument('identifier', help="The mail template identifier")
+        parser.add_argument('language', help="The mail template language")
+        parser.add_argument('--iterations', type=int, default=10, help="Number of timed renders")
+        parser.add_argument(
+            '--tokens',
+            help="Token values as a JSON object, overriding the example values of the registry",
+        )
+        parser.add_argument(
+            '--cprofile',
+            type=int,
+            default=0,
+            metavar='LINES',
+            help="Also render under cProfile and print this number of lines of statistics",
+        )
+        parser.add_argument(
+            '--outlier-factor',
+            type=float,
+            default=4,
+            help="How many times the median of all mail templates a body measure must exceed to be flagged",
+        )
+
+    def handle(self, *args, **options):
+        identifier, language = options['identifier'], options['language']
+        template = MailTemplate.objects.filter(identifier=identifier, language=language).first()
+        if template is None:
+            raise CommandError("No mail template {} in {}".format(identifier, language))
+
+        from osis_mail_template import templates
+        try:
+            tokens = templates.get_example_values(identifier)
+        except UnknownMailTemplateIdentifier:
+            tokens = {}
+        if options['tokens']:
+            try:
+                tokens.update(json.loads(options['tokens']))
+            except (ValueError, TypeError) as e:
+                raise CommandError("Invalid JSON tokens: {}".format(e))
+
+        self.stdout.write("Rendering {} ({}) {} times".format(identifier, language, options['iterations']))
+        profiles = profile_render(template, tokens, iterations=options['iterations'])
+        self.stdout.write("{:<12}{:>14}{:>14}{:>14}".format("Phase", "Mean (ms)", "Best (ms)", "Peak (KiB)"))
+        for profile in profiles:
+            self.stdout.write("{:<12}{:>14.3f}{:>14.3f}{:>14.1f}".format(
+                profile.name, profile.mean * 1000, profile.best * 1000, profile.peak_bytes / 1024,
+            ))
+
+        if options['cprofile']:
+            profiler = cProfile.Profile()
+            profiler.runcall(profile_render, template, tokens, iterations=options['iterations'])
+            output = io.StringIO()
+            pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(options['cprofile'])
+            self.stdout.write(output.getvalue())
+
+        stats = markup_stats(template.body)
+        self.stdout.write("Body: " + ", ".join("{} {}".format(k, v) for k, v in stats.as_dict().items()))
+        bodies = {
+            "{} ({})".format(other_identifier, other_language): body
+            for other_identifier, other_language, body
+            in MailTemplate.objects.values_list('identifier', 'language', 'body')
+        }
+        label = "{} ({})".format(identifier, language)
+        reasons = find_outliers(bodies, factor=options['outlier_factor']).get(label)
+        if reasons:
+            self.stdout.write(self.style.WARNING(
+                "Out of line with the other mail templates: {}".format(", ".join(reasons))
+            ))
@@ -0,0 +1,43 @@
+# Generated by Django 3.2.25 on 2026-10-19 10:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('osis_mail_template', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxMail',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('identifier', models.CharField(max_length=255, verbose_name='Identifier')),
+                ('language', models.CharField(max_length=25, verbose_name='Language')),
+                ('tokens', models.TextField(verbose_name='Tokens')),
+                ('recipients', models.TextField(verbose_name='Recipients')),
+                ('sender', models.CharField(blank=True, max_length=255, verbose_name='Sender')),
+                ('status', models.CharField(
+                    choices=[('PENDING', 'Pending'), ('SENT', 'Sent'), ('FAILED', 'Failed')],
+                    default='PENDING',
+                    max_length=10,
+                    verbose_name='Status',
+                )),
+                ('attempts', models.PositiveSmallIntegerField(default=0, verbose_name='Attempts')),
+                ('last_error', models.TextField(blank=True, verbose_name='Last error')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Created at')),
+                ('sent_at', models.DateTimeField(blank=True, null=True, verbose_name='Sent at')),
+                ('next_attempt_at', models.DateTimeField(blank=True, null=True, verbose_name='Next attempt at')),
+            ],
+            options={
+                'verbose_name': 'Outbox mail',
+                'verbose_name_plural': 'Outbox mails',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='outboxmail',
+            index=models.Index(fields=['status', 'id'], name='osis_mail_t_status_2bf1aa_idx'),
+        ),
+    ]
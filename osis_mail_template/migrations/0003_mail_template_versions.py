@@ -0,0 +1,56 @@
+# Generated by Django 3.2.25 on 2026-10-19 10:34
+
+from django.db import migrations, models
+
+
+def create_initial_revisions(apps, schema_editor):
+    MailTemplate = apps.get_model('osis_mail_template', 'MailTemplate')
+    MailTemplateRevision = apps.get_model('osis_mail_template', 'MailTemplateRevision')
+    MailTemplateRevision.objects.bulk_create(
+        MailTemplateRevision(
+            identifier=template.identifier,
+            language=template.language,
+            version=template.version,
+            subject=template.subject,
+            body=template.body,
+        )
+        for template in MailTemplate.objects.all()
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('osis_mail_template', '0002_outbox_mail'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mailtemplate',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, verbose_name='Updated at'),
+        ),
+        migrations.AddField(
+            model_name='mailtemplate',
+            name='version',
+            field=models.PositiveIntegerField(default=1, editable=False, verbose_name='Version'),
+        ),
+        migrations.CreateModel(
+            name='MailTemplateRevision',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('identifier', models.CharField(max_length=255, verbose_name='Identifier')),
+                ('language', models.CharField(max_length=25, verbose_name='Language')),
+                ('version', models.PositiveIntegerField(verbose_name='Version')),
+                ('subject', models.CharField(max_length=255, verbose_name='Subject')),
+                ('body', models.TextField(verbose_name='Body')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Created at')),
+            ],
+            options={
+                'verbose_name': 'Mail template revision',
+                'verbose_name_plural': 'Mail template revisions',
+                'unique_together': {('identifier', 'language', 'version')},
+            },
+        ),
+        migrations.RunPython(create_initial_revisions, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 3.2.25 on 2026-10-19 10:47
+
+import hashlib
+
+from django.db import migrations, models
+
+
+def compute_content_hash(subject, body):
+    # Same as osis_mail_template.versioning.compute_content_hash() when this migration was written
+    content = hashlib.sha1(subject.encode())
+    content.update(b'\0')
+    content.update(body.encode())
+    return content.hexdigest()
+
+
+def compute_content_hashes(apps, schema_editor):
+    MailTemplate = apps.get_model('osis_mail_template', 'MailTemplate')
+    templates = list(MailTemplate.objects.only('subject', 'body'))
+    for template in templates:
+        template.content_hash = compute_content_hash(template.subject, template.body)
+    MailTemplate.objects.bulk_update(templates, ['content_hash'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('osis_mail_template', '0003_mail_template_versions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mailtemplate',
+            name='content_hash',
+            field=models.CharField(default='', editable=False, max_length=40),
+        ),
+        migrations.RunPython(compute_content_hashes, migrations.RunPython.noop),
+    ]
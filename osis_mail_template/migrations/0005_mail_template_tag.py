@@ -0,0 +1,29 @@
+# Generated by Django 3.2.25 on 2026-10-19 10:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('osis_mail_template', '0004_mail_template_content_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mailtemplate',
+            name='tag',
+            field=models.CharField(blank=True, default='', editable=False, max_length=255, verbose_name='Tag'),
+        ),
+        migrations.AddIndex(
+            model_name='mailtemplate',
+            index=models.Index(
+                fields=['identifier', 'language', 'version', 'content_hash'],
+                name='mail_template_version_idx',
+            ),
+        ),
+        migrations.AddIndex(
+            model_name='mailtemplate',
+            index=models.Index(fields=['tag', 'identifier'], name='mail_template_tag_idx'),
+        ),
+    ]
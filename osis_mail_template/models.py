@@ -23,10 +23,19 @@
 #    see http://www.gnu.org/licenses/.
 #
 # ##############################################################################
-from typing import Dict
+import json
+from collections import OrderedDict
+from functools import lru_cache, partial
+from typing import Dict, FrozenSet, Iterable, List, Tuple
 
 from django.conf import settings
-from django.db import models
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import models, transaction
+from django.db.models import F
+from django.core.signals import setting_changed
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import translation
 from django.utils.translation import gettext_lazy as _
 
 from osis_mail_template.exceptions import (
@@ -35,6 +44,51 @@ from osis_mail_template.exceptions import (
     UnknownLanguage,
 )
 from osis_mail_template.utils import MissingTokenDict, transform_html_to_text
+from osis_mail_template.versioning import compute_content_hash, get_registered_tag, next_version
+
+
+# Renders with the example values of the tokens, by registry generation, identifier, content hash and active language
+_example_renders = {}  # type: Dict[tuple, Tuple[str, str, str]]
+EXAMPLE_RENDERS_MAX_SIZE = 1024
+
+
+@lru_cache(maxsize=None)
+def get_languages() -> FrozenSet[str]:
+    """The codes of settings.LANGUAGES, computed once"""
+    return frozenset(code for code, _name in settings.LANGUAGES)
+
+
+def is_language_fallback_enabled() -> bool:
+    """Whether mail templates missing in a language fall back to other languages, from a setting"""
+    return getattr(settings, 'OSIS_MAIL_TEMPLATE_LANGUAGE_FALLBACK', False)
+
+
+def _base_language(language: str) -> str:
+    return language.split('-')[0]
+
+
+@lru_cache(maxsize=256)
+def get_language_chain(language: str) -> Tuple[str, ...]:
+    """
+    The languages of settings.LANGUAGES a mail template is looked up in, in order, for a language: the language
+    itself (normalized, e.g. fr-be for fr_BE), its base language (fr), the other variants of its base language, then
+    settings.LANGUAGE_CODE and its base language. Empty if none of them is configured.
+    """
+    configured = OrderedDict((code.lower(), code) for code, _name in settings.LANGUAGES)
+    normalized = language.strip().lower().replace('_', '-')
+    default = settings.LANGUAGE_CODE.lower()
+    candidates = [normalized, _base_language(normalized)]
+    candidates += [code for code in configured if _base_language(code) == _base_language(normalized)]
+    candidates += [default, _base_language(default)]
+    return tuple(OrderedDict.fromkeys(configured[code] for code in candidates if code in configured))
+
+
+@receiver(setting_changed)
+def clear_languages(setting, **kwargs):
+    if setting == 'LANGUAGES':
+        get_languages.cache_clear()
+    if setting in ('LANGUAGES', 'LANGUAGE_CODE'):
+        get_language_chain.cache_clear()
 
 
 class MailTemplateManager(models.Manager):
@@ -50,16 +104,126 @@ class MailTemplateManager(models.Manager):
             raise EmptyMailTemplateContent(identifier)
         return instances
 
-    def get_mail_template(self, identifier: str, language: str):
-        """Get a single mail template instance by identifier and language"""
-        try:
-            assert language in dict(settings.LANGUAGES)
-        except AssertionError:
+    def get_mail_template(self, identifier: str, language: str, fallback: bool = None):
+        """
+        Get a single mail template instance by identifier and language
+
+        With fallback (defaults to the OSIS_MAIL_TEMPLATE_LANGUAGE_FALLBACK setting), the mail template is looked up
+        along get_language_chain(language) with a single query.
+        """
+        if not (is_language_fallback_enabled() if fallback is None else fallback):
+            if language not in get_languages():
+                raise UnknownLanguage(language)
+            try:
+                return self.get_queryset().get(identifier=identifier, language=language)
+            except MailTemplate.DoesNotExist:
+                raise EmptyMailTemplateContent(identifier, language)
+        chain = get_language_chain(language)
+        if not chain:
             raise UnknownLanguage(language)
-        try:
-            return self.get_queryset().get(identifier=identifier, language=language)
-        except MailTemplate.DoesNotExist:
-            raise EmptyMailTemplateContent(identifier, language)
+        instances = {instance.language: instance for instance in self.get_queryset().filter(
+            identifier=identifier,
+            language__in=chain,
+        )}
+        for candidate in chain:
+            if candidate in instances:
+                return instances[candidate]
+        raise EmptyMailTemplateContent(identifier, language)
+
+    def sync_tags(self, using: str = None) -> int:
+        """
+        Copy the tags of the registry to the mail templates, with one update per changed tag
+
+        :param using: The alias of the database to update (defaults to the one chosen by the routers)
+        """
+        from osis_mail_template import templates
+
+        identifiers_by_tag = {}
+        for identifier in templates.get_mail_templates():
+            identifiers_by_tag.setdefault(get_registered_tag(identifier), []).append(identifier)
+        queryset = self.get_queryset() if using is None else self.get_queryset().using(using)
+        return sum(
+            queryset.filter(identifier__in=identifiers).exclude(tag=tag).update(tag=tag)
+            for tag, identifiers in identifiers_by_tag.items()
+        )
+
+    def get_versions(self, pairs: Iterable[Tuple[str, str]]) -> Dict[Tuple[str, str], Tuple[int, str]]:
+        """Get the current version and content hash of mail templates, by (identifier, language), in a single query"""
+        pairs = set(pairs)
+        queryset = self.get_queryset().filter(
+            identifier__in={identifier for identifier, _language in pairs},
+            language__in={language for _identifier, language in pairs},
+        ).values_list('identifier', 'language', 'version', 'content_hash')
+        return {(identifier, language): (version, content_hash)
+                for identifier, language, version, content_hash in queryset if (identifier, language) in pairs}
+
+    def get_compiled_templates(self, pairs: Iterable[Tuple[str, str]], fallback: bool = None) -> dict:
+        """
+        Get compiled mail templates by (identifier, language), fetching only the ones changed since last compiled
+
+        Compiled templates are looked up in the process first, then in the shared cache (if configured with
+        settings.OSIS_MAIL_TEMPLATE_CACHE), then in the database: the current versions and content hashes are
+        checked with a single query, the content of outdated (or never compiled) mail templates being fetched with
+        another one.
+
+        With fallback (defaults to the OSIS_MAIL_TEMPLATE_LANGUAGE_FALLBACK setting), all the languages of
+        get_language_chain() are looked up within the same queries, a couple getting the compiled mail template of
+        the first language found (which is then the language it is rendered in).
+
+        :return: a dictionary mapping each (identifier, language) couple to its CompiledMailTemplate, or to the
+            error raised when getting it (UnknownLanguage, EmptyMailTemplateContent, UnknownMailTemplateIdentifier)
+        """
+        from osis_mail_template import store, templates
+        from osis_mail_template.rendering import engine
+
+        pairs = set(pairs)
+        if is_language_fallback_enabled() if fallback is None else fallback:
+            chains = {
+                (identifier, language): [(identifier, candidate) for candidate in get_language_chain(language)]
+                for identifier, language in pairs
+            }
+        else:
+            languages = get_languages()
+            chains = {(identifier, language): [(identifier, language)] if language in languages else []
+                      for identifier, language in pairs}
+        known_pairs = {candidate for chain in chains.values() for candidate in chain}
+        compiled_templates = store.get_shared_compiled_templates(known_pairs)
+        remaining = known_pairs - compiled_templates.keys()
+        if remaining:
+            versions = self.get_versions(remaining)
+            outdated = [
+                pair for pair, (version, content_hash) in versions.items()
+                if engine.get_compiled(*pair, version=version, content_hash=content_hash) is None
+            ]
+            if outdated:
+                for template in self.get_queryset().filter(
+                    identifier__in={identifier for identifier, _language in outdated},
+                    language__in={language for _identifier, language in outdated},
+                ):
+                    engine.compile(template)
+            fetched = {pair: engine.get_compiled(*pair) for pair in versions}
+            store.share(fetched.values())
+            compiled_templates.update(fetched)
+
+        resolved = {}
+        for (identifier, language), chain in chains.items():
+            found = [compiled_templates[candidate] for candidate in chain if candidate in compiled_templates]
+            if found:
+                resolved[identifier, language] = found[0]
+            elif not chain:
+                resolved[identifier, language] = UnknownLanguage(language)
+            elif identifier not in templates.get_mail_templates():
+                resolved[identifier, language] = UnknownMailTemplateIdentifier(identifier)
+            else:
+                resolved[identifier, language] = EmptyMailTemplateContent(identifier, language)
+        return resolved
+
+    def get_compiled_template(self, identifier: str, language: str, fallback: bool = None):
+        """Get a single compiled mail template by identifier and language (see get_compiled_templates())"""
+        compiled = self.get_compiled_templates([(identifier, language)], fallback)[identifier, language]
+        if isinstance(compiled, Exception):
+            raise compiled
+        return compiled
 
 
 def check_mail_template_identifier(identifier):
@@ -86,6 +250,28 @@ class MailTemplate(models.Model):
     body = models.TextField(
         verbose_name=_("Body"),
     )
+    version = models.PositiveIntegerField(
+        verbose_name=_("Version"),
+        default=1,
+        editable=False,
+    )
+    updated_at = models.DateTimeField(
+        verbose_name=_("Updated at"),
+        auto_now=True,
+    )
+    content_hash = models.CharField(
+        max_length=40,
+        editable=False,
+        default='',
+    )
+    # Copied from the registry (see sync_tags), so that mail templates can be filtered by tag in SQL
+    tag = models.CharField(
+        max_length=255,
+        verbose_name=_("Tag"),
+        editable=False,
+        blank=True,
+        default='',
+    )
 
     objects = MailTemplateManager()
 
@@ -95,26 +281,248 @@ class MailTemplate(models.Model):
         unique_together = [
             ['identifier', 'language'],
         ]
+        indexes = [
+            # Covers get_versions(), which is then answered from the index only
+            models.Index(
+                fields=['identifier', 'language', 'version', 'content_hash'],
+                name='mail_template_version_idx',
+            ),
+            models.Index(fields=['tag', 'identifier'], name='mail_template_tag_idx'),
+        ]
 
     def __str__(self):
         return '{}-{}'.format(self.identifier, self.language)
 
-    def _replace_tokens(self, field: str, tokens: Dict[str, str] = None) -> str:
-        if tokens is None:
-            from osis_mail_template import templates
-            tokens = templates.get_example_values(self.identifier)
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._saved_content = (instance.__dict__.get('subject'), instance.__dict__.get('body'))
+        return instance
+
+    def save(self, *args, **kwargs):
+        """Save the mail template, bumping its version and keeping a revision when its content changed"""
+        content = (self.subject, self.body)
+        changed = self.pk is None or content != getattr(self, '_saved_content', None)
+        bumped = changed and self.pk is not None
+        self.content_hash = compute_content_hash(*content)
+        self.tag = get_registered_tag(self.identifier)
+        if kwargs.get('update_fields') is not None:
+            # The fields kept in sync with the content are saved along with it
+            kwargs['update_fields'] = set(kwargs['update_fields']) | {'version', 'content_hash', 'tag', 'updated_at'}
+        with transaction.atomic():
+            if self.pk is None:
+                # Versions keep increasing if a mail template is removed and created again
+                self.version = next_version(MailTemplateRevision, self.identifier, self.language)
+            elif bumped:
+                # Incremented in the database, so that concurrent edits can't get the same version
+                self.version = F('version') + 1
+            super().save(*args, **kwargs)
+            if bumped:
+                self.refresh_from_db(fields=['version'])
+            if changed:
+                MailTemplateRevision.objects.create(
+                    identifier=self.identifier,
+                    language=self.language,
+                    version=self.version,
+                    subject=self.subject,
+                    body=self.body,
+                )
+        self._saved_content = content
+
+    def _replace_tokens(self, field: str, tokens: Dict[str, str]) -> str:
         # As we want to avoid runtime errors, we use MissingTokenDict to prevent KeyError and still fill missing tokens
         return getattr(self, field).format_map(MissingTokenDict(**tokens))
 
+    def render_examples(self) -> Tuple[str, str, str]:
+        """
+        Renders the subject, the body as HTML and the body as plain text with example values
+
+        Renders are shared by all the instances with the same content, until the registered templates change.
+        """
+        from osis_mail_template import templates
+
+        key = (
+            templates.generation,
+            self.identifier,
+            compute_content_hash(self.subject, self.body),
+            translation.get_language(),
+        )
+        rendered = _example_renders.get(key)
+        if rendered is None:
+            tokens = templates.get_example_values(self.identifier)
+            body = self._replace_tokens('body', tokens)
+            rendered = (self._replace_tokens('subject', tokens), body, transform_html_to_text(body))
+            if len(_example_renders) >= EXAMPLE_RENDERS_MAX_SIZE:
+                _example_renders.clear()
+            _example_renders[key] = rendered
+        return rendered
+
     def render_subject(self, tokens: Dict[str, str] = None) -> str:
         """Renders the subject with the given tokens, or example values"""
+        if tokens is None:
+            return self.render_examples()[0]
         return self._replace_tokens('subject', tokens)
 
     def body_as_html(self, tokens: Dict[str, str] = None) -> str:
         """Renders the body as HTML with the given tokens, or example values"""
+        if tokens is None:
+            return self.render_examples()[1]
         return self._replace_tokens('body', tokens)
 
     def body_as_plain(self, tokens: Dict[str, str] = None) -> str:
         """Renders the body as plain text with the given tokens, or example values"""
+        if tokens is None:
+            return self.render_examples()[2]
         formatted_body = self.body_as_html(tokens)
         return transform_html_to_text(formatted_body)
+
+
+@receiver([post_save, post_delete], sender=MailTemplate)
+def forget_shared_compiled_template(sender, instance, **kwargs):
+    from osis_mail_template import store
+
+    # Once committed, so that other processes can't share the previous version again in the meantime
+    transaction.on_commit(partial(store.forget, instance.identifier, instance.language))
+
+
+class MailTemplateRevision(models.Model):
+    """An immutable snapshot of a mail template content, for each of its versions"""
+    identifier = models.CharField(
+        max_length=255,
+        verbose_name=_("Identifier"),
+    )
+    language = models.CharField(
+        max_length=25,
+        verbose_name=_("Language"),
+    )
+    version = models.PositiveIntegerField(
+        verbose_name=_("Version"),
+    )
+    subject = models.CharField(
+        max_length=255,
+        verbose_name=_("Subject"),
+    )
+    body = models.TextField(
+        verbose_name=_("Body"),
+    )
+    created_at = models.DateTimeField(
+        verbose_name=_("Created at"),
+        auto_now_add=True,
+    )
+
+    class Meta:
+        verbose_name = _("Mail template revision")
+        verbose_name_plural = _("Mail template revisions")
+        unique_together = [
+            ['identifier', 'language', 'version'],
+        ]
+
+    def __str__(self):
+        return '{}-{} v{}'.format(self.identifier, self.language, self.version)
+
+
+class OutboxMailManager(models.Manager):
+    def enqueue(self, identifier: str, language: str, tokens: Dict[str, str], recipients: List[str],
+                sender: str = None) -> 'OutboxMail':
+        """Store a mail to be rendered and sent later by the process_mail_outbox command"""
+        from osis_mail_template import templates
+
+        # Fail early on what can be checked without querying the database
+        templates.get_mail_template(identifier)
+        if language not in get_languages() and not (is_language_fallback_enabled() and get_language_chain(language)):
+            raise UnknownLanguage(language)
+
+        # Lazy translations in tokens are resolved now, in the mail language, as they can't be serialized
+        with translation.override(language):
+            serialized_tokens = json.dumps(tokens, cls=DjangoJSONEncoder)
+        return self.create(
+            identifier=identifier,
+            language=language,
+            tokens=serialized_tokens,
+            recipients=json.dumps(list(recipients)),
+            sender=sender or '',
+        )
+
+
+class OutboxMail(models.Model):
+    """A mail waiting to be rendered and sent by the process_mail_outbox command"""
+    PENDING = 'PENDING'
+    SENT = 'SENT'
+    FAILED = 'FAILED'
+    STATUSES = (
+        (PENDING, _("Pending")),
+        (SENT, _("Sent")),
+        (FAILED, _("Failed")),
+    )
+
+    identifier = models.CharField(
+        max_length=255,
+        verbose_name=_("Identifier"),
+    )
+    language = models.CharField(
+        max_length=25,
+        verbose_name=_("Language"),
+    )
+    tokens = models.TextField(
+        verbose_name=_("Tokens"),
+    )
+    recipients = models.TextField(
+        verbose_name=_("Recipients"),
+    )
+    sender = models.CharField(
+        max_length=255,
+        verbose_name=_("Sender"),
+        blank=True,
+    )
+    status = models.CharField(
+        max_length=10,
+        verbose_name=_("Status"),
+        choices=STATUSES,
+        default=PENDING,
+    )
+    attempts = models.PositiveSmallIntegerField(
+        verbose_name=_("Attempts"),
+        default=0,
+    )
+    last_error = models.TextField(
+        verbose_name=_("Last error"),
+        blank=True,
+    )
+    created_at = models.DateTimeField(
+        verbose_name=_("Created at"),
+        auto_now_add=True,
+    )
+    sent_at = models.DateTimeField(
+        verbose_name=_("Sent at"),
+        null=True,
+        blank=True,
+    )
+    # Set after a transient failure, so that the mail is not retried right away
+    next_attempt_at = models.DateTimeField(
+        verbose_name=_("Next attempt at"),
+        null=True,
+        blank=True,
+    )
+
+    objects = OutboxMailManager()
+
+    class Meta:
+        verbose_name = _("Outbox mail")
+        verbose_name_plural = _("Outbox mails")
+        indexes = [
+            models.Index(fields=['status', 'id']),
+        ]
+
+    def __str__(self):
+        return '{}-{} ({})'.format(self.identifier, self.language, self.status)
+
+    def as_mail_job(self):
+        from osis_mail_template.sending import MailJob
+
+        return MailJob(
+            self.identifier,
+            self.language,
+            json.loads(self.tokens),
+            json.loads(self.recipients),
+            self.sender or None,
+        )
@@ -0,0 +1,223 @@
+# ##############################################################################
+#
+#    OSIS stands for Open Student Information System. It's an application
+#    designed to manage the core business of higher education institutions,
+#    such as universities, faculties, institutes and professional schools.
+#    The core business involves the administration of students, teachers,
+#    courses, programs and so on.
+#
+#    Copyright (C) 2015-2021 Université catholique de Louvain (http://www.uclouvain.be)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    A copy of this license - GNU General Public License - is available
+#    at the root of the source code of this program.  If not,
+#    see http://www.gnu.org/licenses/.
+#
+# ##############################################################################
+import re
+import string
+from collections import OrderedDict
+from html import escape
+from html.parser import HTMLParser
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+
+__all__ = [
+    'is_normalization_enabled',
+    'normalize_html',
+    'saved_bytes',
+]
+
+# HTML whitespace only: non-breaking spaces (e.g. of French typography) are displayed, they must be kept
+HTML_WHITESPACE = ' \t\n\r\f'
+_WHITESPACE = re.compile('[{}]+'.format(HTML_WHITESPACE))
+
+# Inline elements that can be removed, keeping their content, when they bear no attribute
+UNWRAPPABLE_ELEMENTS = {'span', 'font'}
+# Elements whose whitespace is significant
+PREFORMATTED_ELEMENTS = {'pre', 'textarea'}
+VOID_ELEMENTS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'source', 'wbr'}
+# Properties inherited from a parent, that are redundant when repeated with the same value by a nested span
+INHERITED_PROPERTIES = {
+    'color', 'font', 'font-family', 'font-size', 'font-style', 'font-variant', 'font-weight', 'letter-spacing',
+    'line-height', 'text-align', 'text-indent', 'text-transform', 'white-space', 'word-spacing',
+}
+
+
+def is_normalization_enabled() -> bool:
+    """Whether HTML bodies are normalized when saved, from the OSIS_MAIL_TEMPLATE_NORMALIZE_HTML setting"""
+    return getattr(settings, 'OSIS_MAIL_TEMPLATE_NORMALIZE_HTML', False)
+
+
+def _parse_style(style: str) -> Dict[str, str]:
+    declarations = OrderedDict()
+    for declaration in style.split(';'):
+        name, _, value = declaration.partition(':')
+        name, value = name.strip().lower(), ' '.join(value.split())
+        # Office suites properties are meaningless to mail clients
+        if name and value and not name.startswith('mso-'):
+            # The last declaration of a property wins, as in a browser
+            declarations.pop(name, None)
+            declarations[name] = value
+    return declarations
+
+
+class _Element:
+    __slots__ = ('tag', 'style', 'unwrapped', 'start')
+
+    def __init__(self, tag: str, style: Dict[str, str], unwrapped: bool, start: Optional[int]) -> None:
+        self.tag = tag
+        self.style = style
+        self.unwrapped = unwrapped
+        # Position of the start tag in the output, to remove it if the element turns out to be empty
+        self.start = start
+
+
+class _Normalizer(HTMLParser):
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=False)
+        self.output = []  # type: List[str]
+        self.stack = []  # type: List[_Element]
+        self.preformatted = 0
+
+    def inherited_style(self) -> Dict[str, str]:
+        return self.stack[-1].style if self.stack else {}
+
+    def serialize_attrs(self, tag: str, attrs: List[Tuple[str, Optional[str]]]) -> Tuple[str, Dict[str, str]]:
+        inherited = self.inherited_style()
+        style = OrderedDict()
+        serialized = []
+        for name, value in attrs:
+            if name == 'style':
+                style.update(_parse_style(value or ''))
+                continue
+            serialized.append(' {}'.format(name) if value is None else ' {}="{}"'.format(name, escape(value)))
+        if tag not in UNWRAPPABLE_ELEMENTS:
+            # Other elements may have their own default style (e.g. links), they don't inherit from their parent
+            inherited = {}
+        own_style = OrderedDict(
+            (name, value) for name, value in style.items()
+            if name not in INHERITED_PROPERTIES or inherited.get(name) != value
+        )
+        if own_style:
+            serialized.append(' style="{}"'.format(escape('; '.join(
+                '{}: {}'.format(name, value) for name, value in own_style.items()
+            ))))
+        computed = OrderedDict((name, value) for name, value in inherited.items())
+        computed.update((name, value) for name, value in style.items() if name in INHERITED_PROPERTIES)
+        return ''.join(serialized), computed
+
+    def handle_starttag(self, tag, attrs):
+        serialized, computed = self.serialize_attrs(tag, attrs)
+        if tag in VOID_ELEMENTS:
+            self.output.append('<{}{}>'.format(tag, serialized))
+            return
+        # Office suites namespaced elements (e.g. <o:p>) are meaningless to mail clients
+        unwrapped = tag in UNWRAPPABLE_ELEMENTS and not serialized or ':' in tag
+        start = None
+        if not unwrapped:
+            start = len(self.output)
+            self.output.append('<{}{}>'.format(tag, serialized))
+        if tag in PREFORMATTED_ELEMENTS:
+            self.preformatted += 1
+        self.stack.append(_Element(tag, computed, unwrapped, start))
+
+    def handle_startendtag(self, tag, attrs):
+        serialized, _ = self.serialize_attrs(tag, attrs)
+        if tag in VOID_ELEMENTS:
+            self.output.append('<{}{}>'.format(tag, serialized))
+        elif tag not in UNWRAPPABLE_ELEMENTS and ':' not in tag:
+            self.output.append('<{}{} />'.format(tag, serialized))
+
+    def handle_endtag(self, tag):
+        if tag in VOID_ELEMENTS:
+            return
+        if not any(element.tag == tag for element in self.stack):
+            # Stray end tag, kept as is
+            self.output.append('</{}>'.format(tag))
+            return
+        # Close the elements left open inside this one
+        while True:
+            element = self.stack.pop()
+            if element.tag in PREFORMATTED_ELEMENTS:
+                self.preformatted -= 1
+            if element.unwrapped:
+                pass
+            elif element.tag in UNWRAPPABLE_ELEMENTS and not ''.join(self.output[element.start + 1:]).strip():
+                # Empty (or only whitespace) styling element
+                whitespace = ''.join(self.output[element.start + 1:])
+                del self.output[element.start:]
+                self.append_text(whitespace)
+            else:
+                self.output.append('</{}>'.format(element.tag))
+            if element.tag == tag:
+                break
+
+    def append_text(self, text: str) -> None:
+        if not self.preformatted:
+            text = _WHITESPACE.sub(' ', text)
+            if text.startswith(' ') and self.output and self.output[-1].endswith(' '):
+                text = text[1:]
+        if text:
+            self.output.append(text)
+
+    def handle_data(self, data):
+        self.append_text(data)
+
+    def handle_entityref(self, name):
+        self.output.append('&{};'.format(name))
+
+    def handle_charref(self, name):
+        self.output.append('&#{};'.format(name))
+
+    def handle_comment(self, data):
+        # Comments (including office suites conditional comments) are not displayed
+        pass
+
+    def handle_decl(self, decl):
+        self.output.append('<!{}>'.format(decl))
+
+    def handle_pi(self, data):
+        self.output.append('<?{}>'.format(data))
+
+    def unknown_decl(self, data):
+        self.output.append('<![{}]>'.format(data))
+
+
+def _fields(source: str) -> List[Tuple[str, str, str]]:
+    try:
+        return [parsed[1:] for parsed in string.Formatter().parse(source) if parsed[1] is not None]
+    except ValueError:
+        return []
+
+
+def normalize_html(html: str) -> str:
+    """
+    Normalize an HTML body to reduce its size, without changing how it is displayed
+
+    Empty spans, spans without attribute and office suites markup are removed, inline styles are deduplicated
+    (including properties repeated from a parent element) and whitespace is collapsed (except in preformatted text).
+    Tokens are left intact: if the normalization would alter them, the original HTML is returned.
+    """
+    normalizer = _Normalizer()
+    normalizer.feed(html)
+    normalizer.close()
+    normalized = ''.join(normalizer.output).strip(HTML_WHITESPACE)
+    if _fields(normalized) != _fields(html):
+        return html
+    return normalized
+
+
+def saved_bytes(original: str, normalized: str) -> int:
+    """The number of bytes saved by the normalization, once encoded"""
+    return len(original.encode(settings.DEFAULT_CHARSET)) - len(normalized.encode(settings.DEFAULT_CHARSET))
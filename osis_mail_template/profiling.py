@@ -0,0 +1,224 @@
+# ##############################################################################
+#
+#    OSIS stands for Open Student Information System. It's an application
+#    designed to manage the core business of higher education institutions,
+#    such as universities, faculties, institutes and professional schools.
+#    The core business involves the administration of students, teachers,
+#    courses, programs and so on.
+#
+#    Copyright (C) 2015-2021 Université catholique de Louvain (http://www.uclouvain.be)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    A copy of this license - GNU General Public License - is available
+#    at the root of the source code of this program.  If not,
+#    see http://www.gnu.org/licenses/.
+#
+# ##############################################################################
+import statistics
+import time
+import tracemalloc
+from collections import OrderedDict
+from html.parser import HTMLParser
+from typing import Callable, Dict, Iterable, List, Tuple
+
+from django.conf import settings
+
+from osis_mail_template.rendering import (
+    CompiledMailTemplate,
+    build_message,
+    engine,
+    is_escaping_enabled,
+    language_activated,
+    render_wrapper,
+    transform_html_to_text,
+)
+
+__all__ = [
+    'PHASES',
+    'MarkupStats',
+    'PhaseProfile',
+    'find_outliers',
+    'markup_stats',
+    'profile_render',
+]
+
+PHASES = ('format_map', 'wrapper', 'html2text', 'mime')
+
+# Markers left by office suites when pasting content (e.g. CKEditor's pastefromword)
+WORD_MARKERS = ('mso-', 'class="Mso', '<o:p>', 'urn:schemas-microsoft-com')
+
+
+class MarkupStats:
+    """Size and markup complexity of an HTML body"""
+    __slots__ = ('size', 'tags', 'max_depth', 'styles', 'word_markers')
+
+    def __init__(self, size: int, tags: int, max_depth: int, styles: int, word_markers: int) -> None:
+        self.size = size
+        self.tags = tags
+        self.max_depth = max_depth
+        self.styles = styles
+        self.word_markers = word_markers
+
+    def as_dict(self) -> Dict[str, int]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class _MarkupCounter(HTMLParser):
+    # Elements that never have a closing tag, and thus no depth
+    VOID_ELEMENTS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'source', 'wbr'}
+
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=False)
+        self.tags = self.depth = self.max_depth = self.styles = 0
+
+    def handle_starttag(self, tag, attrs):
+        self.tags += 1
+        self.styles += sum(1 for name, _ in attrs if name == 'style')
+        if tag not in self.VOID_ELEMENTS:
+            self.depth += 1
+            self.max_depth = max(self.max_depth, self.depth)
+
+    def handle_startendtag(self, tag, attrs):
+        self.tags += 1
+        self.styles += sum(1 for name, _ in attrs if name == 'style')
+
+    def handle_endtag(self, tag):
+        if tag not in self.VOID_ELEMENTS:
+            self.depth = max(self.depth - 1, 0)
+
+
+def markup_stats(html: str) -> MarkupStats:
+    """Measure the size (in encoded bytes) and the markup complexity of an HTML body"""
+    counter = _MarkupCounter()
+    counter.feed(html)
+    counter.close()
+    return MarkupStats(
+        size=len(html.encode(settings.DEFAULT_CHARSET)),
+        tags=counter.tags,
+        max_depth=counter.max_depth,
+        styles=counter.styles,
+        word_markers=sum(html.count(marker) for marker in WORD_MARKERS),
+    )
+
+
+def find_outliers(bodies: Dict[str, str], factor: float = 4) -> Dict[str, List[str]]:
+    """
+    Flag the bodies whose size or markup complexity is out of line with the others
+
+    :param bodies: A dict of HTML bodies, keyed by a label (e.g. "identifier (language)")
+    :param factor: How many times the median of all bodies a measure must exceed to be flagged
+    :return: a dict of the reasons why each flagged body is out of line, keyed by its label
+    """
+    stats = {label: markup_stats(body).as_dict() for label, body in bodies.items()}
+    outliers = OrderedDict()
+    for measure in MarkupStats.__slots__:
+        values = [body_stats[measure] for body_stats in stats.values()]
+        if not values:
+            break
+        # A median of 0 (e.g. no inline style at all) should still flag the bodies having some
+        threshold = max(statistics.median(values), 1) * factor
+        for label, body_stats in stats.items():
+            if body_stats[measure] > threshold:
+                outliers.setdefault(label, []).append('{} {} > {:g}'.format(measure, body_stats[measure], threshold))
+    return outliers
+
+
+class PhaseProfile:
+    """Timings and allocations of a rendering phase over several renders"""
+    __slots__ = ('name', 'timings', 'peak_bytes')
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.timings = []
+        self.peak_bytes = 0
+
+    @property
+    def total(self) -> float:
+        return sum(self.timings)
+
+    @property
+    def mean(self) -> float:
+        return statistics.mean(self.timings) if self.timings else 0
+
+    @property
+    def best(self) -> float:
+        return min(self.timings) if self.timings else 0
+
+
+def _render_phases(compiled: CompiledMailTemplate, tokens: Dict[str, str], recipients: List[str],
+                   escape: bool) -> Iterable[Tuple[str, Callable[[], None]]]:
+    """Split engine.render_message into its phases, each one using the result of the previous ones"""
+    rendered = {}
+
+    def format_map():
+        with language_activated(compiled.language):
+            rendered['subject'] = compiled.subject.render(tokens)
+            rendered['body'] = compiled.body.render(tokens, escape=escape)
+
+    def wrapper():
+        with language_activated(compiled.language):
+            rendered['html'] = render_wrapper(
+                rendered['subject'], compiled.language, recipients, None, rendered['body'],
+            )
+
+    def html2text():
+        rendered['text'] = transform_html_to_text(rendered['body'])
+
+    def mime():
+        build_message(rendered['subject'], None, recipients, rendered['text'], rendered['html']).as_bytes()
+
+    return zip(PHASES, (format_map, wrapper, html2text, mime))
+
+
+def profile_render(template, tokens: Dict[str, str], iterations: int = 10,
+                   recipients: List[str] = None, escape: bool = None) -> List[PhaseProfile]:
+    """
+    Render a mail template several times, measuring the time and the peak memory allocated by each phase
+
+    Timings are taken without tracing memory (which slows down Python code), the allocations of each phase are then
+    measured by a last, traced, render. Memory tracing already started elsewhere (e.g. with PYTHONTRACEMALLOC) is
+    left running, the phases being measured from the current usage (which needs Python 3.9+ to reset the peak).
+
+    :param template: A MailTemplate instance or a CompiledMailTemplate
+    :param tokens: The token values to render with
+    :param iterations: The number of timed renders
+    :param recipients: The recipients of the rendered message
+    :param escape: Whether token values are escaped in the HTML body (defaults to is_escaping_enabled())
+    """
+    compiled = template if isinstance(template, CompiledMailTemplate) else engine.compile(template)
+    recipients = recipients or ['recipient@example.com']
+    if escape is None:
+        escape = is_escaping_enabled()
+    profiles = OrderedDict((name, PhaseProfile(name)) for name in PHASES)
+
+    for _ in range(iterations):
+        for name, phase in _render_phases(compiled, tokens, recipients, escape):
+            start = time.perf_counter()
+            phase()
+            profiles[name].timings.append(time.perf_counter() - start)
+
+    tracing = tracemalloc.is_tracing()
+    if tracing and not hasattr(tracemalloc, 'reset_peak'):
+        return list(profiles.values())
+    for name, phase in _render_phases(compiled, tokens, recipients, escape):
+        if tracing:
+            tracemalloc.reset_peak()
+        else:
+            tracemalloc.start()
+        try:
+            current = tracemalloc.get_traced_memory()[0]
+            phase()
+            profiles[name].peak_bytes = tracemalloc.get_traced_memory()[1] - current
+        finally:
+            if not tracing:
+                tracemalloc.stop()
+    return list(profiles.values())
@@ -23,9 +23,13 @@
 #    see http://www.gnu.org/licenses/.
 #
 # ##############################################################################
+import hashlib
 from collections import defaultdict, OrderedDict
+from datetime import datetime, timezone
 from typing import List, Dict, Tuple
 
+from django.utils import translation
+
 from osis_mail_template.exceptions import (
     DuplicateMailTemplateIdentifier,
     UnknownMailTemplateIdentifier,
@@ -53,16 +57,34 @@ class MailTemplateRegistry:
 
     def __init__(self) -> None:
         self.templates = {}
+        # Changed on each register/unregister, to cache what is derived from the registered templates
+        self.generation = 0
+        self.updated_at = datetime.now(timezone.utc)
+        self._snapshots = {}
+
+    def _changed(self) -> None:
+        self.generation += 1
+        self.updated_at = datetime.now(timezone.utc)
+        self._snapshots = {}
+
+    def _snapshot(self, name: str, build):
+        # Built once per generation, the registry not changing after the applications are ready
+        snapshots = self._snapshots
+        if name not in snapshots:
+            snapshots[name] = build()
+        return snapshots[name]
 
     def register(self, identifier: str, description: str, tokens: List[Token], tag: str = '') -> None:
         if identifier in self.templates:
             raise DuplicateMailTemplateIdentifier(identifier)
         self.templates[identifier] = (description, tokens, tag)
+        self._changed()
 
     def unregister(self, identifier: str) -> None:
         if identifier not in self.templates:
             raise UnknownMailTemplateIdentifier(identifier)
         del self.templates[identifier]
+        self._changed()
 
     def get_mail_templates(self) -> Dict[str, Tuple[str, List[Token]]]:
         return self.templates
@@ -76,12 +98,45 @@ class MailTemplateRegistry:
         return self.get_mail_template(identifier)[1]
 
     def get_example_values(self, identifier: str) -> Dict[str, str]:
-        return {t.name: t.example for t in self.get_tokens(identifier)}
+        """The example value of each token of a template (built once, a copy being returned)"""
+        example_values = self._snapshot('example_values', self._build_example_values)
+        if identifier not in example_values:
+            raise UnknownMailTemplateIdentifier(identifier)
+        return dict(example_values[identifier])
+
+    def _build_example_values(self) -> Dict[str, Dict[str, str]]:
+        return {
+            identifier: {token.name: token.example for token in tokens}
+            for identifier, (description, tokens, tag) in self.templates.items()
+        }
 
     def get_description(self, identifier: str) -> str:
         return self.get_mail_template(identifier)[0]
 
+    def get_content_hash(self) -> str:
+        """
+        A hash of the registered templates (identifiers, untranslated descriptions, tags and tokens), which is the
+        same for all the processes running the same code
+        """
+        return self._snapshot('content_hash', self._compute_content_hash)
+
+    def _compute_content_hash(self) -> str:
+        content = hashlib.sha1()
+        with translation.override(None):
+            for identifier, (description, tokens, tag) in sorted(self.templates.items()):
+                content.update(repr((
+                    identifier,
+                    str(description),
+                    str(tag),
+                    [(token.name, str(token.description), str(token.example)) for token in tokens],
+                )).encode())
+        return content.hexdigest()
+
     def get_list_by_tag(self) -> Dict[str, Dict[str, str]]:
+        """The descriptions of the templates by identifier, grouped by tag (built once, must not be modified)"""
+        return self._snapshot('list_by_tag', self._build_list_by_tag)
+
+    def _build_list_by_tag(self) -> Dict[str, Dict[str, str]]:
         ret = OrderedDict()
         for identifier, template in sorted(self.templates.items(), key=lambda i: i[1][2]):
             tag = template[2]
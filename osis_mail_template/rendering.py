@@ -0,0 +1,747 @@
+# ##############################################################################
+#
+#    OSIS stands for Open Student Information System. It's an application
+#    designed to manage the core business of higher education institutions,
+#    such as universities, faculties, institutes and professional schools.
+#    The core business involves the administration of students, teachers,
+#    courses, programs and so on.
+#
+#    Copyright (C) 2015-2021 Université catholique de Louvain (http://www.uclouvain.be)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    A copy of this license - GNU General Public License - is available
+#    at the root of the source code of this program.  If not,
+#    see http://www.gnu.org/licenses/.
+#
+# ##############################################################################
+import base64
+import html
+import html.entities
+import logging
+import re
+import string
+import time
+import uuid
+from contextlib import contextmanager
+from email.message import EmailMessage
+from operator import itemgetter
+from typing import BinaryIO, Callable, Dict, Iterable, Iterator, List, Mapping, Optional, Sequence, Set, Tuple
+
+import html2text
+from django.conf import settings
+from django.template.loader import render_to_string
+from django.utils import translation
+from django.utils.functional import Promise, cached_property
+from django.utils.safestring import SafeData
+
+from osis_mail_template.attachments import Attachment, attach, to_attachments
+from osis_mail_template.versioning import compute_content_hash
+
+__all__ = [
+    'CompiledFormat',
+    'CompiledMailTemplate',
+    'LazyTokenResolver',
+    'MailRenderEngine',
+    'MissingTokenDict',
+    'RenderedMail',
+    'build_message',
+    'compute_content_hash',
+    'engine',
+    'escape_token_value',
+    'get_render_budgets',
+    'is_escaping_enabled',
+    'iter_html_chunks_to_text',
+    'strip_html_to_text',
+    'transform_html_chunks_to_text',
+    'transform_html_to_text',
+]
+
+_FORMATTER = string.Formatter()
+_FIRST_FIELD_PART = re.compile(r'[^.[]*')
+_HTML_SPECIAL_CHARACTERS = re.compile('[&<>"\']')
+
+WRAPPER_TEMPLATE = 'osis_mail_template/base_email.html'
+# The maximum number of characters of markup fed at once to html2text when converting chunks
+FEED_CHARACTERS = 64 * 1024
+CONTENT_PLACEHOLDER = '<!-- osis_mail_template content -->'
+
+_BLOCK_END = re.compile(r'<br\s*/?>|</(?:p|div|h[1-6]|li|tr|table|ul|ol|blockquote|pre)\s*>', re.IGNORECASE)
+_CELL_END = re.compile(r'</t[dh]\s*>', re.IGNORECASE)
+_TAG = re.compile(r'<!--.*?-->|<[^>]*>', re.DOTALL)
+_BLANK_LINES = re.compile(r'\n{3,}')
+
+logger = logging.getLogger(__name__)
+
+# Mail template versions whose plain text took longer than its budget, converted with strip_html_to_text() since
+_slow_plain_text = set()
+
+
+class MissingTokenDict(dict):
+    def __missing__(self, key):
+        return "TOKEN_{}_UNDEFINED".format(key)
+
+
+def transform_html_to_text(html: str) -> str:
+    """Transforms html markup to plain text for email sending
+
+    :param html: THe html markup string to transform
+    :return: The plain text formatted string
+    """
+    return _html_to_text_converter().handle(html)
+
+
+def transform_html_chunks_to_text(chunks: Iterable[str]) -> str:
+    """Same as transform_html_to_text(), for html markup given by chunks instead of a single string"""
+    return ''.join(iter_html_chunks_to_text(chunks))
+
+
+def _markup_pieces(chunks: Iterable[str]) -> Iterator[str]:
+    # Markup is cut right before a tag opening (every FEED_CHARACTERS at most), so that runs of text between tags
+    # are handled at once, as they would be with the whole document
+    pending = ''
+    for chunk in chunks:
+        chunk = pending + chunk if pending else chunk
+        start = 0
+        while len(chunk) - start > FEED_CHARACTERS:
+            position = chunk.find('<', start + FEED_CHARACTERS)
+            if position == -1:
+                break
+            yield chunk[start:position]
+            start = position
+        position = chunk.rfind('<', start)
+        if position > start:
+            yield chunk[start:position]
+            start = position
+        pending = chunk[start:]
+    yield pending
+
+
+def iter_html_chunks_to_text(chunks: Iterable[str]) -> Iterator[str]:
+    """
+    Same as transform_html_chunks_to_text(), the plain text being given by pieces as the markup is converted, so
+    that neither the whole markup nor the whole text are held in memory
+    """
+    h = _html_to_text_converter()
+    nbsp = html.entities.html5['nbsp;'] if h.unicode_snob else ' '
+    # Same as HTML2Text.handle(), the converted text being taken as it is produced
+    h.start = True
+    text = ''
+    for piece in _markup_pieces(chunks):
+        h.feed(piece)
+        # The converter may still take back the last piece of text it produced
+        text += ''.join(h.outtextlist[:-1]).replace('&nbsp_place_holder;', nbsp)
+        del h.outtextlist[:-1]
+        # Wrapping is done by paragraph (line), its only state being reset by a non-empty line: the text is wrapped
+        # up to the last line break followed by text, the same way as it would be as a whole
+        position = text.rstrip('\n').rfind('\n')
+        if position != -1:
+            yield h.optwrap(text[:position])
+            text = text[position + 1:]
+    h.feed('')
+    yield h.optwrap(text + h.finish())
+
+
+def strip_html_to_text(html_content: str) -> str:
+    """
+    A cheap transform of html markup to plain text, only keeping line breaks and the text, for the bodies that
+    html2text handles too slowly (e.g. with thousands of nested table cells)
+    """
+    text = _CELL_END.sub(' ', _BLOCK_END.sub('\n', html_content))
+    text = html.unescape(_TAG.sub('', text))
+    lines = (' '.join(line.split()) for line in text.splitlines())
+    return _BLANK_LINES.sub('\n\n', '\n'.join(lines)).strip() + '\n'
+
+
+def _html_to_text_converter() -> html2text.HTML2Text:
+    # A converter keeps the state of the document it handled (links, lists, etc.), so it can't be reused
+    h = html2text.HTML2Text()
+    h.links_each_paragraph = True
+    h.body_width = 80
+    h.inline_links = False
+    h.wrap_links = False
+    h.wrap_list_items = True
+    h.use_automatic_links = True
+    return h
+
+
+@contextmanager
+def language_activated(language: str):
+    """Like translation.override(), without deactivating and reactivating if the language is already active"""
+    if translation.get_language() == language:
+        yield
+    else:
+        with translation.override(language):
+            yield
+
+
+class LazyTokenResolver:
+    """
+    Resolves lazy translations used as token values, each lazy object being resolved once per language
+
+    Meant to be used for a batch of mails: resolved values (and the lazy objects) are kept as long as the resolver.
+    """
+
+    def __init__(self) -> None:
+        self._resolved = {}
+
+    def resolve(self, tokens: Dict[str, str], language: str) -> Dict[str, str]:
+        """Get the tokens with their lazy values resolved in the given language"""
+        resolved_tokens = None
+        for name, value in tokens.items():
+            if not isinstance(value, Promise):
+                continue
+            if resolved_tokens is None:
+                resolved_tokens = dict(tokens)
+            # The lazy object is kept along its resolved value, so that its id can't be reused while cached
+            key = (language, id(value))
+            if key not in self._resolved:
+                with language_activated(language):
+                    self._resolved[key] = (value, str(value))
+            resolved_tokens[name] = self._resolved[key][1]
+        return tokens if resolved_tokens is None else resolved_tokens
+
+
+def get_render_budgets() -> Dict[str, float]:
+    """
+    The time budgets (in seconds) of the rendering phases (format_map, wrapper and html2text), from the
+    OSIS_MAIL_TEMPLATE_RENDER_BUDGETS setting, a slow phase being logged
+    """
+    return getattr(settings, 'OSIS_MAIL_TEMPLATE_RENDER_BUDGETS', None) or {}
+
+
+def is_plain_text_fallback_enabled() -> bool:
+    """
+    Whether the plain text of a mail template exceeding its html2text budget is converted with strip_html_to_text()
+    from then on, from the OSIS_MAIL_TEMPLATE_PLAIN_TEXT_FALLBACK setting
+    """
+    return getattr(settings, 'OSIS_MAIL_TEMPLATE_PLAIN_TEXT_FALLBACK', False)
+
+
+def is_escaping_enabled() -> bool:
+    """Whether token values are escaped in HTML bodies by default, from the OSIS_MAIL_TEMPLATE_ESCAPE_TOKENS setting"""
+    return getattr(settings, 'OSIS_MAIL_TEMPLATE_ESCAPE_TOKENS', False)
+
+
+def escape_token_value(value, field_format: str = '{0}') -> str:
+    """
+    Format a token value for an HTML body, escaping it unless it is marked as safe
+
+    Values marked as safe (e.g. with mark_safe) are kept as-is, and the formatted values without any special
+    character (most of them) are returned without being copied.
+    """
+    if field_format == '{0}':
+        if isinstance(value, SafeData):
+            return value
+        if hasattr(value, '__html__'):
+            return value.__html__()
+    text = field_format.format(value)
+    if _HTML_SPECIAL_CHARACTERS.search(text) is None:
+        return text
+    return html.escape(text)
+
+
+class CompiledFormat:
+    """
+    A format string parsed once, rendering exactly as `source.format_map(MissingTokenDict(**tokens))`
+
+    Token names are replaced by positional indexes, so that rendering only needs the values in the order of
+    `names` and no copy of the tokens dictionary. Format strings that can't be compiled (nested format specs,
+    positional fields, malformed strings) are rendered with format_map as-is.
+
+    When escaping, the literal segments (the HTML of the template) are kept as-is, only the formatted token values
+    being escaped (see escape_token_value). Format strings that can't be compiled only get their string values
+    escaped.
+    """
+    __slots__ = ('source', 'names', 'positional', 'segments', 'plain_fields')
+
+    def __init__(self, source: str) -> None:
+        self.source = source
+        self.names = None
+        self.positional = None
+        self.segments = None
+        self.plain_fields = False
+        try:
+            parts = list(_FORMATTER.parse(source))
+        except ValueError:
+            return
+        names = []
+        pieces = []
+        segments = []
+        for literal, field_name, format_spec, conversion in parts:
+            pieces.append(literal.replace('{', '{{').replace('}', '}}'))
+            if field_name is None:
+                segments.append((literal, None, None))
+                continue
+            name = _FIRST_FIELD_PART.match(field_name).group()
+            if not name or name.isdigit() or '{' in format_spec:
+                return
+            if name not in names:
+                names.append(name)
+            field = field_name[len(name):]
+            if conversion:
+                field += '!' + conversion
+            if format_spec:
+                field += ':' + format_spec
+            pieces.append('{' + str(names.index(name)) + field + '}')
+            segments.append((literal, names.index(name), '{0' + field + '}'))
+        self.names = tuple(names)
+        self.positional = ''.join(pieces)
+        self.segments = tuple(segments)
+        self.plain_fields = self._has_plain_fields(self.segments)
+
+    @staticmethod
+    def _has_plain_fields(segments: tuple) -> bool:
+        # Without attributes, conversions or format specs, escaping the values is the same as escaping the fields
+        return all(field_format in (None, '{0}') for _literal, _index, field_format in segments)
+
+    def dump(self) -> tuple:
+        """A compact, picklable form of the compiled format string"""
+        return self.source, self.names, self.positional, self.segments
+
+    @classmethod
+    def load(cls, data: tuple) -> 'CompiledFormat':
+        compiled = cls.__new__(cls)
+        compiled.source, compiled.names, compiled.positional, compiled.segments = data
+        compiled.plain_fields = compiled.segments is not None and cls._has_plain_fields(compiled.segments)
+        return compiled
+
+    def bind(self, token_names: Sequence[str], escape: bool = False) -> Callable[[Sequence], str]:
+        """
+        Get a function rendering from rows of values given in the order of token_names, without building dicts
+
+        :param token_names: The names of the tokens, in the order of the values of the rows
+        :param escape: Whether token values are escaped for HTML
+        """
+        if self.names is None:
+            return lambda row: self.render(dict(zip(token_names, row)), escape=escape)
+        if tuple(token_names) == self.names:
+            if escape:
+                return self._render_escaped
+            return lambda row: self.positional.format(*row)
+        positions = {name: position for position, name in enumerate(token_names)}
+        indexes = []
+        missing = []
+        for name in self.names:
+            if name in positions:
+                indexes.append(positions[name])
+            else:
+                # Missing tokens are taken from values appended to each row
+                indexes.append(len(token_names) + len(missing))
+                missing.append("TOKEN_{}_UNDEFINED".format(name))
+        missing = tuple(missing)
+        positional = self.positional
+
+        if escape:
+            # Values are escaped from the rows in the order of the fields
+            render_escaped = self._render_escaped
+            if missing:
+                return lambda row: render_escaped([(tuple(row) + missing)[index] for index in indexes])
+            return lambda row: render_escaped([row[index] for index in indexes])
+        if not indexes:
+            rendered = positional.format()
+            return lambda row: rendered
+        if len(indexes) == 1:
+            index = indexes[0]
+            if missing:
+                rendered = positional.format(missing[0])
+                return lambda row: rendered
+            return lambda row: positional.format(row[index])
+        getter = itemgetter(*indexes)
+        if missing:
+            return lambda row: positional.format(*getter(tuple(row) + missing))
+        return lambda row: positional.format(*getter(row))
+
+    def get_token_names(self) -> Set[str]:
+        """The names of the tokens used by the format string"""
+        if self.names is not None:
+            return set(self.names)
+        try:
+            fields = [field for _literal, field, _spec, _conversion in _FORMATTER.parse(self.source) if field]
+        except ValueError:
+            return set()
+        return {_FIRST_FIELD_PART.match(field).group() for field in fields}
+
+    def _values(self, tokens: Mapping) -> list:
+        return [tokens[name] if name in tokens else "TOKEN_{}_UNDEFINED".format(name) for name in self.names]
+
+    def render(self, tokens: Mapping, escape: bool = False) -> str:
+        if self.names is None:
+            if escape:
+                tokens = {
+                    name: escape_token_value(value) if isinstance(value, str) else value
+                    for name, value in tokens.items()
+                }
+            return self.source.format_map(MissingTokenDict(**tokens))
+        if escape:
+            return self._render_escaped(self._values(tokens))
+        return self.positional.format(*self._values(tokens))
+
+    def _render_escaped(self, values: Sequence) -> str:
+        if self.plain_fields:
+            return self.positional.format(*[escape_token_value(value) for value in values])
+        pieces = []
+        for literal, index, field_format in self.segments:
+            pieces.append(literal)
+            if index is not None:
+                pieces.append(escape_token_value(values[index], field_format))
+        return ''.join(pieces)
+
+    def iter_render(self, tokens: Mapping, escape: bool = False) -> Iterator[str]:
+        """Render piece by piece (literal text and token values), without building the whole string"""
+        if self.names is None:
+            yield self.render(tokens, escape=escape)
+            return
+        values = self._values(tokens)
+        for literal, index, field_format in self.segments:
+            if literal:
+                yield literal
+            if index is None:
+                continue
+            if escape:
+                yield escape_token_value(values[index], field_format)
+            else:
+                yield field_format.format(values[index])
+
+
+class CompiledMailTemplate:
+    """
+    The compiled subject and body of a version of a mail template for a language, immutable once built
+
+    A version number alone doesn't identify a content (a version is reused when the transaction saving it is rolled
+    back), compiled templates are thus checked against the content hash as well.
+    """
+    __slots__ = ('identifier', 'language', 'version', 'content_hash', 'subject', 'body')
+
+    def __init__(self, identifier: str, language: str, version: int, subject: str, body: str) -> None:
+        self.identifier = identifier
+        self.language = language
+        self.version = version
+        self.content_hash = compute_content_hash(subject, body)
+        self.subject = CompiledFormat(subject)
+        self.body = CompiledFormat(body)
+
+    def dump(self) -> tuple:
+        """A compact, picklable form of the compiled mail template"""
+        return (
+            self.identifier, self.language, self.version, self.content_hash, self.subject.dump(), self.body.dump(),
+        )
+
+    @classmethod
+    def load(cls, data: tuple) -> 'CompiledMailTemplate':
+        compiled = cls.__new__(cls)
+        compiled.identifier, compiled.language, compiled.version, compiled.content_hash, subject, body = data
+        compiled.subject = CompiledFormat.load(subject)
+        compiled.body = CompiledFormat.load(body)
+        return compiled
+
+    def matches(self, version: int, content_hash: str) -> bool:
+        """Whether this is the compiled form of the given version and content of the mail template"""
+        return self.version == version and self.content_hash == content_hash
+
+    def is_compiled_from(self, template) -> bool:
+        return (
+            self.version == template.version
+            and self.subject.source == template.subject
+            and self.body.source == template.body
+        )
+
+
+def build_message(subject: str, sender: Optional[str], recipients: List[str], plain_text: str, html_content: str,
+                  attachments: Iterable = ()) -> EmailMessage:
+    """Build the message of a rendered mail, from the default sender when none is given"""
+    msg = EmailMessage()
+    msg.set_charset(settings.DEFAULT_CHARSET)
+    msg['Subject'] = subject
+    msg['From'] = sender or settings.DEFAULT_FROM_EMAIL
+    msg['To'] = recipients
+    msg.set_content(plain_text)
+    msg.add_alternative(html_content, subtype="html")
+    attach(msg, attachments)
+    return msg
+
+
+class RenderedMail:
+    """
+    A mail template rendered with token values, each part being computed (in the mail template language) only when
+    first accessed, then kept: callers only needing the subject and HTML body never pay for html2text or MIME.
+
+    The time taken by each phase is kept in `timings`, a phase exceeding its budget (see get_render_budgets())
+    being logged. Token values must not be modified once given.
+    """
+
+    def __init__(self, compiled: CompiledMailTemplate, tokens: Dict[str, str], recipients: List[str] = None,
+                 sender: str = None, escape: bool = False, attachments: List[Attachment] = None) -> None:
+        self.compiled = compiled
+        self.language = compiled.language
+        self.tokens = tokens
+        self.recipients = recipients or []
+        self.sender = sender
+        self.escape = escape
+        self.attachments = attachments or []
+        self.timings = {}  # type: Dict[str, float]
+        self._message = None
+
+    def _timed(self, phase: str, render: Callable[[], str]) -> str:
+        start = time.perf_counter()
+        rendered = render()
+        elapsed = time.perf_counter() - start
+        self.timings[phase] = self.timings.get(phase, 0) + elapsed
+        budget = get_render_budgets().get(phase)
+        if budget is not None and elapsed > budget:
+            self._exceeded(phase, elapsed, budget)
+        return rendered
+
+    def _exceeded(self, phase: str, elapsed: float, budget: float) -> None:
+        compiled = self.compiled
+        logger.warning(
+            "Slow render of mail template %s (%s): %s took %.3fs (budget %.3fs), body of %d characters, timings: %s",
+            compiled.identifier, self.language, phase, elapsed, budget, len(compiled.body.source),
+            ', '.join('{} {:.3f}s'.format(name, timing) for name, timing in self.timings.items()),
+        )
+        if phase == 'html2text' and is_plain_text_fallback_enabled():
+            _slow_plain_text.add((compiled.identifier, compiled.language, compiled.version))
+
+    @cached_property
+    def subject(self) -> str:
+        with language_activated(self.language):
+            return self._timed('format_map', lambda: self.compiled.subject.render(self.tokens))
+
+    @cached_property
+    def html_body(self) -> str:
+        """The HTML body, as written in the mail template"""
+        with language_activated(self.language):
+            return self._timed('format_map', lambda: self.compiled.body.render(self.tokens, escape=self.escape))
+
+    @cached_property
+    def wrapped_html(self) -> str:
+        """The HTML body within the HTML base template, as sent"""
+        subject, html_body = self.subject, self.html_body
+        with language_activated(self.language):
+            return self._timed('wrapper', lambda: render_wrapper(
+                subject, self.language, self.recipients, self.sender, html_body,
+            ))
+
+    @cached_property
+    def plain_text(self) -> str:
+        html_body = self.html_body
+        compiled = self.compiled
+        key = (compiled.identifier, compiled.language, compiled.version)
+        if key in _slow_plain_text and is_plain_text_fallback_enabled():
+            return self._timed('html2text', lambda: strip_html_to_text(html_body))
+        return self._timed('html2text', lambda: transform_html_to_text(html_body))
+
+    def as_message(self) -> EmailMessage:
+        """The message ready for sending, built once (the same instance is returned each time)"""
+        if self._message is None:
+            self._message = build_message(
+                self.subject, self.sender, self.recipients, self.plain_text, self.wrapped_html, self.attachments,
+            )
+        return self._message
+
+    def serialize(self) -> bytes:
+        """The mail as compact bytes, to be handed to another process (see osis_mail_template.serialization)"""
+        from osis_mail_template.serialization import dump_mail
+
+        return dump_mail(self)
+
+
+class MailRenderEngine:
+    """
+    Renders mail templates into messages, an engine can be shared between threads.
+
+    * compiled templates (the last compiled version of each mail template) are kept in a plain dictionary read
+      without locking: two threads compiling the same template at the same time only do the work twice, the last
+      one being kept
+    * translation.override() only activates the language for the current thread
+    * html2text converters hold the state of the document being converted, so each conversion uses its own
+    """
+
+    def __init__(self) -> None:
+        self._compiled = {}
+
+    def compile(self, template) -> CompiledMailTemplate:
+        """Get the compiled version of a MailTemplate instance, compiling it if it changed since last time"""
+        key = (template.identifier, template.language)
+        compiled = self._compiled.get(key)
+        if compiled is None or not compiled.is_compiled_from(template):
+            compiled = CompiledMailTemplate(
+                template.identifier,
+                template.language,
+                template.version,
+                template.subject,
+                template.body,
+            )
+            self._compiled[key] = compiled
+        return compiled
+
+    def add(self, compiled: CompiledMailTemplate) -> CompiledMailTemplate:
+        """Keep a template compiled elsewhere (e.g. loaded from a shared cache), unless a newer version is known"""
+        key = (compiled.identifier, compiled.language)
+        current = self._compiled.get(key)
+        if current is not None and current.matches(compiled.version, compiled.content_hash):
+            return current
+        if current is None or current.version <= compiled.version:
+            self._compiled[key] = compiled
+        return compiled
+
+    def get_compiled(self, identifier: str, language: str, version: int = None,
+                     content_hash: str = None) -> Optional[CompiledMailTemplate]:
+        """
+        Get the last compiled version of a mail template, if any (and if it matches the given version and content
+        hash, when given)
+        """
+        compiled = self._compiled.get((identifier, language))
+        if compiled is not None and version is not None and not compiled.matches(version, content_hash):
+            return None
+        return compiled
+
+    def clear(self) -> None:
+        self._compiled = {}
+
+    def render(self, template, tokens: Dict[str, str], recipients: List[str] = None, sender: str = None,
+               resolver: LazyTokenResolver = None, escape: bool = None, attachments: Iterable = None) -> RenderedMail:
+        """
+        Render a MailTemplate instance or a CompiledMailTemplate, lazily (see RenderedMail)
+
+        Token values are escaped in the HTML body if escape is True (defaults to is_escaping_enabled()), the subject
+        and the plain text body getting the unescaped values. Attachments are Attachment instances (encoded once for
+        all the messages they are attached to) or anything to_attachments() accepts.
+        """
+        compiled = template if isinstance(template, CompiledMailTemplate) else self.compile(template)
+        if resolver is not None:
+            tokens = resolver.resolve(tokens, compiled.language)
+        if escape is None:
+            escape = is_escaping_enabled()
+        attachments = to_attachments(attachments or [])
+        return RenderedMail(compiled, tokens, recipients, sender, escape=escape, attachments=attachments)
+
+    def render_message(self, template, tokens: Dict[str, str], recipients: List[str], sender: str = None,
+                       resolver: LazyTokenResolver = None, escape: bool = None,
+                       attachments: Iterable = None) -> EmailMessage:
+        """Render a message from a MailTemplate instance or a CompiledMailTemplate (see render())"""
+        return self.render(
+            template, tokens, recipients, sender, resolver=resolver, escape=escape, attachments=attachments,
+        ).as_message()
+
+    def render_rows(self, template, token_names: Sequence[str], rows: Iterable[Sequence],
+                    escape: bool = None) -> Iterator[Tuple[str, str, str]]:
+        """
+        Render the subject, HTML body and plain text body for each row of token values, lazily
+
+        :param template: A MailTemplate instance or a CompiledMailTemplate
+        :param token_names: The names of the tokens, in the order of the values of the rows
+        :param rows: An iterable of sequences of token values
+        :param escape: Whether token values are escaped in the HTML body (defaults to is_escaping_enabled())
+        """
+        compiled = template if isinstance(template, CompiledMailTemplate) else self.compile(template)
+        render_subject = compiled.subject.bind(token_names)
+        render_body = compiled.body.bind(token_names, escape=is_escaping_enabled() if escape is None else escape)
+        for row in rows:
+            # Activated for each row, as the caller code runs in between
+            with language_activated(compiled.language):
+                body = render_body(row)
+                rendered = (render_subject(row), body, transform_html_to_text(body))
+            yield rendered
+
+    def render_to_stream(self, template, tokens: Dict[str, str], recipients: List[str], sink: BinaryIO,
+                         sender: str = None, resolver: LazyTokenResolver = None, escape: bool = None) -> None:
+        """
+        Write a message to a binary sink (e.g. a file), as it is produced
+
+        The written message has the same headers and parts as the one returned by render_message(), both parts
+        being base64-encoded. The HTML body is never built as a whole: it is rendered piece by piece, once for
+        converting it to plain text and once for writing the HTML part, so that large token values are not copied.
+        """
+        compiled = template if isinstance(template, CompiledMailTemplate) else self.compile(template)
+        language = compiled.language
+        if resolver is not None:
+            tokens = resolver.resolve(tokens, language)
+        if escape is None:
+            escape = is_escaping_enabled()
+        charset = settings.DEFAULT_CHARSET
+        boundary = '==============={}=='.format(uuid.uuid4().hex)
+
+        with language_activated(language):
+            subject = compiled.subject.render(tokens)
+            headers = EmailMessage()
+            headers['Subject'] = subject
+            headers['From'] = sender or settings.DEFAULT_FROM_EMAIL
+            headers['To'] = recipients
+            headers['MIME-Version'] = '1.0'
+            headers['Content-Type'] = 'multipart/alternative; boundary="{}"'.format(boundary)
+            for name, value in headers.items():
+                sink.write(headers.policy.fold_binary(name, value))
+            sink.write(b'\n')
+
+            part_headers = '--{boundary}\nContent-Type: text/{subtype}; charset="{charset}"\n' \
+                           'Content-Transfer-Encoding: base64\n\n'
+            sink.write(part_headers.format(boundary=boundary, subtype='plain', charset=charset).encode())
+            with _Base64Writer(sink, charset) as writer:
+                for text in iter_html_chunks_to_text(compiled.body.iter_render(tokens, escape=escape)):
+                    writer.write(text)
+
+            sink.write(part_headers.format(boundary=boundary, subtype='html', charset=charset).encode())
+            wrapper = render_wrapper(subject, language, recipients, sender, CONTENT_PLACEHOLDER)
+            with _Base64Writer(sink, charset) as writer:
+                if wrapper.count(CONTENT_PLACEHOLDER) == 1:
+                    prefix, suffix = wrapper.split(CONTENT_PLACEHOLDER)
+                    writer.write(prefix)
+                    for piece in compiled.body.iter_render(tokens, escape=escape):
+                        writer.write(piece)
+                    writer.write(suffix)
+                else:
+                    # The base template has been overridden and alters the content, it has to be rendered as a whole
+                    content = compiled.body.render(tokens, escape=escape)
+                    writer.write(render_wrapper(subject, language, recipients, sender, content))
+            sink.write('--{}--\n'.format(boundary).encode())
+
+
+def render_wrapper(subject: str, language: str, recipients: List[str], sender: str, content: str) -> str:
+    """Render the HTML base template around the HTML content of a message"""
+    return render_to_string(WRAPPER_TEMPLATE, {
+        'subject': subject,
+        'language': language,
+        'recipients': recipients,
+        'sender': sender,
+        'content': content,
+    })
+
+
+class _Base64Writer:
+    """Encode text to base64 lines of 76 characters as it is written, keeping only an incomplete line in memory"""
+    LINE_BYTES = 57
+    CHUNK_CHARACTERS = LINE_BYTES * 1024
+
+    def __init__(self, sink: BinaryIO, charset: str) -> None:
+        self.sink = sink
+        self.charset = charset
+        self.pending = b''
+
+    def write(self, text: str) -> None:
+        # Large pieces of text are encoded by chunks, to avoid holding a whole encoded copy of them
+        for start in range(0, len(text), self.CHUNK_CHARACTERS):
+            self.pending += text[start:start + self.CHUNK_CHARACTERS].encode(self.charset)
+            complete = len(self.pending) - len(self.pending) % self.LINE_BYTES
+            if complete:
+                self.sink.write(base64.encodebytes(self.pending[:complete]))
+                self.pending = self.pending[complete:]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.pending:
+            self.sink.write(base64.encodebytes(self.pending))
+            self.pending = b''
+
+
+engine = MailRenderEngine()
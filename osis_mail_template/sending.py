@@ -0,0 +1,559 @@
+# ##############################################################################
+#
+#    OSIS stands for Open Student Information System. It's an application
+#    designed to manage the core business of higher education institutions,
+#    such as universities, faculties, institutes and professional schools.
+#    The core business involves the administration of students, teachers,
+#    courses, programs and so on.
+#
+#    Copyright (C) 2015-2021 Université catholique de Louvain (http://www.uclouvain.be)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    A copy of this license - GNU General Public License - is available
+#    at the root of the source code of this program.  If not,
+#    see http://www.gnu.org/licenses/.
+#
+# ##############################################################################
+import smtplib
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from email.message import EmailMessage
+from itertools import groupby, islice
+from pathlib import Path
+from queue import Empty, LifoQueue
+from typing import Callable, Dict, Iterable, Iterator, List, Mapping, Optional, Tuple, Union
+
+from django.core.mail import get_connection
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.html import conditional_escape
+from django.utils.safestring import mark_safe
+
+from osis_mail_template.attachments import to_attachments
+from osis_mail_template.exceptions import (
+    EmptyMailTemplateContent,
+    PreflightError,
+    UnknownLanguage,
+    UnknownMailTemplateIdentifier,
+)
+from osis_mail_template.rendering import CompiledFormat, LazyTokenResolver, engine, language_activated
+
+__all__ = [
+    'FileConnection',
+    'MailJob',
+    'PreflightReport',
+    'generate_emails_multi',
+    'preflight',
+    'preflight_jobs',
+    'process_outbox',
+    'SendReport',
+    'SMTPConnectionPool',
+    'digest_jobs',
+    'send_emails',
+]
+
+RENDERING_ERRORS = (EmptyMailTemplateContent, UnknownLanguage, UnknownMailTemplateIdentifier)
+
+# The number of seconds the mails of an outbox batch are kept from other workers while being sent
+OUTBOX_LEASE = 10 * 60
+
+# How each merged mail is rendered in the {items} token of a digest mail template
+DIGEST_ITEM_FORMAT = '<h3>{subject}</h3>\n{body}\n'
+
+
+class MailJob:
+    """
+    A mail to render and send: the mail template identifier and language, the tokens and the recipients
+
+    Attachments can be Attachment instances, file paths, bytes or (filename, content, mimetype) tuples, the same
+    attachment (or object) given to many jobs being encoded only once.
+    """
+    __slots__ = ('identifier', 'language', 'tokens', 'recipients', 'sender', 'attachments')
+
+    def __init__(self, identifier: str, language: str, tokens: Dict[str, str], recipients: List[str],
+                 sender: str = None, attachments: List = None) -> None:
+        self.identifier = identifier
+        self.language = language
+        self.tokens = tokens
+        self.recipients = recipients
+        self.sender = sender
+        self.attachments = attachments or []
+
+    def __repr__(self):
+        return '<MailJob {}-{} to {}>'.format(self.identifier, self.language, ', '.join(self.recipients))
+
+
+class SendReport:
+    """
+    The outcome of a send run: the jobs sent, the jobs that failed (with their error) and the elapsed time
+    """
+
+    def __init__(self) -> None:
+        self.sent = []
+        self.failed = []
+        self.elapsed = 0.0
+
+    @property
+    def throughput(self) -> float:
+        """The number of messages sent per second"""
+        if not self.elapsed:
+            return 0.0
+        return len(self.sent) / self.elapsed
+
+    def __str__(self):
+        return '{} sent, {} failed in {:.2f}s ({:.1f} messages/s)'.format(
+            len(self.sent), len(self.failed), self.elapsed, self.throughput,
+        )
+
+
+def open_smtp_connection() -> smtplib.SMTP:
+    """Open an SMTP connection configured by Django's SMTP email backend (EMAIL_HOST, EMAIL_PORT, etc.)"""
+    backend = get_connection('django.core.mail.backends.smtp.EmailBackend', fail_silently=False)
+    backend.open()
+    return backend.connection
+
+
+class FileConnection:
+    """
+    A stand-in for an SMTP connection that writes each message to a .eml file in a directory
+
+    Useful for tests and local development, use it with `connection_factory=lambda: FileConnection(path)`
+    """
+
+    def __init__(self, directory) -> None:
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def send_message(self, msg: EmailMessage, from_addr: str = None, to_addrs: List[str] = None) -> dict:
+        path = self.directory / '{}-{}.eml'.format(time.strftime('%Y%m%d-%H%M%S'), uuid.uuid4().hex)
+        path.write_bytes(msg.as_bytes())
+        return {}
+
+    def quit(self) -> None:
+        pass
+
+
+class SMTPConnectionPool:
+    """
+    A thread-safe pool of persistent connections, opened lazily and reused from one message to the next
+
+    :param size: The maximum number of connections opened at the same time
+    :param connection_factory: A callable returning a new connection (defaults to an SMTP connection)
+    """
+
+    def __init__(self, size: int = 4, connection_factory: Callable = None) -> None:
+        self.size = size
+        self.connection_factory = connection_factory or open_smtp_connection
+        self._idle = LifoQueue()
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Get an idle connection, open a new one if the pool is not full, or wait for one to be released"""
+        try:
+            return self._idle.get_nowait()
+        except Empty:
+            pass
+        with self._lock:
+            can_open = self._opened < self.size
+            if can_open:
+                self._opened += 1
+        if not can_open:
+            return self._idle.get()
+        try:
+            return self.connection_factory()
+        except Exception:
+            with self._lock:
+                self._opened -= 1
+            raise
+
+    def release(self, connection, discard: bool = False) -> None:
+        """Give a connection back to the pool, or close it if it is not usable anymore"""
+        if not discard:
+            self._idle.put(connection)
+            return
+        with self._lock:
+            self._opened -= 1
+        _quit_quietly(connection)
+
+    def close(self) -> None:
+        """Close all idle connections"""
+        while True:
+            try:
+                connection = self._idle.get_nowait()
+            except Empty:
+                break
+            with self._lock:
+                self._opened -= 1
+            _quit_quietly(connection)
+
+
+def _quit_quietly(connection) -> None:
+    try:
+        connection.quit()
+    except (smtplib.SMTPServerDisconnected, OSError):
+        pass
+
+
+def _is_permanent_failure(error: Exception) -> bool:
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return True
+    return isinstance(error, smtplib.SMTPResponseException) and error.smtp_code >= 500
+
+
+def _deliver(pool: SMTPConnectionPool, messages: List[Tuple[MailJob, EmailMessage]], max_retries: int):
+    """
+    Send messages over a single pooled connection, reconnecting and retrying on transient failures
+
+    Any error is reported as the failure of its message, the next messages being sent anyway.
+    """
+    results = []
+    connection = None
+    try:
+        for job, msg in messages:
+            attempt = 0
+            while True:
+                try:
+                    if connection is None:
+                        connection = pool.acquire()
+                    connection.send_message(msg, msg['From'], job.recipients)
+                except Exception as e:
+                    # The connection state is unknown after any error, other messages are sent over a new one
+                    if connection is not None:
+                        pool.release(connection, discard=True)
+                        connection = None
+                    # Only network and SMTP errors (smtplib exceptions are OSError subclasses) may be transient
+                    if isinstance(e, OSError) and attempt < max_retries and not _is_permanent_failure(e):
+                        attempt += 1
+                        continue
+                    results.append((job, e))
+                else:
+                    results.append((job, None))
+                break
+    finally:
+        if connection is not None:
+            pool.release(connection)
+    return results
+
+
+class PreflightReport:
+    """
+    The outcome of checking the mail templates a send will use, before rendering anything: the errors getting
+    each (identifier, language) couple, and the tokens used by the mail templates but missing from the jobs
+    """
+
+    def __init__(self) -> None:
+        self.errors = {}  # type: Dict[Tuple[str, str], Exception]
+        self.missing_tokens = {}  # type: Dict[Tuple[str, str], List[str]]
+
+    @property
+    def ok(self) -> bool:
+        return not self.errors and not self.missing_tokens
+
+    def __str__(self) -> str:
+        lines = ['{}-{}: {}'.format(identifier, language, error)
+                 for (identifier, language), error in sorted(self.errors.items())]
+        lines += ['{}-{}: missing tokens {}'.format(identifier, language, ', '.join(tokens))
+                  for (identifier, language), tokens in sorted(self.missing_tokens.items())]
+        return '\n'.join(lines)
+
+    def raise_for_errors(self) -> None:
+        if not self.ok:
+            raise PreflightError(self)
+
+
+def preflight(pairs: Iterable[Tuple[str, str]],
+              token_names: Union[Iterable[str], Mapping[Tuple[str, str], Iterable[str]]] = None) -> PreflightReport:
+    """
+    Check that all the mail templates a send will use can be rendered, before rendering anything
+
+    Mail templates are checked against the registry and settings.LANGUAGES, their versions with a single query
+    (the ones not compiled yet being fetched, and kept compiled for the send).
+
+    :param pairs: The (identifier, language) couples of the mail templates to check
+    :param token_names: The names of the tokens that will be given, for all mail templates or by couple (optional)
+    :return: a PreflightReport of all the problems found
+    """
+    from osis_mail_template.models import MailTemplate
+
+    pairs = set(pairs)
+    report = PreflightReport()
+    for pair, compiled in MailTemplate.objects.get_compiled_templates(pairs).items():
+        if isinstance(compiled, Exception):
+            report.errors[pair] = compiled
+            continue
+        if token_names is None:
+            continue
+        given = token_names.get(pair, ()) if isinstance(token_names, Mapping) else token_names
+        missing = (compiled.subject.get_token_names() | compiled.body.get_token_names()) - set(given)
+        if missing:
+            report.missing_tokens[pair] = sorted(missing)
+    return report
+
+
+def preflight_jobs(jobs: Iterable[MailJob]) -> PreflightReport:
+    """Check the mail templates of jobs with preflight(), tokens being missing when a job doesn't give them"""
+    token_names = {}
+    for job in jobs:
+        pair = (job.identifier, job.language)
+        if pair in token_names:
+            token_names[pair] &= job.tokens.keys()
+        else:
+            token_names[pair] = set(job.tokens)
+    return preflight(token_names.keys(), token_names)
+
+
+def _batched(iterable: Iterable, size: int):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _render_batch(batch: List[MailJob], resolver: LazyTokenResolver, attachments: Dict) -> list:
+    """
+    Render a batch of jobs, the versions of the mail templates it uses being checked with a single query
+
+    Jobs are rendered grouped by language, so that each language is activated once per batch. Attachments are
+    shared with the other jobs through the given dict (see to_attachments()).
+
+    :return: the rendered message or the rendering error for each job, in the batch order
+    """
+    from osis_mail_template.models import MailTemplate
+
+    templates = MailTemplate.objects.get_compiled_templates((job.identifier, job.language) for job in batch)
+    results = [None] * len(batch)
+    order = sorted(range(len(batch)), key=lambda index: batch[index].language)
+    for language, indexes in groupby(order, key=lambda index: batch[index].language):
+        with language_activated(language):
+            for index in indexes:
+                job = batch[index]
+                template = templates[job.identifier, job.language]
+                if isinstance(template, Exception):
+                    results[index] = template
+                else:
+                    results[index] = engine.render_message(
+                        template, job.tokens, job.recipients, job.sender, resolver=resolver,
+                        attachments=to_attachments(job.attachments, attachments),
+                    )
+    return results
+
+
+def generate_emails_multi(jobs: Iterable[MailJob],
+                          batch_size: int = 100) -> Iterator[Tuple[MailJob, Union[EmailMessage, Exception]]]:
+    """
+    Generate the messages of many jobs, using any number of mail templates and languages, without sending them
+
+    Jobs are rendered by batches of batch_size, each batch being yielded before the next one is rendered: the
+    versions of all the mail templates a batch needs are checked with a single query, the outdated ones being fetched
+    with another one, and its jobs are rendered grouped by language. Attachments shared by jobs are encoded once.
+
+    :return: an iterator of (job, result) in the order of the jobs, the result being the EmailMessage, or the error
+        that prevented rendering it (UnknownLanguage, EmptyMailTemplateContent, UnknownMailTemplateIdentifier)
+    """
+    resolver = LazyTokenResolver()
+    attachments = {}
+    for batch in _batched(jobs, batch_size):
+        yield from zip(batch, _render_batch(batch, resolver, attachments))
+
+
+def digest_jobs(jobs: Iterable[MailJob], digest_identifier: str, min_items: int = 2,
+                item_format: str = DIGEST_ITEM_FORMAT) -> List[MailJob]:
+    """
+    Merge the jobs sent to the same recipients in the same language into a single job of a digest mail template
+
+    The digest mail template gets an `items` token, made of the subject and HTML body of each merged mail rendered
+    through item_format (compiled once), and a `count` token. The mail templates of all the merged jobs are checked
+    with a single query. Attachments of the merged jobs are all attached to the digest, once each.
+
+    :param jobs: An iterable of MailJob, consumed as a whole to be grouped
+    :param digest_identifier: The identifier of the digest mail template
+    :param min_items: The number of jobs from which jobs are merged, fewer jobs being kept as they are
+    :param item_format: The HTML fragment repeated for each merged mail, with `subject` and `body` tokens
+    :return: the jobs to send, in the order of the first job of each group, jobs that can't be rendered (e.g. with
+        an UnknownLanguage) being kept as they are, so that their error is reported when sending
+    """
+    from osis_mail_template.models import MailTemplate
+
+    groups = OrderedDict()
+    for job in jobs:
+        groups.setdefault((tuple(job.recipients), job.language, job.sender), []).append(job)
+    templates = MailTemplate.objects.get_compiled_templates(
+        (job.identifier, job.language) for group in groups.values() if len(group) >= min_items for job in group
+    )
+    render_item = CompiledFormat(item_format).bind(['subject', 'body'])
+    resolver = LazyTokenResolver()
+    shared_attachments = {}
+
+    digests = []
+    for (recipients, language, sender), group in groups.items():
+        merged, failing = [], []
+        for job in group:
+            if isinstance(templates.get((job.identifier, job.language)), Exception):
+                failing.append(job)
+            else:
+                merged.append(job)
+        if len(merged) < min_items:
+            digests.extend(group)
+            continue
+        with language_activated(language):
+            items = []
+            for job in merged:
+                rendered = engine.render(templates[job.identifier, job.language], job.tokens, resolver=resolver)
+                items.append(render_item([conditional_escape(rendered.subject), rendered.html_body]))
+        # The same attachment (e.g. a regulation, by path or content) may be given to each merged job, the same
+        # content getting the same Attachment instance
+        attachments = OrderedDict(
+            (id(attachment), attachment)
+            for job in merged for attachment in to_attachments(job.attachments, shared_attachments)
+        )
+        digests.append(MailJob(
+            digest_identifier,
+            language,
+            {'items': mark_safe(''.join(items)), 'count': len(merged)},
+            list(recipients),
+            sender,
+            list(attachments.values()),
+        ))
+        digests.extend(failing)
+    return digests
+
+
+def send_emails(jobs: Iterable[MailJob], pool_size: int = 4, batch_size: int = 100, max_retries: int = 2,
+                connection_factory: Callable = None, check: bool = False, digest: str = None,
+                on_result: Callable[[MailJob, Optional[Exception]], None] = None) -> SendReport:
+    """
+    Render and send a stream of mails over a pool of persistent connections
+
+    Jobs are rendered by batches in the calling thread (mail templates being checked once per batch and fetched only
+    when changed, lazy translations in tokens and attachments being resolved once for the whole run), then each
+    batch is split across the pool, each worker thread sending its share over a single connection.
+
+    :param jobs: An iterable of MailJob
+    :param pool_size: The number of connections (and sending threads) to use
+    :param batch_size: The number of messages rendered before being handed over for sending
+    :param max_retries: The number of times a message is retried on a transient failure (over a new connection)
+    :param connection_factory: A callable returning a new connection (defaults to an SMTP connection)
+    :param check: Whether all the jobs are checked with preflight_jobs() before sending any, raising PreflightError
+    :param digest: The identifier of a digest mail template, to merge the jobs sent to the same recipients in the
+        same language into a single mail (see digest_jobs(), the report then counts the merged jobs as one)
+    :param on_result: A callable given each job and its error (None once sent) in the calling thread, as soon as
+        the result is known (e.g. to record it)
+    :return: a SendReport with the sent and failed jobs and the throughput
+    """
+    if digest:
+        jobs = digest_jobs(jobs, digest)
+    if check:
+        jobs = list(jobs)
+        preflight_jobs(jobs).raise_for_errors()
+    report = SendReport()
+
+    def add_result(job, error):
+        if error is None:
+            report.sent.append(job)
+        else:
+            report.failed.append((job, error))
+        if on_result is not None:
+            on_result(job, error)
+
+    pool = SMTPConnectionPool(pool_size, connection_factory)
+    resolver = LazyTokenResolver()
+    attachments = {}
+    start = time.monotonic()
+    try:
+        with ThreadPoolExecutor(max_workers=pool_size) as executor:
+            for batch in _batched(jobs, batch_size):
+                messages = []
+                for job, result in zip(batch, _render_batch(batch, resolver, attachments)):
+                    if isinstance(result, Exception):
+                        add_result(job, result)
+                    else:
+                        messages.append((job, result))
+                chunks = [messages[i::pool_size] for i in range(pool_size) if messages[i::pool_size]]
+                for results in executor.map(lambda chunk: _deliver(pool, chunk, max_retries), chunks):
+                    for job, error in results:
+                        add_result(job, error)
+    finally:
+        pool.close()
+        report.elapsed = time.monotonic() - start
+    return report
+
+
+def process_outbox(batch_size: int = 100, max_attempts: int = 3, pool_size: int = 4,
+                   connection_factory: Callable = None, retry_delay: float = 60,
+                   lease: float = OUTBOX_LEASE) -> SendReport:
+    """
+    Render and send a batch of pending mails from the outbox
+
+    Rows are claimed with SKIP LOCKED, so that several workers can process the outbox concurrently, each one
+    getting its own batch: their attempt is counted and their next attempt postponed by the lease, then the locks are
+    released before sending. Each mail is marked as sent or failed as soon as its result is known, so that an
+    aborted batch doesn't send again the mails already sent, the other ones being retried once the lease expires.
+
+    A mail failing to send because of a transient error is retried on a later batch, after a delay doubling with each
+    attempt, until max_attempts is reached. A mail failing to render, or permanently rejected (a 5xx reply or refused
+    recipients), is marked as failed right away.
+
+    :param retry_delay: The number of seconds before the first retry of a mail
+    :param lease: The number of seconds the mails of the batch are kept from other workers while being sent
+    :return: a SendReport for the processed batch (empty if there was nothing to send)
+    """
+    from osis_mail_template.models import OutboxMail
+
+    with transaction.atomic():
+        items = list(
+            OutboxMail.objects.select_for_update(skip_locked=True)
+            .filter(status=OutboxMail.PENDING, attempts__lt=max_attempts)
+            .filter(Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=timezone.now()))
+            .order_by('pk')[:batch_size]
+        )
+        if not items:
+            return SendReport()
+        claimed_until = timezone.now() + timedelta(seconds=lease)
+        for item in items:
+            item.attempts += 1
+            item.next_attempt_at = claimed_until
+        OutboxMail.objects.bulk_update(items, ['attempts', 'next_attempt_at'])
+    items_by_job = {}
+    for item in items:
+        items_by_job[item.as_mail_job()] = item
+
+    def record(job, error):
+        item = items_by_job[job]
+        now = timezone.now()
+        if error is None:
+            item.status = OutboxMail.SENT
+            item.sent_at = now
+            item.next_attempt_at = None
+        else:
+            item.last_error = str(error)
+            if isinstance(error, RENDERING_ERRORS) or _is_permanent_failure(error) or item.attempts >= max_attempts:
+                item.status = OutboxMail.FAILED
+                item.next_attempt_at = None
+            else:
+                item.next_attempt_at = now + timedelta(seconds=retry_delay * 2 ** (item.attempts - 1))
+        item.save(update_fields=['status', 'sent_at', 'last_error', 'next_attempt_at'])
+
+    return send_emails(
+        items_by_job.keys(),
+        pool_size=pool_size,
+        batch_size=batch_size,
+        connection_factory=connection_factory,
+        on_result=record,
+    )
@@ -0,0 +1,203 @@
+# ##############################################################################
+#
+#    OSIS stands for Open Student Information System. It's an application
+#    designed to manage the core business of higher education institutions,
+#    such as universities, faculties, institutes and professional schools.
+#    The core business involves the administration of students, teachers,
+#    courses, programs and so on.
+#
+#    Copyright (C) 2015-2021 Université catholique de Louvain (http://www.uclouvain.be)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    A copy of this license - GNU General Public License - is available
+#    at the root of the source code of this program.  If not,
+#    see http://www.gnu.org/licenses/.
+#
+# ##############################################################################
+import base64
+import struct
+import uuid
+from email.message import EmailMessage
+from email.policy import SMTP
+from typing import List
+
+from django.conf import settings
+from django.utils.functional import cached_property
+
+from osis_mail_template.attachments import Attachment
+from osis_mail_template.exceptions import InvalidSerializedMail
+from osis_mail_template.rendering import build_message
+
+__all__ = [
+    'LoadedMail',
+    'dump_mail',
+    'load_mail',
+]
+
+MAGIC = b'OMT'
+# Bump when the layout changes, loading a mail serialized with another version fails
+FORMAT_VERSION = 1
+# Magic, format version, number of recipients and number of attachments
+_HEADER = struct.Struct('>3sBHH')
+# Subject, sender, plain text and HTML, then each recipient, then the filename, MIME type and content of each attachment
+_FIXED_FIELDS = 4
+_ATTACHMENT_FIELDS = 3
+_TEXT_PART_HEADERS = '--{boundary}\r\nContent-Type: text/{subtype}; charset="utf-8"\r\n' \
+    'Content-Transfer-Encoding: base64\r\n\r\n'
+
+
+def dump_mail(mail) -> bytes:
+    """
+    Serialize a rendered mail into compact bytes, to hand it over to another process (e.g. a worker) instead of
+    pickling its EmailMessage
+
+    The bytes are made of a header (a magic, the format version and the number of recipients and attachments), the
+    lengths of all the fields, then the fields as UTF-8. Attachments are kept encoded in base64, as in the message.
+
+    :param mail: A RenderedMail (or a LoadedMail), its parts being rendered if they are not yet
+    """
+    fields = [mail.subject, mail.sender or settings.DEFAULT_FROM_EMAIL, mail.plain_text, mail.wrapped_html]
+    fields += mail.recipients
+    for attachment in mail.attachments:
+        fields += [attachment.filename or '', attachment.mimetype, attachment.encoded]
+    encoded = [field.encode('utf-8') for field in fields]
+    return b''.join([
+        _HEADER.pack(MAGIC, FORMAT_VERSION, len(mail.recipients), len(mail.attachments)),
+        struct.pack('>{}I'.format(len(encoded)), *map(len, encoded)),
+    ] + encoded)
+
+
+def _boundary() -> str:
+    # "_" is not a base64 character, so the boundary can't appear in the parts
+    return '=_{}'.format(uuid.uuid4().hex)
+
+
+def _fold(name: str, value) -> str:
+    # Values are parsed to be encoded (RFC 2047) if needed, as when set on a message
+    return SMTP.fold(*SMTP.header_store_parse(name, value))
+
+
+def _crlf(encoded: bytes) -> bytes:
+    return encoded.replace(b'\n', b'\r\n')
+
+
+def _text_part(boundary: str, subtype: str, text: str) -> bytes:
+    headers = _TEXT_PART_HEADERS.format(boundary=boundary, subtype=subtype).encode('ascii')
+    # Line breaks of text are encoded in their canonical form (CRLF)
+    text = text.replace('\r\n', '\n').replace('\n', '\r\n')
+    return headers + _crlf(base64.encodebytes(text.encode('utf-8')))
+
+
+def _attachment_part(boundary: str, attachment: Attachment) -> bytes:
+    headers = ''.join(_fold(name, value) for name, value in attachment.as_part().items())
+    return '--{}\r\n{}\r\n'.format(boundary, headers).encode('ascii') + _crlf(attachment.encoded.encode('ascii'))
+
+
+class LoadedMail:
+    """
+    A mail loaded from the bytes of dump_mail(), with the same parts as the RenderedMail it was serialized from,
+    ready to be turned into a message
+    """
+
+    def __init__(self, subject: str, sender: str, recipients: List[str], plain_text: str, wrapped_html: str,
+                 attachments: List[Attachment] = None) -> None:
+        self.subject = subject
+        self.sender = sender
+        self.recipients = recipients
+        self.plain_text = plain_text
+        self.wrapped_html = wrapped_html
+        self.attachments = attachments or []
+        self._message = None
+
+    def __repr__(self):
+        return '<LoadedMail {!r} to {}>'.format(self.subject, ', '.join(self.recipients))
+
+    def as_message(self) -> EmailMessage:
+        """The message ready for sending, built once (the same instance is returned each time)"""
+        if self._message is None:
+            self._message = build_message(
+                self.subject, self.sender, self.recipients, self.plain_text, self.wrapped_html, self.attachments,
+            )
+        return self._message
+
+    @cached_property
+    def smtp_bytes(self) -> bytes:
+        """
+        The message as sent over SMTP (with CRLF line endings), e.g. for smtplib.SMTP.sendmail()
+
+        The MIME structure being known, it is written directly rather than through an EmailMessage: all the parts
+        are in base64, attachments as they were serialized.
+        """
+        alternative = _boundary()
+        parts = [
+            _text_part(alternative, 'plain', self.plain_text),
+            _text_part(alternative, 'html', self.wrapped_html),
+            '--{}--\r\n'.format(alternative).encode('ascii'),
+        ]
+        if self.attachments:
+            mixed = _boundary()
+            parts.insert(0, '--{}\r\nContent-Type: multipart/alternative; boundary="{}"\r\n\r\n'.format(
+                mixed, alternative,
+            ).encode('ascii'))
+            parts += [_attachment_part(mixed, attachment) for attachment in self.attachments]
+            parts.append('--{}--\r\n'.format(mixed).encode('ascii'))
+            content_type = 'multipart/mixed; boundary="{}"'.format(mixed)
+        else:
+            content_type = 'multipart/alternative; boundary="{}"'.format(alternative)
+        headers = [
+            'MIME-Version: 1.0\r\n',
+            _fold('Subject', self.subject),
+            _fold('From', self.sender),
+            _fold('To', ', '.join(self.recipients)),
+            'Content-Type: {}\r\n\r\n'.format(content_type),
+        ]
+        return ''.join(headers).encode('ascii') + b''.join(parts)
+
+
+def load_mail(data: bytes) -> LoadedMail:
+    """
+    Load a mail serialized by dump_mail()
+
+    :raise InvalidSerializedMail: if the bytes are not a serialized mail, or were serialized with another version
+    """
+    view = memoryview(data)
+    try:
+        magic, version, recipients, attachments = _HEADER.unpack_from(view)
+    except struct.error:
+        raise InvalidSerializedMail("truncated header")
+    if magic != MAGIC:
+        raise InvalidSerializedMail("not a serialized mail")
+    if version != FORMAT_VERSION:
+        raise InvalidSerializedMail("unsupported version {}".format(version))
+    count = _FIXED_FIELDS + recipients + attachments * _ATTACHMENT_FIELDS
+    try:
+        lengths = struct.unpack_from('>{}I'.format(count), view, _HEADER.size)
+    except struct.error:
+        raise InvalidSerializedMail("truncated lengths")
+    offset = _HEADER.size + 4 * count
+    if offset + sum(lengths) != len(view):
+        raise InvalidSerializedMail("{} bytes of fields expected, got {}".format(sum(lengths), len(view) - offset))
+    fields = []
+    try:
+        for length in lengths:
+            fields.append(str(view[offset:offset + length], 'utf-8'))
+            offset += length
+    except UnicodeDecodeError as e:
+        raise InvalidSerializedMail(e)
+    subject, sender, plain_text, wrapped_html = fields[:_FIXED_FIELDS]
+    attachment_fields = fields[_FIXED_FIELDS + recipients:]
+    return LoadedMail(
+        subject, sender, fields[_FIXED_FIELDS:_FIXED_FIELDS + recipients], plain_text, wrapped_html, [
+            Attachment.from_encoded(encoded, filename or None, mimetype)
+            for filename, mimetype, encoded in zip(*[iter(attachment_fields)] * _ATTACHMENT_FIELDS)
+        ],
+    )
@@ -0,0 +1,139 @@
+# ##############################################################################
+#
+#    OSIS stands for Open Student Information System. It's an application
+#    designed to manage the core business of higher education institutions,
+#    such as universities, faculties, institutes and professional schools.
+#    The core business involves the administration of students, teachers,
+#    courses, programs and so on.
+#
+#    Copyright (C) 2015-2021 Université catholique de Louvain (http://www.uclouvain.be)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    A copy of this license - GNU General Public License - is available
+#    at the root of the source code of this program.  If not,
+#    see http://www.gnu.org/licenses/.
+#
+# ##############################################################################
+from contextlib import contextmanager
+from typing import Dict, Iterable, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import caches
+
+from osis_mail_template.rendering import CompiledMailTemplate, engine
+
+__all__ = [
+    'forget',
+    'get_shared_cache',
+    'get_shared_compiled_templates',
+    'share',
+    'using_shared_cache',
+]
+
+# Bump the format number when the serialized form of compiled templates changes
+KEY_PREFIX = 'osis_mail_template:3'
+DEFAULT_TIMEOUT = 24 * 60 * 60
+# The current version of a mail template is only trusted for a short time (see share())
+DEFAULT_VERSION_TIMEOUT = 60
+
+_FROM_SETTINGS = object()
+# The cache alias used instead of settings.OSIS_MAIL_TEMPLATE_CACHE (see using_shared_cache())
+_cache_alias = _FROM_SETTINGS
+
+
+def get_shared_cache():
+    """Get the cache configured by settings.OSIS_MAIL_TEMPLATE_CACHE (a cache alias), if any"""
+    alias = getattr(settings, 'OSIS_MAIL_TEMPLATE_CACHE', None) if _cache_alias is _FROM_SETTINGS else _cache_alias
+    return caches[alias] if alias else None
+
+
+@contextmanager
+def using_shared_cache(alias: Optional[str]):
+    """
+    Share compiled templates through another cache of settings.CACHES (or none, with None) for all threads, instead
+    of the one configured by settings.OSIS_MAIL_TEMPLATE_CACHE (e.g. to compare both from a management command)
+    """
+    global _cache_alias
+    previous, _cache_alias = _cache_alias, alias
+    try:
+        yield
+    finally:
+        _cache_alias = previous
+
+
+def _version_key(identifier: str, language: str) -> str:
+    return '{}:version:{}:{}'.format(KEY_PREFIX, identifier, language)
+
+
+def _compiled_key(identifier: str, language: str, version: int, content_hash: str) -> str:
+    return '{}:compiled:{}:{}:{}:{}'.format(KEY_PREFIX, identifier, language, version, content_hash)
+
+
+def get_shared_compiled_templates(pairs: Iterable[Tuple[str, str]]) -> Dict[Tuple[str, str], CompiledMailTemplate]:
+    """
+    Get compiled mail templates from the shared cache, by (identifier, language)
+
+    The current version and content hash of each mail template is read from the cache (one key per mail template),
+    the compiled template being taken from the engine if it matches them, from the cache otherwise.
+
+    :return: the compiled templates found, missing ones have to be fetched from the database
+    """
+    cache = get_shared_cache()
+    if cache is None:
+        return {}
+    version_keys = {_version_key(*pair): pair for pair in pairs}
+    compiled_templates = {}
+    compiled_keys = {}
+    for key, (version, content_hash) in cache.get_many(version_keys.keys()).items():
+        pair = version_keys[key]
+        compiled = engine.get_compiled(*pair, version=version, content_hash=content_hash)
+        if compiled is None:
+            compiled_keys[_compiled_key(pair[0], pair[1], version, content_hash)] = pair
+        else:
+            compiled_templates[pair] = compiled
+    if compiled_keys:
+        for key, data in cache.get_many(compiled_keys.keys()).items():
+            compiled_templates[compiled_keys[key]] = engine.add(CompiledMailTemplate.load(data))
+    return compiled_templates
+
+
+def share(compiled_templates: Iterable[CompiledMailTemplate], timeout: Optional[int] = None) -> None:
+    """
+    Store compiled templates in the shared cache, along with their current version and content hash
+
+    A compiled template is stored under its version and content hash, it can thus be kept long. The current version
+    is only added if none is known (another process may have stored a newer one), and expires quickly: a process
+    that read a mail template from the database before it was changed may share it after the change forgot the
+    current version, the outdated version is then only trusted until it expires.
+    """
+    cache = get_shared_cache()
+    if cache is None:
+        return
+    values = {}
+    versions = {}
+    for compiled in compiled_templates:
+        current = (compiled.version, compiled.content_hash)
+        versions[_version_key(compiled.identifier, compiled.language)] = current
+        values[_compiled_key(compiled.identifier, compiled.language, *current)] = compiled.dump()
+    if values:
+        timeout = getattr(settings, 'OSIS_MAIL_TEMPLATE_CACHE_TIMEOUT', DEFAULT_TIMEOUT) if timeout is None else timeout
+        cache.set_many(values, timeout)
+        version_timeout = getattr(settings, 'OSIS_MAIL_TEMPLATE_CACHE_VERSION_TIMEOUT', DEFAULT_VERSION_TIMEOUT)
+        for key, current in versions.items():
+            cache.add(key, current, version_timeout)
+
+
+def forget(identifier: str, language: str) -> None:
+    """Remove the current version of a mail template from the shared cache, so that it is read again from the db"""
+    cache = get_shared_cache()
+    if cache is not None:
+        cache.delete(_version_key(identifier, language))
@@ -0,0 +1,81 @@
+# ##############################################################################
+#
+#    OSIS stands for Open Student Information System. It's an application
+#    designed to manage the core business of higher education institutions,
+#    such as universities, faculties, institutes and professional schools.
+#    The core business involves the administration of students, teachers,
+#    courses, programs and so on.
+#
+#    Copyright (C) 2015-2021 Université catholique de Louvain (http://www.uclouvain.be)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    A copy of this license - GNU General Public License - is available
+#    at the root of the source code of this program.  If not,
+#    see http://www.gnu.org/licenses/.
+#
+# ##############################################################################
+import pickle
+import time
+
+from django.test import SimpleTestCase, tag
+
+from osis_mail_template.models import MailTemplate
+from osis_mail_template.rendering import MailRenderEngine
+from osis_mail_template.serialization import load_mail
+
+MESSAGES = 500
+
+
+@tag('benchmark')
+class SerializationBenchmark(SimpleTestCase):
+    """Size and speed of handing rendered mails over to a worker (./manage.py test --tag=benchmark)"""
+
+    def setUp(self):
+        engine = MailRenderEngine()
+        template = MailTemplate(
+            identifier='benchmark',
+            language='en',
+            subject='Your grade for {course}',
+            body='<p>Hello {name},</p>' + '<p>Your grade for <a href="http://test.com">{course}</a>: {grade}</p>' * 20,
+        )
+        attachment = ('regulation.pdf', b'%PDF-1.4 ' + bytes(range(256)) * 400, 'application/pdf')
+        self.mails = [
+            engine.render(template, {'name': i, 'course': 'LINFO1101', 'grade': 15}, ['to@example.com'],
+                          attachments=[attachment])
+            for i in range(MESSAGES)
+        ]
+        for mail in self.mails:
+            mail.as_message()
+
+    def measure(self, dump, load):
+        start = time.perf_counter()
+        dumped = [dump(mail) for mail in self.mails]
+        dump_time = time.perf_counter() - start
+        start = time.perf_counter()
+        for data in dumped:
+            load(data)
+        return sum(map(len, dumped)) / MESSAGES, dump_time, time.perf_counter() - start
+
+    def test_serialization(self):
+        def smtp_bytes(msg):
+            return msg.as_bytes(policy=msg.policy.clone(linesep='\r\n'))
+
+        pickled = self.measure(
+            lambda mail: pickle.dumps(mail.as_message()), lambda data: smtp_bytes(pickle.loads(data)),
+        )
+        serialized = self.measure(lambda mail: mail.serialize(), lambda data: load_mail(data).smtp_bytes)
+        print('\n{:>20} | {:>10} | {:>8} | {:>20}'.format('', 'bytes/mail', 'dump (s)', 'load to SMTP (s)'))
+        for name, (size, dump_time, load_time) in [('pickle(EmailMessage)', pickled), ('serialize()', serialized)]:
+            print('{:>20} | {:>10.0f} | {:>8.3f} | {:>20.3f}'.format(name, size, dump_time, load_time))
+        self.assertLess(serialized[0], pickled[0])
+        self.assertLess(serialized[1], pickled[1])
+        self.assertLess(serialized[2], pickled[2])
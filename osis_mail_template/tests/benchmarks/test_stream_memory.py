@@ -0,0 +1,76 @@
+# ##############################################################################
+#
+#    OSIS stands for Open Student Information System. It's an application
+#    designed to manage the core business of higher education institutions,
+#    such as universities, faculties, institutes and professional schools.
+#    The core business involves the administration of students, teachers,
+#    courses, programs and so on.
+#
+#    Copyright (C) 2015-2021 Université catholique de Louvain (http://www.uclouvain.be)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    A copy of this license - GNU General Public License - is available
+#    at the root of the source code of this program.  If not,
+#    see http://www.gnu.org/licenses/.
+#
+# ##############################################################################
+import tempfile
+import tracemalloc
+
+from django.test import SimpleTestCase, tag
+
+from osis_mail_template.models import MailTemplate
+from osis_mail_template.rendering import MailRenderEngine
+
+
+@tag('benchmark')
+class StreamMemoryBenchmark(SimpleTestCase):
+    """Peak memory of rendering a message with a large body (./manage.py test --tag=benchmark)"""
+
+    def setUp(self):
+        self.engine = MailRenderEngine()
+        self.template = MailTemplate(
+            identifier='benchmark',
+            language='en',
+            subject='Your timetable',
+            body='<p>Hello {name},</p><p>Here is your timetable:</p>{timetable}<p>--<br>The OSIS Team</p>',
+        )
+        rows = ''.join(
+            '<tr><td>Course {0}</td><td>Room {0}</td><td>08:30</td><td>10:30</td></tr>'.format(i)
+            for i in range(5000)
+        )
+        self.tokens = {'name': 'John', 'timetable': '<table>' + rows + '</table>'}
+
+    def measure(self, render):
+        with tempfile.TemporaryFile() as sink:
+            tracemalloc.start()
+            render(sink)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        return peak
+
+    def test_stream_memory(self):
+        def generate(sink):
+            sink.write(self.engine.render_message(self.template, self.tokens, ['to@example.com']).as_bytes())
+
+        def stream(sink):
+            self.engine.render_to_stream(self.template, self.tokens, ['to@example.com'], sink)
+
+        body_size = len(self.template.body.format_map(self.tokens))
+        generate_peak = self.measure(generate)
+        stream_peak = self.measure(stream)
+        print('\nbody size: {:.1f} MB'.format(body_size / 2 ** 20))
+        print('render_message().as_bytes(): peak {:.1f} MB'.format(generate_peak / 2 ** 20))
+        print('render_to_stream(): peak {:.1f} MB'.format(stream_peak / 2 ** 20))
+        self.assertLess(stream_peak, generate_peak)
+        # Only html2text parser state remains along the body, neither the whole markup nor the whole text
+        self.assertLess(stream_peak, 3 * body_size)
@@ -0,0 +1,58 @@
+# ##############################################################################
+#
+#    OSIS stands for Open Student Information System. It's an application
+#    designed to manage the core business of higher education institutions,
+#    such as universities, faculties, institutes and professional schools.
+#    The core business involves the administration of students, teachers,
+#    courses, programs and so on.
+#
+#    Copyright (C) 2015-2021 Université catholique de Louvain (http://www.uclouvain.be)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    A copy of this license - GNU General Public License - is available
+#    at the root of the source code of this program.  If not,
+#    see http://www.gnu.org/licenses/.
+#
+# ##############################################################################
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.test import SimpleTestCase, tag
+
+from osis_mail_template.models import MailTemplate
+from osis_mail_template.rendering import MailRenderEngine
+
+MESSAGES = 400
+
+
+@tag('benchmark')
+class ThreadScalingBenchmark(SimpleTestCase):
+    """Throughput of the render engine depending on the number of threads (./manage.py test --tag=benchmark)"""
+
+    def test_thread_scaling(self):
+        engine = MailRenderEngine()
+        template = MailTemplate(
+            identifier='benchmark',
+            language='en',
+            subject='Your grade for {course}',
+            body='<p>Hello {name},</p>' + '<p>Your grade for <a href="http://test.com">{course}</a>: {grade}</p>' * 20,
+        )
+
+        def render(i):
+            return engine.render_message(template, {'name': i, 'course': 'LINFO1101', 'grade': 15}, ['to@example.com'])
+
+        print('\nthreads | messages/s')
+        for thread_count in (1, 2, 4, 8):
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=thread_count) as executor:
+                list(executor.map(render, range(MESSAGES)))
+            print('{:>7} | {:>10.1f}'.format(thread_count, MESSAGES / (time.perf_counter() - start)))
@@ -0,0 +1,117 @@
+# ##############################################################################
+#
+#    OSIS stands for Open Student Information System. It's an application
+#    designed to manage the core business of higher education institutions,
+#    such as universities, faculties, institutes and professional schools.
+#    The core business involves the administration of students, teachers,
+#    courses, programs and so on.
+#
+#    Copyright (C) 2015-2021 Université catholique de Louvain (http://www.uclouvain.be)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    A copy of this license - GNU General Public License - is available
+#    at the root of the source code of this program.  If not,
+#    see http://www.gnu.org/licenses/.
+#
+# ##############################################################################
+import base64
+import email
+import os
+import tempfile
+from email import policy
+from unittest.mock import patch
+
+from django.test import SimpleTestCase, TestCase
+
+from osis_mail_template import Attachment, MailJob, generate_email, generate_emails_multi
+from osis_mail_template.attachments import to_attachments
+from osis_mail_template.models import MailTemplate
+from osis_mail_template.rendering import engine
+
+PDF_CONTENT = b'%PDF-1.4 ' + bytes(range(256)) * 100
+
+
+class AttachmentTestCase(SimpleTestCase):
+    def test_bytes(self):
+        attachment = Attachment(memoryview(PDF_CONTENT), 'regulation.pdf')
+        self.assertEqual(attachment.mimetype, 'application/pdf')
+        self.assertEqual(attachment.encoded, base64.encodebytes(PDF_CONTENT).decode())
+        self.assertIs(attachment.encoded, attachment.encoded)
+
+    def test_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'calendar.ics')
+            with open(path, 'wb') as file:
+                file.write(PDF_CONTENT)
+            attachment = Attachment(path)
+            self.assertEqual(attachment.filename, 'calendar.ics')
+            self.assertEqual(attachment.mimetype, 'text/calendar')
+            self.assertEqual(attachment.encoded, base64.encodebytes(PDF_CONTENT).decode())
+
+            # Large files are mapped in memory
+            with patch('osis_mail_template.attachments.MMAP_THRESHOLD', 1):
+                self.assertEqual(Attachment(path).encoded, attachment.encoded)
+
+    def test_unknown_mimetype(self):
+        self.assertEqual(Attachment(b'content').mimetype, 'application/octet-stream')
+
+    def test_to_attachments_shares_contents(self):
+        shared = {}
+        first = to_attachments([PDF_CONTENT, ('regulation.pdf', PDF_CONTENT, 'application/pdf')], shared)
+        second = to_attachments([PDF_CONTENT, ('regulation.pdf', PDF_CONTENT, 'application/pdf')], shared)
+        self.assertIs(first[0], second[0])
+        self.assertIs(first[1], second[1])
+        self.assertEqual(first[1].filename, 'regulation.pdf')
+        # Equal contents given as distinct objects are shared too
+        third = to_attachments([bytes(bytearray(PDF_CONTENT)), ('regulation.pdf', bytearray(PDF_CONTENT))], shared)
+        self.assertIs(third[0], first[0])
+        self.assertIsNot(third[1], first[1])  # the mimetype is guessed, not given
+        self.assertIsNot(to_attachments([b'other'], shared)[0], first[0])
+        attachment = Attachment(b'content')
+        self.assertEqual(to_attachments([attachment]), [attachment])
+
+
+class GenerateEmailWithAttachmentsTestCase(TestCase):
+    TEMPLATE_ID = 'test-identifier'
+
+    def setUp(self):
+        engine.clear()
+        MailTemplate.objects.create(
+            identifier=self.TEMPLATE_ID,
+            language='en',
+            subject='This is a subject with {token}',
+            body='<p>This is a body with {token}</p>',
+        )
+
+    def test_generate_email(self):
+        msg = generate_email(self.TEMPLATE_ID, 'en', {'token': 'value'}, ['to@example.com'], attachments=[
+            ('regulation.pdf', PDF_CONTENT, 'application/pdf'),
+        ])
+        parsed = email.message_from_bytes(msg.as_bytes(), policy=policy.default)
+        self.assertEqual(parsed.get_content_type(), 'multipart/mixed')
+        self.assertIn('This is a body with value', parsed.get_body(('plain',)).get_content())
+        attachments = list(parsed.iter_attachments())
+        self.assertEqual(len(attachments), 1)
+        self.assertEqual(attachments[0].get_filename(), 'regulation.pdf')
+        self.assertEqual(attachments[0].get_content(), PDF_CONTENT)
+
+    def test_bulk_shares_encoded_content(self):
+        jobs = [
+            MailJob(self.TEMPLATE_ID, 'en', {'token': i}, ['to@example.com'], attachments=[PDF_CONTENT])
+            for i in range(3)
+        ]
+        payloads = [
+            next(msg.iter_attachments()).get_payload()
+            for _, msg in generate_emails_multi(jobs)
+        ]
+        self.assertIs(payloads[0], payloads[1])
+        self.assertIs(payloads[1], payloads[2])
@@ -0,0 +1,171 @@
+# ##############################################################################
+#
+#    OSIS stands for Open Student Information System. It's an application
+#    designed to manage the core business of higher education institutions,
+#    such as universities, faculties, institutes and professional schools.
+#    The core business involves the administration of students, teachers,
+#    courses, programs and so on.
+#
+#    Copyright (C) 2015-2021 Université catholique de Louvain (http://www.uclouvain.be)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    A copy of this license - GNU General Public License - is available
+#    at the root of the source code of this program.  If not,
+#    see http://www.gnu.org/licenses/.
+#
+# ##############################################################################
+import gzip
+import io
+import json
+import os
+import tempfile
+from io import StringIO
+from unittest.mock import patch
+
+from django.core.management import CommandError, call_command
+from django.test import TestCase
+
+from osis_mail_template.bundle import export_bundle, import_bundle
+from osis_mail_template.exceptions import (
+    InvalidMailTemplateBundle,
+    UnknownLanguage,
+    UnknownMailTemplateIdentifier,
+    UnknownToken,
+)
+from osis_mail_template.models import MailTemplate, MailTemplateRevision
+from osis_mail_template.registry import MailTemplateRegistry, Token
+
+
+class BundleTestCase(TestCase):
+    def setUp(self):
+        registry = MailTemplateRegistry()
+        for identifier in ['test-reminder', 'test-rejection']:
+            registry.register(identifier, identifier, [Token('token', 'Token', 'example')], tag='Test')
+        patcher = patch('osis_mail_template.templates', registry)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for identifier in ['test-reminder', 'test-rejection']:
+            for language in ['en', 'fr-be']:
+                MailTemplate.objects.create(
+                    identifier=identifier,
+                    language=language,
+                    subject='{} {} {{token}}'.format(identifier, language),
+                    body='<p>Body {token}</p>',
+                )
+
+    def export(self, identifiers=None) -> io.BytesIO:
+        bundle = io.BytesIO()
+        export_bundle(bundle, identifiers)
+        bundle.seek(0)
+        return bundle
+
+    def make_bundle(self, rows, header=None) -> io.BytesIO:
+        bundle = io.BytesIO()
+        with gzip.open(bundle, 'wt', encoding='utf-8') as file:
+            file.write(json.dumps(header or {'format': 'osis_mail_template', 'version': 1}) + '\n')
+            for row in rows:
+                file.write(json.dumps(row) + '\n')
+        bundle.seek(0)
+        return bundle
+
+    def test_export(self):
+        with gzip.open(self.export(['test-reminder']), 'rt') as bundle:
+            lines = [json.loads(line) for line in bundle]
+        self.assertEqual(lines[0]['format'], 'osis_mail_template')
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(lines[1]['identifier'], 'test-reminder')
+        self.assertEqual(lines[1]['language'], 'en')
+        self.assertEqual(lines[1]['tokens'], ['token'])
+        self.assertEqual(lines[1]['tag'], 'Test')
+
+    def test_only_changed_rows_are_written(self):
+        bundle = self.export()
+        reminder = MailTemplate.objects.get(identifier='test-reminder', language='en')
+        reminder.body = '<p>Changed</p>'
+        reminder.save()
+        MailTemplate.objects.filter(identifier='test-rejection', language='fr-be').delete()
+
+        # Per batch: existing rows, last versions of new rows, insert, update and revisions (within a savepoint)
+        with self.assertNumQueries(5 + 2):
+            report = import_bundle(bundle, batch_size=10)
+        self.assertEqual((report.inserted, report.updated, report.unchanged), (1, 1, 2))
+        reminder.refresh_from_db()
+        self.assertEqual(reminder.body, '<p>Body {token}</p>')
+        self.assertEqual(reminder.version, 3)
+        recreated = MailTemplate.objects.get(identifier='test-rejection', language='fr-be')
+        # Versions keep increasing when a mail template is created again
+        self.assertEqual(recreated.version, 2)
+        self.assertEqual(recreated.tag, 'Test')
+        self.assertTrue(MailTemplateRevision.objects.filter(
+            identifier='test-reminder', language='en', version=3, body='<p>Body {token}</p>',
+        ).exists())
+
+    def test_invalid_rows_are_all_reported(self):
+        valid = {'identifier': 'test-reminder', 'language': 'en', 'subject': 'New', 'body': 'New'}
+        report = import_bundle(self.make_bundle([
+            valid,
+            dict(valid, identifier='test-unknown'),
+            dict(valid, language='de'),
+            dict(valid, body='{unknown}'),
+            {'identifier': 'test-reminder'},
+        ]), batch_size=2)
+        self.assertEqual([type(error) for _line, error in report.errors], [
+            UnknownMailTemplateIdentifier, UnknownLanguage, UnknownToken, InvalidMailTemplateBundle,
+        ])
+        self.assertEqual([line for line, _error in report.errors], [3, 4, 5, 6])
+        # Nothing is written
+        self.assertEqual(MailTemplate.objects.get(identifier='test-reminder', language='en').subject,
+                         'test-reminder en {token}')
+
+    def test_duplicates_and_long_subjects_are_reported(self):
+        valid = {'identifier': 'test-reminder', 'language': 'en', 'subject': 'New', 'body': 'New'}
+        report = import_bundle(self.make_bundle([
+            valid,
+            dict(valid, subject='x' * 256),
+            dict(valid, subject='Other'),
+            dict(valid, language='fr-be'),
+        ]), batch_size=10)
+        self.assertEqual([line for line, _error in report.errors], [3, 4])
+        self.assertIn('duplicate', str(report.errors[1][1]))
+        self.assertEqual(MailTemplate.objects.get(identifier='test-reminder', language='en').version, 1)
+
+    def test_dry_run(self):
+        rows = [{'identifier': 'test-reminder', 'language': 'en', 'subject': 'New', 'body': 'New'}]
+        report = import_bundle(self.make_bundle(rows), dry_run=True)
+        self.assertEqual(report.updated, 1)
+        self.assertEqual(MailTemplate.objects.get(identifier='test-reminder', language='en').version, 1)
+
+    def test_invalid_bundle(self):
+        with self.assertRaises(InvalidMailTemplateBundle):
+            import_bundle(self.make_bundle([], header={'format': 'other'}))
+        with self.assertRaises(InvalidMailTemplateBundle):
+            import_bundle(self.make_bundle([], header={'format': 'osis_mail_template', 'version': 99}))
+        truncated = self.export().read()[:-20]
+        with self.assertRaises(InvalidMailTemplateBundle):
+            import_bundle(io.BytesIO(truncated))
+
+    def test_commands(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'templates.jsonl.gz')
+            output = StringIO()
+            call_command('export_mail_templates', path, stdout=output)
+            self.assertIn('4 mail template(s) exported', output.getvalue())
+            MailTemplate.objects.filter(identifier='test-reminder').delete()
+
+            output = StringIO()
+            call_command('import_mail_templates', path, stdout=output)
+            self.assertIn('2 inserted, 0 updated, 2 unchanged', output.getvalue())
+
+            with open(path, 'wb') as bundle:
+                bundle.write(self.make_bundle([{'identifier': 'test-unknown'}]).read())
+            with self.assertRaises(CommandError):
+                call_command('import_mail_templates', path, stdout=StringIO(), stderr=StringIO())
@@ -60,3 +60,17 @@ class MailTemplateModelTest(TestCase):
         }, instance=self.instance)
         self.assertFalse(form.is_valid())
         self.assertIn('body', form.errors)
+
+    @patch('osis_mail_template.templates')
+    def test_normalize_body(self, tpl):
+        tpl.get_example_values.return_value = {
+            'token': 'example value',
+        }
+
+        form = MailTemplateConfigureForm(data={
+            'subject': 'This is a test subject {token}',
+            'body': '<p><span>This is   a test body</span> <span style="color: red"></span>{token}</p>'
+        }, instance=self.instance, normalize=True)
+        self.assertTrue(form.is_valid(), form.errors)
+        self.assertEqual(form.cleaned_data['body'], '<p>This is a test body {token}</p>')
+        self.assertEqual(form.saved_bytes, 47)
@@ -0,0 +1,132 @@
+# ##############################################################################
+#
+#    OSIS stands for Open Student Information System. It's an application
+#    designed to manage the core business of higher education institutions,
+#    such as universities, faculties, institutes and professional schools.
+#    The core business involves the administration of students, teachers,
+#    courses, programs and so on.
+#
+#    Copyright (C) 2015-2021 Université catholique de Louvain (http://www.uclouvain.be)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    A copy of this license - GNU General Public License - is available
+#    at the root of the source code of this program.  If not,
+#    see http://www.gnu.org/licenses/.
+#
+# ##############################################################################
+import os
+from io import StringIO
+from unittest import skipUnless
+from unittest.mock import patch
+
+from django.core.management import call_command
+from django.test import SimpleTestCase, TransactionTestCase
+
+from osis_mail_template.loadtest import LoadTestReport, load_test
+from osis_mail_template.models import MailTemplate
+from osis_mail_template.rendering import engine
+
+
+class LoadTestReportTestCase(SimpleTestCase):
+    def test_percentiles(self):
+        report = LoadTestReport()
+        report.add([i / 1000 for i in range(100, 0, -1)], {}, 200)
+        report.elapsed = 2
+        self.assertEqual(report.percentile(50), 0.05)
+        self.assertEqual(report.percentile(99), 0.099)
+        self.assertEqual(report.percentile(100), 0.1)
+        self.assertEqual(report.throughput, 50)
+        self.assertEqual(report.queries_per_message, 2)
+        self.assertIn('p95 95.00ms', str(report))
+
+    def test_empty_report(self):
+        report = LoadTestReport()
+        self.assertEqual(report.percentile(50), 0)
+        self.assertEqual(report.throughput, 0)
+
+
+# Concurrent callers use their own database connection, they must see committed data
+class LoadTestTestCase(TransactionTestCase):
+    def setUp(self):
+        engine.clear()
+        for identifier in ['first-identifier', 'second-identifier']:
+            for language in ['en', 'fr-be']:
+                MailTemplate.objects.create(
+                    identifier=identifier,
+                    language=language,
+                    subject='Subject {token}',
+                    body='<p>Body {token}</p>',
+                )
+        self.jobs = [
+            (identifier, language, {'token': 'value'}, ['to@example.com'])
+            for identifier, language in MailTemplate.objects.values_list('identifier', 'language')
+        ]
+
+    def test_threads(self):
+        report = load_test(self.jobs, requests=20, concurrency=4)
+        self.assertEqual(report.requests, 20)
+        self.assertEqual(report.messages, 20)
+        self.assertFalse(report.errors)
+        # Each message checks the version of its mail template
+        self.assertGreaterEqual(report.queries, 20)
+        self.assertLessEqual(report.percentile(50), report.percentile(99))
+
+    def test_async_tasks(self):
+        report = load_test(self.jobs, requests=20, concurrency=4, model='async')
+        self.assertEqual(report.requests, 20)
+        self.assertFalse(report.errors)
+
+    @skipUnless(hasattr(os, 'fork'), "Processes are forked")
+    def test_processes(self):
+        report = load_test(self.jobs, requests=20, concurrency=2, model='process')
+        self.assertEqual(report.requests, 20)
+        self.assertFalse(report.errors)
+
+    def test_bulk(self):
+        report = load_test(self.jobs, requests=4, concurrency=2, mode='bulk', batch_size=10)
+        self.assertEqual(report.requests, 4)
+        self.assertEqual(report.messages, 40)
+        self.assertFalse(report.errors)
+        self.assertLess(report.queries_per_message, 1)
+
+    def test_errors_are_counted(self):
+        report = load_test([('unknown', 'en', {}, ['to@example.com'])], requests=3, concurrency=1)
+        self.assertEqual(report.errors, {'UnknownMailTemplateIdentifier': 3})
+
+    def test_bulk_errors_are_counted(self):
+        MailTemplate.objects.create(identifier='number-identifier', language='en', subject='{token:d}', body='')
+        jobs = [('number-identifier', 'en', {'token': 'value'}, ['to@example.com'])]
+        report = load_test(jobs, requests=2, concurrency=2, mode='bulk', batch_size=3)
+        self.assertEqual(report.requests, 2)
+        self.assertEqual(report.errors, {'ValueError': 6})
+
+    def test_thread_failure_is_raised(self):
+        with patch('osis_mail_template.loadtest._run_share', side_effect=RuntimeError('failed')):
+            with self.assertRaisesMessage(RuntimeError, 'failed'):
+                load_test(self.jobs, requests=2, concurrency=2)
+
+    def test_unknown_model(self):
+        with self.assertRaises(ValueError):
+            load_test(self.jobs, model='greenlet')
+
+    @patch('osis_mail_template.templates')
+    def test_command(self, tpl):
+        tpl.get_mail_templates.return_value = {'first-identifier': None, 'second-identifier': None}
+        tpl.get_example_values.return_value = {'token': 'example'}
+        output = StringIO()
+        call_command(
+            'load_test_mail_templates', '--requests=8', '--concurrency=2', '--batch-size=4', '--cache=default',
+            stdout=output,
+        )
+        for run in ['baseline', 'bulk', 'baseline+default', 'bulk+default']:
+            self.assertIn(run, output.getvalue())
+        self.assertIn('over 4 mail templates', output.getvalue())
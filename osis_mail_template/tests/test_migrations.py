@@ -0,0 +1,80 @@
+# ##############################################################################
+#
+#    OSIS stands for Open Student Information System. It's an application
+#    designed to manage the core business of higher education institutions,
+#    such as universities, faculties, institutes and professional schools.
+#    The core business involves the administration of students, teachers,
+#    courses, programs and so on.
+#
+#    Copyright (C) 2015-2021 Université catholique de Louvain (http://www.uclouvain.be)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    A copy of this license - GNU General Public License - is available
+#    at the root of the source code of this program.  If not,
+#    see http://www.gnu.org/licenses/.
+#
+# ##############################################################################
+from unittest.mock import patch
+
+from django.db import connection
+from django.db.migrations.loader import MigrationLoader
+from django.test import TestCase
+
+from osis_mail_template import MailTemplateMigration
+from osis_mail_template.models import MailTemplate, MailTemplateRevision, compute_content_hash
+
+SUBJECTS = {'en': 'Subject {token}', 'fr-be': 'Sujet {token}'}
+CONTENTS = {'en': '<p>Body {token}</p>', 'fr-be': '<p>Corps {token}</p>'}
+
+
+@patch('osis_mail_template.templates')
+class MailTemplateMigrationTestCase(TestCase):
+    IDENTIFIER = 'test-migration'
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # Migrations run with historical models, without the custom save()
+        loader = MigrationLoader(connection)
+        cls.apps = loader.project_state(loader.graph.leaf_nodes('osis_mail_template')).apps
+
+    def migrate(self, subjects=SUBJECTS, contents=CONTENTS):
+        with self.assertLogs('osis_mail_template.contrib.migrations') as logs:
+            MailTemplateMigration(self.IDENTIFIER, subjects, contents).code(self.apps, None)
+        return logs.output[-1]
+
+    def test_inserts_then_skips_unchanged_rows(self, tpl):
+        tpl.get_example_values.return_value = {'token': 'value'}
+        self.assertIn('2 inserted, 0 updated, 0 unchanged', self.migrate())
+        template = MailTemplate.objects.get(identifier=self.IDENTIFIER, language='en')
+        self.assertEqual(template.content_hash, compute_content_hash(SUBJECTS['en'], CONTENTS['en']))
+
+        # A single query to compare the content of all languages
+        with self.assertNumQueries(1):
+            self.assertIn('0 inserted, 0 updated, 2 unchanged', self.migrate())
+        self.assertEqual(MailTemplateRevision.objects.count(), 2)
+
+    def test_updates_only_changed_rows(self, tpl):
+        tpl.get_example_values.return_value = {'token': 'value'}
+        self.migrate()
+        self.assertIn('0 inserted, 1 updated, 1 unchanged', self.migrate(contents=dict(CONTENTS, en='<p>New</p>')))
+        template = MailTemplate.objects.get(identifier=self.IDENTIFIER, language='en')
+        self.assertEqual((template.body, template.version), ('<p>New</p>', 2))
+        self.assertEqual(template.content_hash, compute_content_hash(SUBJECTS['en'], '<p>New</p>'))
+        self.assertEqual(MailTemplate.objects.get(identifier=self.IDENTIFIER, language='fr-be').version, 1)
+        self.assertEqual(MailTemplateRevision.objects.filter(identifier=self.IDENTIFIER, language='en').count(), 2)
+
+    def test_content_hash_is_kept_by_save(self, tpl):
+        template = MailTemplate.objects.create(identifier=self.IDENTIFIER, language='en', subject='a', body='b')
+        template.body = 'c'
+        template.save()
+        self.assertEqual(MailTemplate.objects.get().content_hash, compute_content_hash('a', 'c'))
@@ -26,15 +26,21 @@
 from unittest.mock import patch
 
 from django.core.exceptions import ValidationError
-from django.test import SimpleTestCase, TestCase
+from django.db import DatabaseError, connection, transaction
+from django.db.migrations.loader import MigrationLoader
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import translation
 from django.utils.translation import gettext_lazy as _
 
+from osis_mail_template.apps import sync_mail_template_tags
 from osis_mail_template.exceptions import (
     UnknownMailTemplateIdentifier,
     UnknownLanguage,
     EmptyMailTemplateContent,
 )
-from osis_mail_template.models import MailTemplate
+from osis_mail_template.models import MailTemplate, MailTemplateRevision, get_language_chain
+from osis_mail_template.rendering import CompiledMailTemplate, compute_content_hash, engine
 
 
 class MailTemplateModelTest(SimpleTestCase):
@@ -65,6 +71,29 @@ class MailTemplateModelTest(SimpleTestCase):
             }
             self.assertEqual(self.template.render_subject(), 'This is a test subject example value')
 
+    def test_example_renders_are_shared(self):
+        with patch('osis_mail_template.templates') as tpl:
+            tpl.get_example_values.return_value = {'token': 'example value'}
+            other = MailTemplate(identifier=self.template.identifier, language='en',
+                                 subject=self.template.subject, body=self.template.body)
+            self.assertEqual(self.template.render_examples(), (
+                'This is a test subject example value',
+                '<p>This is a test body example value</p>',
+                'This is a test body example value\n\n',
+            ))
+            self.assertEqual(other.body_as_html(), '<p>This is a test body example value</p>')
+            self.assertEqual(other.body_as_plain(), 'This is a test body example value\n\n')
+            tpl.get_example_values.assert_called_once_with(self.template.identifier)
+
+            # Changed content is rendered again
+            other.body = '<p>Changed {token}</p>'
+            self.assertEqual(other.body_as_html(), '<p>Changed example value</p>')
+
+            # As are all mail templates once the registered templates changed
+            tpl.generation = 'changed'
+            tpl.get_example_values.return_value = {'token': 'new example'}
+            self.assertEqual(self.template.render_subject(), 'This is a test subject new example')
+
     def test_rendering_body_html(self):
         self.assertEqual(self.template.body_as_html({
             'token': 'example',
@@ -116,3 +145,244 @@ class MailTemplateManagerTest(TestCase):
     def test_get_non_existant_content_for_language(self):
         with self.assertRaises(EmptyMailTemplateContent):
             MailTemplate.objects.get_mail_template(self.TEMPLATE_ID, 'fr-be')
+
+    def test_languages_follow_settings(self):
+        with override_settings(LANGUAGES=[('de', 'German')]):
+            with self.assertRaises(EmptyMailTemplateContent):
+                MailTemplate.objects.get_mail_template(self.TEMPLATE_ID, 'de')
+        with self.assertRaises(UnknownLanguage):
+            MailTemplate.objects.get_mail_template(self.TEMPLATE_ID, 'de')
+
+
+class MailTemplateVersionTest(TestCase):
+    TEMPLATE_ID = 'test-mail-template'
+
+    def setUp(self):
+        engine.clear()
+        self.template = MailTemplate.objects.create(
+            identifier=self.TEMPLATE_ID,
+            language='en',
+            subject='This is a test subject {token}',
+            body='<p>This is a test body {token}</p>',
+        )
+
+    def test_version_is_bumped_on_change(self):
+        self.assertEqual(self.template.version, 1)
+        self.template.save()
+        self.assertEqual(self.template.version, 1)
+        self.template.subject = 'This is another subject'
+        self.template.save()
+        self.assertEqual(self.template.version, 2)
+        self.assertEqual(
+            list(MailTemplateRevision.objects.values_list('version', 'subject')),
+            [(1, 'This is a test subject {token}'), (2, 'This is another subject')],
+        )
+
+    def test_version_is_bumped_on_change_of_fetched_instance(self):
+        template = MailTemplate.objects.get(pk=self.template.pk)
+        template.save()
+        self.assertEqual(template.version, 1)
+        template.body = 'Another body'
+        template.save()
+        self.assertEqual(template.version, 2)
+
+    def test_version_is_bumped_when_saving_update_fields(self):
+        self.template.subject = 'This is another subject'
+        self.template.save(update_fields=['subject'])
+        self.assertEqual(self.template.version, 2)
+        self.template.refresh_from_db()
+        self.assertEqual(self.template.version, 2)
+        self.assertEqual(self.template.content_hash, compute_content_hash(self.template.subject, self.template.body))
+        self.assertEqual(MailTemplateRevision.objects.latest('version').subject, 'This is another subject')
+
+    def test_version_keeps_increasing_when_created_again(self):
+        self.template.delete()
+        template = MailTemplate.objects.create(identifier=self.TEMPLATE_ID, language='en', subject='', body='')
+        self.assertEqual(template.version, 2)
+
+    def test_get_versions(self):
+        with self.assertNumQueries(1):
+            versions = MailTemplate.objects.get_versions([(self.TEMPLATE_ID, 'en'), (self.TEMPLATE_ID, 'fr-be')])
+        self.assertEqual(versions, {(self.TEMPLATE_ID, 'en'): (1, self.template.content_hash)})
+
+    def test_get_compiled_templates(self):
+        pairs = [(self.TEMPLATE_ID, 'en')]
+        with self.assertNumQueries(2):
+            compiled = MailTemplate.objects.get_compiled_templates(pairs)[self.TEMPLATE_ID, 'en']
+        self.assertIsInstance(compiled, CompiledMailTemplate)
+        with self.assertNumQueries(1):
+            self.assertIs(MailTemplate.objects.get_compiled_templates(pairs)[self.TEMPLATE_ID, 'en'], compiled)
+
+        self.template.subject = 'Changed'
+        self.template.save()
+        with self.assertNumQueries(2):
+            compiled = MailTemplate.objects.get_compiled_templates(pairs)[self.TEMPLATE_ID, 'en']
+        self.assertEqual(compiled.version, 2)
+        self.assertEqual(compiled.subject.source, 'Changed')
+
+    def test_get_compiled_templates_after_rollback(self):
+        # The version of a rolled back save is given to the next one, with another content
+        pairs = [(self.TEMPLATE_ID, 'fr-be')]
+        with self.assertRaises(DatabaseError), transaction.atomic():
+            MailTemplate.objects.create(identifier=self.TEMPLATE_ID, language='fr-be', subject='First', body='First')
+            self.assertEqual(MailTemplate.objects.get_compiled_template(*pairs[0]).subject.source, 'First')
+            raise DatabaseError
+        template = MailTemplate.objects.create(identifier=self.TEMPLATE_ID, language='fr-be', subject='Second', body='')
+        self.assertEqual(template.version, 1)
+        self.assertEqual(MailTemplate.objects.get_compiled_template(*pairs[0]).subject.source, 'Second')
+
+    def test_get_compiled_templates_errors(self):
+        with patch('osis_mail_template.templates') as tpl:
+            tpl.get_mail_templates.return_value = {self.TEMPLATE_ID: None}
+            compiled_templates = MailTemplate.objects.get_compiled_templates([
+                (self.TEMPLATE_ID, 'de'),
+                (self.TEMPLATE_ID, 'fr-be'),
+                ('unknown', 'en'),
+            ])
+        self.assertIsInstance(compiled_templates[self.TEMPLATE_ID, 'de'], UnknownLanguage)
+        self.assertIsInstance(compiled_templates[self.TEMPLATE_ID, 'fr-be'], EmptyMailTemplateContent)
+        self.assertIsInstance(compiled_templates['unknown', 'en'], UnknownMailTemplateIdentifier)
+
+
+class MailTemplateLanguageFallbackTest(TestCase):
+    TEMPLATE_ID = 'test-mail-template'
+
+    def setUp(self):
+        engine.clear()
+        self.template = MailTemplate.objects.create(
+            identifier=self.TEMPLATE_ID,
+            language='en',
+            subject='This is a test subject {token}',
+            body='<p>This is a test body {token}</p>',
+        )
+
+    def test_language_chain(self):
+        self.assertEqual(get_language_chain('fr-be'), ('fr-be', 'en'))
+        self.assertEqual(get_language_chain('fr_BE'), ('fr-be', 'en'))
+        self.assertEqual(get_language_chain('fr'), ('fr-be', 'en'))
+        self.assertEqual(get_language_chain('en-us'), ('en',))
+        self.assertEqual(get_language_chain('de'), ('en',))
+        with override_settings(LANGUAGE_CODE='nl'):
+            self.assertEqual(get_language_chain('de'), ())
+
+    def test_get_compiled_templates_falls_back(self):
+        pairs = [(self.TEMPLATE_ID, 'fr'), (self.TEMPLATE_ID, 'fr_BE'), (self.TEMPLATE_ID, 'en'), ('unknown', 'fr')]
+        with patch('osis_mail_template.templates') as tpl:
+            tpl.get_mail_templates.return_value = {self.TEMPLATE_ID: None}
+            # All the languages of the chains are checked at once
+            with self.assertNumQueries(2):
+                compiled_templates = MailTemplate.objects.get_compiled_templates(pairs, fallback=True)
+        self.assertEqual(compiled_templates[self.TEMPLATE_ID, 'fr'].language, 'en')
+        self.assertIs(compiled_templates[self.TEMPLATE_ID, 'fr_BE'], compiled_templates[self.TEMPLATE_ID, 'en'])
+        self.assertIsInstance(compiled_templates['unknown', 'fr'], UnknownMailTemplateIdentifier)
+
+        MailTemplate.objects.create(
+            identifier=self.TEMPLATE_ID,
+            language='fr-be',
+            subject='Ceci est un sujet {token}',
+            body='<p>Ceci est un corps {token}</p>',
+        )
+        compiled = MailTemplate.objects.get_compiled_template(self.TEMPLATE_ID, 'fr', fallback=True)
+        self.assertEqual(compiled.language, 'fr-be')
+
+    @override_settings(OSIS_MAIL_TEMPLATE_LANGUAGE_FALLBACK=True)
+    def test_fallback_from_setting(self):
+        self.assertEqual(MailTemplate.objects.get_mail_template(self.TEMPLATE_ID, 'fr-BE').language, 'en')
+        self.assertEqual(MailTemplate.objects.get_compiled_template(self.TEMPLATE_ID, 'de').language, 'en')
+        with self.assertRaises(UnknownLanguage):
+            MailTemplate.objects.get_mail_template(self.TEMPLATE_ID, 'de', fallback=False)
+
+
+class MailTemplateQueryPlanTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for i in range(20):
+            for language in ['en', 'fr-be']:
+                MailTemplate.objects.create(
+                    identifier='test-identifier-{}'.format(i),
+                    language=language,
+                    subject='Subject {token}',
+                    body='<p>Body {token}</p>',
+                )
+
+    def setUp(self):
+        engine.clear()
+        if connection.vendor == 'postgresql':
+            # Tables are too small for the planner to prefer indexes otherwise
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+
+    def assertQueriesUseIndexes(self, queries):
+        explain = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN '
+        for query in queries:
+            with connection.cursor() as cursor:
+                cursor.execute(explain + query['sql'])
+                plan = '\n'.join(' '.join(str(column) for column in row) for row in cursor.fetchall())
+            with self.subTest(sql=query['sql']):
+                self.assertNotIn('Seq Scan', plan)
+                self.assertNotRegex(plan, r'\bSCAN [\w]+$')
+                self.assertRegex(plan, '(?i)index')
+
+    def assertHotQuery(self, method, *args, num_queries=1):
+        with CaptureQueriesContext(connection) as context:
+            method(*args)
+        self.assertEqual(len(context.captured_queries), num_queries)
+        self.assertQueriesUseIndexes(context.captured_queries)
+
+    def test_get_by_id(self):
+        self.assertHotQuery(MailTemplate.objects.get_by_id, 'test-identifier-1')
+
+    def test_get_mail_template(self):
+        self.assertHotQuery(MailTemplate.objects.get_mail_template, 'test-identifier-1', 'en')
+
+    def test_get_versions(self):
+        self.assertHotQuery(
+            MailTemplate.objects.get_versions, [('test-identifier-1', 'en'), ('test-identifier-2', 'en')],
+        )
+
+    def test_get_compiled_templates(self):
+        pairs = [('test-identifier-1', 'en'), ('test-identifier-2', 'fr-be')]
+        self.assertHotQuery(MailTemplate.objects.get_compiled_templates, pairs, num_queries=2)
+        # Once compiled, only the versions are checked
+        self.assertHotQuery(MailTemplate.objects.get_compiled_templates, pairs)
+
+    def test_filter_by_tag(self):
+        self.assertHotQuery(lambda: list(MailTemplate.objects.filter(tag='Test')))
+
+
+@patch('osis_mail_template.templates')
+class MailTemplateTagTest(TestCase):
+    def test_tag_is_copied_from_registry(self, tpl):
+        tpl.get_mail_templates.return_value = {'test-identifier': ('Description', [], 'Tag')}
+        template = MailTemplate.objects.create(identifier='test-identifier', language='en', subject='a', body='b')
+        self.assertEqual(template.tag, 'Tag')
+
+    def test_sync_tags(self, tpl):
+        tpl.get_mail_templates.return_value = {}
+        MailTemplate.objects.create(identifier='test-identifier', language='en', subject='a', body='b')
+        MailTemplate.objects.create(identifier='test-other', language='en', subject='a', body='b')
+        tpl.get_mail_templates.return_value = {
+            'test-identifier': ('Description', [], 'Tag'),
+            'test-other': ('Other description', [], ''),
+        }
+        self.assertEqual(MailTemplate.objects.sync_tags(), 1)
+        self.assertEqual(MailTemplate.objects.get(identifier='test-identifier').tag, 'Tag')
+        self.assertEqual(MailTemplate.objects.sync_tags(), 0)
+
+    def test_tag_does_not_depend_on_active_language(self, tpl):
+        tpl.get_mail_templates.return_value = {'test-identifier': ('Description', [], _("English"))}
+        with translation.override('fr-be'):
+            template = MailTemplate.objects.create(identifier='test-identifier', language='en', subject='a', body='b')
+        self.assertEqual(template.tag, 'English')
+
+    def test_tags_are_synced_in_migrated_database(self, tpl):
+        with patch.object(MailTemplate.objects, 'sync_tags') as sync_tags:
+            sync_mail_template_tags(sender=None, using='other')
+        sync_tags.assert_called_once_with(using='other')
+
+    def test_tags_are_not_synced_before_being_stored(self, tpl):
+        loader = MigrationLoader(connection)
+        apps = loader.project_state(('osis_mail_template', '0004_mail_template_content_hash')).apps
+        with patch.object(MailTemplate.objects, 'sync_tags') as sync_tags:
+            sync_mail_template_tags(sender=None, using='default', apps=apps)
+        sync_tags.assert_not_called()
@@ -0,0 +1,90 @@
+# ##############################################################################
+#
+#    OSIS stands for Open Student Information System. It's an application
+#    designed to manage the core business of higher education institutions,
+#    such as universities, faculties, institutes and professional schools.
+#    The core business involves the administration of students, teachers,
+#    courses, programs and so on.
+#
+#    Copyright (C) 2015-2021 Université catholique de Louvain (http://www.uclouvain.be)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    A copy of this license - GNU General Public License - is available
+#    at the root of the source code of this program.  If not,
+#    see http://www.gnu.org/licenses/.
+#
+# ##############################################################################
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase
+
+from osis_mail_template.models import MailTemplate
+from osis_mail_template.normalization import normalize_html, saved_bytes
+
+WORD_HTML = """<p class="MsoNormal" style="margin:0cm;mso-line-height-rule:exactly;margin: 0">
+<span style="font-family:Arial;color:red"><span style="font-family: Arial;  font-size:12pt">Dear   {first_name},</span>
+<span></span><span style="color:red">  </span><o:p></o:p></span></p>
+<!--[if gte mso 9]><xml><w:WordDocument></w:WordDocument></xml><![endif]-->"""
+
+
+class NormalizeHtmlTestCase(SimpleTestCase):
+    def test_word_markup(self):
+        self.assertEqual(
+            normalize_html(WORD_HTML),
+            '<p class="MsoNormal" style="margin: 0"> <span style="font-family: Arial; color: red">'
+            '<span style="font-size: 12pt">Dear {first_name},</span> </span></p>',
+        )
+
+    def test_keeps_tokens_links_and_preformatted_text(self):
+        html = '<p>Hello <b>{name}</b>,<br><a href="http://test.com/?a=1&amp;b={id}">link</a></p><pre>  a\n  b</pre>'
+        self.assertEqual(normalize_html(html), html)
+
+    def test_nested_styles_are_not_inherited_through_other_elements(self):
+        html = '<span style="color: red"><a href="#"><span style="color: red">link</span></a></span>'
+        self.assertEqual(normalize_html(html), html)
+
+    def test_keeps_non_breaking_spaces(self):
+        self.assertEqual(
+            normalize_html('\xa0<p>Bonjour\xa0!  10\xa0000  \u20ac</p>\xa0'),
+            '\xa0<p>Bonjour\xa0! 10\xa0000 \u20ac</p>\xa0',
+        )
+
+    def test_keeps_original_when_tokens_would_change(self):
+        html = '<p>{<span></span>token}</p>'
+        self.assertEqual(normalize_html(html), html)
+
+    def test_saved_bytes(self):
+        self.assertEqual(saved_bytes('<span>é</span>', 'é'), 13)
+
+
+class NormalizeMailTemplatesCommandTestCase(TestCase):
+    def setUp(self):
+        self.template = MailTemplate.objects.create(
+            identifier='test-identifier',
+            language='en',
+            subject='Subject',
+            body='<p><span>Body</span></p>',
+        )
+
+    def test_dry_run(self):
+        output = StringIO()
+        call_command('normalize_mail_templates', '--dry-run', stdout=output)
+        self.assertIn('1 mail template(s) normalized, 13 bytes saved (dry run)', output.getvalue())
+        self.template.refresh_from_db()
+        self.assertEqual(self.template.body, '<p><span>Body</span></p>')
+
+    def test_normalize(self):
+        call_command('normalize_mail_templates', 'test-identifier', stdout=StringIO())
+        self.template.refresh_from_db()
+        self.assertEqual(self.template.body, '<p>Body</p>')
+        self.assertEqual(self.template.version, 2)
@@ -0,0 +1,140 @@
+# ##############################################################################
+#
+#    OSIS stands for Open Student Information System. It's an application
+#    designed to manage the core business of higher education institutions,
+#    such as universities, faculties, institutes and professional schools.
+#    The core business involves the administration of students, teachers,
+#    courses, programs and so on.
+#
+#    Copyright (C) 2015-2021 Université catholique de Louvain (http://www.uclouvain.be)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    A copy of this license - GNU General Public License - is available
+#    at the root of the source code of this program.  If not,
+#    see http://www.gnu.org/licenses/.
+#
+# ##############################################################################
+import json
+import smtplib
+from datetime import timedelta
+from io import StringIO
+from unittest.mock import patch
+
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
+
+from osis_mail_template import sending
+from osis_mail_template.exceptions import UnknownLanguage
+from osis_mail_template.models import MailTemplate, OutboxMail
+from osis_mail_template.rendering import engine
+from osis_mail_template.sending import process_outbox
+from osis_mail_template.tests.utils import FakeConnection
+
+
+@patch('osis_mail_template.templates')
+class OutboxTestCase(TestCase):
+    TEMPLATE_ID = 'test-identifier'
+
+    def setUp(self):
+        engine.clear()
+        MailTemplate.objects.create(
+            identifier=self.TEMPLATE_ID,
+            language='en',
+            subject='This is a subject with {token}',
+            body='<p>This is a body with {token}</p>',
+        )
+        self.connection = FakeConnection()
+
+    def test_enqueue_resolves_lazy_tokens(self, tpl):
+        mail = OutboxMail.objects.enqueue(self.TEMPLATE_ID, 'fr-be', {'token': _("English")}, ['to@example.com'])
+        self.assertEqual(json.loads(mail.tokens), {'token': 'Anglais'})
+        self.assertEqual(mail.status, OutboxMail.PENDING)
+
+    def test_enqueue_unknown_language(self, tpl):
+        with self.assertRaises(UnknownLanguage):
+            OutboxMail.objects.enqueue(self.TEMPLATE_ID, 'de', {}, ['to@example.com'])
+
+    def test_process_outbox(self, tpl):
+        for i in range(3):
+            OutboxMail.objects.enqueue(self.TEMPLATE_ID, 'en', {'token': i}, ['to@example.com'])
+        report = process_outbox(batch_size=2, connection_factory=lambda: self.connection)
+        self.assertEqual(len(report.sent), 2)
+        self.assertEqual(OutboxMail.objects.filter(status=OutboxMail.SENT).count(), 2)
+
+        report = process_outbox(batch_size=2, connection_factory=lambda: self.connection)
+        self.assertEqual(len(report.sent), 1)
+        self.assertEqual(len(self.connection.sent), 3)
+        self.assertFalse(process_outbox(connection_factory=lambda: self.connection).sent)
+
+    def test_process_outbox_retries_until_max_attempts(self, tpl):
+        mail = OutboxMail.objects.enqueue(self.TEMPLATE_ID, 'en', {'token': 'value'}, ['to@example.com'])
+        self.connection.errors = [smtplib.SMTPDataError(421, 'Try again later')] * 10
+
+        process_outbox(max_attempts=2, connection_factory=lambda: self.connection, retry_delay=60)
+        mail.refresh_from_db()
+        self.assertEqual(mail.status, OutboxMail.PENDING)
+        self.assertEqual(mail.attempts, 1)
+        self.assertGreater(mail.next_attempt_at, timezone.now() + timedelta(seconds=50))
+
+        # Not retried before its next attempt
+        self.assertFalse(process_outbox(max_attempts=2, connection_factory=lambda: self.connection).failed)
+        OutboxMail.objects.update(next_attempt_at=timezone.now())
+
+        process_outbox(max_attempts=2, connection_factory=lambda: self.connection)
+        mail.refresh_from_db()
+        self.assertEqual(mail.status, OutboxMail.FAILED)
+        self.assertEqual(mail.attempts, 2)
+        self.assertIn('Try again later', mail.last_error)
+
+    def test_process_outbox_permanent_failure(self, tpl):
+        mail = OutboxMail.objects.enqueue(self.TEMPLATE_ID, 'en', {'token': 'value'}, ['to@example.com'])
+        self.connection.errors = [smtplib.SMTPDataError(550, 'Rejected')]
+        process_outbox(max_attempts=3, connection_factory=lambda: self.connection)
+        mail.refresh_from_db()
+        self.assertEqual(mail.status, OutboxMail.FAILED)
+        self.assertEqual(mail.attempts, 1)
+        self.assertIn('Rejected', mail.last_error)
+
+    def test_sent_mails_are_kept_when_a_batch_aborts(self, tpl):
+        first = OutboxMail.objects.enqueue(self.TEMPLATE_ID, 'en', {'token': 'first'}, ['to@example.com'])
+        second = OutboxMail.objects.enqueue(self.TEMPLATE_ID, 'en', {'token': 'second'}, ['to@example.com'])
+        deliver = sending._deliver
+
+        def deliver_or_abort(pool, messages, max_retries):
+            if messages[0][0].tokens['token'] == 'second':
+                raise SystemExit
+            return deliver(pool, messages, max_retries)
+
+        with patch('osis_mail_template.sending._deliver', deliver_or_abort), self.assertRaises(SystemExit):
+            process_outbox(pool_size=2, connection_factory=lambda: self.connection)
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual(first.status, OutboxMail.SENT)
+        # Claimed for the duration of the lease, then retried
+        self.assertEqual((second.status, second.attempts), (OutboxMail.PENDING, 1))
+        self.assertGreater(second.next_attempt_at, timezone.now())
+        self.assertFalse(process_outbox(connection_factory=lambda: self.connection).sent)
+
+    def test_process_outbox_rendering_error(self, tpl):
+        mail = OutboxMail.objects.enqueue('unknown-identifier', 'en', {}, ['to@example.com'])
+        process_outbox(connection_factory=lambda: self.connection)
+        mail.refresh_from_db()
+        self.assertEqual(mail.status, OutboxMail.FAILED)
+
+    def test_command(self, tpl):
+        OutboxMail.objects.enqueue(self.TEMPLATE_ID, 'en', {'token': 'value'}, ['to@example.com'])
+        with patch('osis_mail_template.sending.open_smtp_connection', return_value=self.connection):
+            call_command('process_mail_outbox', stdout=StringIO())
+        self.assertEqual(len(self.connection.sent), 1)
+        self.assertEqual(OutboxMail.objects.get().status, OutboxMail.SENT)
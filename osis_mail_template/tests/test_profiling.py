@@ -0,0 +1,94 @@
+# ##############################################################################
+#
+#    OSIS stands for Open Student Information System. It's an application
+#    designed to manage the core business of higher education institutions,
+#    such as universities, faculties, institutes and professional schools.
+#    The core business involves the administration of students, teachers,
+#    courses, programs and so on.
+#
+#    Copyright (C) 2015-2021 Université catholique de Louvain (http://www.uclouvain.be)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    A copy of this license - GNU General Public License - is available
+#    at the root of the source code of this program.  If not,
+#    see http://www.gnu.org/licenses/.
+#
+# ##############################################################################
+import tracemalloc
+from io import StringIO
+from unittest.mock import patch
+
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from osis_mail_template.models import MailTemplate
+from osis_mail_template.profiling import PHASES, find_outliers, markup_stats, profile_render
+
+WORD_HTML = (
+    '<p class="MsoNormal" style="margin:0"><span style="mso-ansi-language:FR"><span><b>Hello</b></span></span>'
+    '<o:p></o:p></p>'
+)
+
+
+class MarkupStatsTestCase(SimpleTestCase):
+    def test_markup_stats(self):
+        stats = markup_stats(WORD_HTML + '<br/><br>')
+        self.assertEqual(stats.tags, 7)
+        self.assertEqual(stats.max_depth, 4)
+        self.assertEqual(stats.styles, 2)
+        self.assertEqual(stats.word_markers, 3)
+
+    def test_find_outliers(self):
+        bodies = {str(i): '<p>Hello {token}</p>' for i in range(5)}
+        bodies['word'] = WORD_HTML * 20
+        outliers = find_outliers(bodies)
+        self.assertEqual(list(outliers), ['word'])
+        self.assertIn('styles 40 > 4', outliers['word'])
+
+
+class ProfileRenderTestCase(TestCase):
+    def setUp(self):
+        self.template = MailTemplate.objects.create(
+            identifier='test-identifier',
+            language='en',
+            subject='Subject {token}',
+            body='<p>Body {token}</p>',
+        )
+
+    def test_profile_render(self):
+        profiles = profile_render(self.template, {'token': 'value'}, iterations=3)
+        self.assertEqual([profile.name for profile in profiles], list(PHASES))
+        for profile in profiles:
+            self.assertEqual(len(profile.timings), 3)
+            self.assertGreater(profile.peak_bytes, 0)
+
+    @override_settings(OSIS_MAIL_TEMPLATE_ESCAPE_TOKENS=True)
+    def test_profile_render_escapes_tokens(self):
+        with patch('osis_mail_template.profiling.render_wrapper', return_value='') as render_wrapper:
+            profile_render(self.template, {'token': '<'}, iterations=1)
+        self.assertEqual(render_wrapper.call_args[0][4], '<p>Body &lt;</p>')
+
+    def test_profile_render_keeps_tracing(self):
+        tracemalloc.start()
+        self.addCleanup(tracemalloc.stop)
+        profiles = profile_render(self.template, {'token': 'value'}, iterations=1)
+        self.assertTrue(tracemalloc.is_tracing())
+        self.assertEqual(len(profiles), len(PHASES))
+
+    @patch('osis_mail_template.templates')
+    def test_command(self, tpl):
+        tpl.get_example_values.return_value = {'token': 'example'}
+        output = StringIO()
+        call_command('profile_mail_template', 'test-identifier', 'en', '--iterations=2', '--cprofile=5', stdout=output)
+        for phase in PHASES:
+            self.assertIn(phase, output.getvalue())
+        self.assertIn('function calls', output.getvalue())
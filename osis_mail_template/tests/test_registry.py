@@ -25,6 +25,8 @@
 # ##############################################################################
 
 from django.test import SimpleTestCase
+from django.utils import translation
+from django.utils.translation import gettext_lazy as _
 
 from osis_mail_template.exceptions import (
     DuplicateMailTemplateIdentifier,
@@ -60,6 +62,18 @@ class MailTemplateRegistryTest(SimpleTestCase):
             self.registry.unregister('bad-identifier')
         with self.assertRaises(UnknownMailTemplateIdentifier):
             self.registry.get_tokens('bad-identifier')
+        with self.assertRaises(UnknownMailTemplateIdentifier):
+            self.registry.get_example_values('bad-identifier')
+
+    def test_example_values_are_built_once(self):
+        self.registry.register(self.IDENTIFIER, "My awesome template", [Token('test-token', 'Example token', 'value')])
+        example_values = self.registry.get_example_values(self.IDENTIFIER)
+        self.assertEqual(example_values, {'test-token': 'value'})
+        # Modifying the values given doesn't change the ones built
+        example_values['test-token'] = 'modified'
+        self.assertEqual(self.registry.get_example_values(self.IDENTIFIER), {'test-token': 'value'})
+        self.registry.register('test-other-template', "My other template", [])
+        self.assertEqual(self.registry.get_example_values('test-other-template'), {})
 
     def test_get_list_by_tag_is_sorted(self):
         token = Token("test-token", "Example token", "value")
@@ -67,3 +81,29 @@ class MailTemplateRegistryTest(SimpleTestCase):
         self.registry.register('test-other-template', "My other template", [token], tag="First")
 
         self.assertListEqual(["First", "Last"], list(self.registry.get_list_by_tag().keys()))
+
+    def test_generation_and_content_hash_change_with_registered_templates(self):
+        token = Token("test-token", "Example token", "value")
+        initial_hash = self.registry.get_content_hash()
+        self.registry.register(self.IDENTIFIER, "My awesome template", [token])
+        self.assertEqual(self.registry.generation, 1)
+        registered_hash = self.registry.get_content_hash()
+        self.assertNotEqual(initial_hash, registered_hash)
+        self.assertIs(self.registry.get_list_by_tag(), self.registry.get_list_by_tag())
+
+        other_registry = MailTemplateRegistry()
+        other_registry.register(self.IDENTIFIER, "My awesome template", [token])
+        self.assertEqual(other_registry.get_content_hash(), registered_hash)
+
+        self.registry.unregister(self.IDENTIFIER)
+        self.assertEqual(self.registry.generation, 2)
+        self.assertEqual(self.registry.get_content_hash(), initial_hash)
+        self.assertEqual(self.registry.get_list_by_tag(), {})
+
+    def test_content_hash_does_not_depend_on_language(self):
+        self.registry.register(self.IDENTIFIER, _("English"), [])
+        with translation.override('fr-be'):
+            french_hash = self.registry.get_content_hash()
+        self.registry._snapshots = {}
+        with translation.override('en'):
+            self.assertEqual(self.registry.get_content_hash(), french_hash)
@@ -0,0 +1,345 @@
+# ##############################################################################
+#
+#    OSIS stands for Open Student Information System. It's an application
+#    designed to manage the core business of higher education institutions,
+#    such as universities, faculties, institutes and professional schools.
+#    The core business involves the administration of students, teachers,
+#    courses, programs and so on.
+#
+#    Copyright (C) 2015-2021 Université catholique de Louvain (http://www.uclouvain.be)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    A copy of this license - GNU General Public License - is available
+#    at the root of the source code of this program.  If not,
+#    see http://www.gnu.org/licenses/.
+#
+# ##############################################################################
+import threading
+from email import message_from_bytes, policy
+from io import BytesIO
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from django.conf import settings
+from django.test import SimpleTestCase, override_settings
+from django.utils import translation
+from django.utils.functional import lazy
+from django.utils.html import conditional_escape, escape
+from django.utils.safestring import mark_safe
+from django.utils.translation import gettext, gettext_lazy as _
+
+from osis_mail_template.models import MailTemplate
+from osis_mail_template.rendering import (
+    CompiledFormat,
+    LazyTokenResolver,
+    MailRenderEngine,
+    MissingTokenDict,
+    escape_token_value,
+    iter_html_chunks_to_text,
+    _slow_plain_text,
+    strip_html_to_text,
+    transform_html_chunks_to_text,
+    transform_html_to_text,
+)
+
+FORMAT_STRINGS = [
+    'No token at all',
+    'Hello {first_name} {last_name}, {first_name}!',
+    'Escaped {{braces}} and {token}}}',
+    'Attribute {person.name} and item {grades[0]}',
+    'Conversion {token!r} and spec {amount:>8.2f}',
+    'Nested spec {token:{width}}',
+    'Missing {unknown}',
+]
+TOKENS = {
+    'first_name': 'John',
+    'last_name': 'Doe',
+    'token': 'value',
+    'person': SimpleNamespace(name='Jane'),
+    'grades': [18, 12],
+    'amount': 12.5,
+    'width': 10,
+}
+
+
+def message_parts(msg):
+    return [msg['Subject'], msg['To']] + [part.get_payload(decode=True) for part in msg.iter_parts()]
+
+
+class CompiledFormatTestCase(SimpleTestCase):
+    def test_renders_as_format_map(self):
+        for source in FORMAT_STRINGS:
+            with self.subTest(source=source):
+                self.assertEqual(CompiledFormat(source).render(TOKENS), source.format_map(MissingTokenDict(**TOKENS)))
+
+    def test_renders_by_pieces(self):
+        for source in FORMAT_STRINGS:
+            with self.subTest(source=source):
+                self.assertEqual(
+                    ''.join(CompiledFormat(source).iter_render(TOKENS)), CompiledFormat(source).render(TOKENS),
+                )
+
+    def test_renders_missing_tokens(self):
+        self.assertEqual(CompiledFormat('Hello {first_name}').render({}), 'Hello TOKEN_first_name_UNDEFINED')
+
+    def test_names(self):
+        self.assertEqual(CompiledFormat('{b} {a.attr} {b}').names, ('b', 'a'))
+
+    def test_malformed_string_raises_at_rendering(self):
+        with self.assertRaises(ValueError):
+            CompiledFormat('Unclosed {token').render(TOKENS)
+
+    def test_renders_lazy_tokens(self):
+        self.assertEqual(CompiledFormat('{lang}').render({'lang': _("English")}), 'English')
+
+    def test_bound_rows_render_as_format_map(self):
+        orders = [tuple(TOKENS), ('token', 'first_name'), ('first_name', 'last_name', 'token'), ()]
+        for source in FORMAT_STRINGS:
+            for names in orders:
+                with self.subTest(source=source, names=names):
+                    row = [TOKENS[name] for name in names]
+                    try:
+                        expected = CompiledFormat(source).render(dict(zip(names, row)))
+                    except (AttributeError, TypeError, ValueError) as error:
+                        with self.assertRaises(type(error)):
+                            CompiledFormat(source).bind(names)(row)
+                    else:
+                        self.assertEqual(CompiledFormat(source).bind(names)(row), expected)
+
+
+class EscapingTestCase(SimpleTestCase):
+    UNSAFE = '<b>"Tom" & Jerry\'s</b>'
+    TEMPLATE = SimpleNamespace(identifier='test', language='en', version=1, subject='{token}', body='<p>{token}</p>')
+
+    def test_escape_token_value(self):
+        self.assertEqual(escape_token_value(self.UNSAFE), escape(self.UNSAFE))
+        plain = 'Plain value'
+        self.assertIs(escape_token_value(plain), plain)
+        self.assertEqual(escape_token_value(mark_safe(self.UNSAFE)), self.UNSAFE)
+        self.assertEqual(escape_token_value(12.5, '{0:>6.1f}'), '  12.5')
+        self.assertEqual(escape_token_value(mark_safe('<b>'), '{0!r}'), escape("'<b>'"))
+
+    def test_renders_escaped_values_as_escaping_them_first(self):
+        tokens = dict(TOKENS, first_name=self.UNSAFE, token=mark_safe('<i>safe</i>'), person=SimpleNamespace(name='<'))
+        escaped = {
+            name: conditional_escape(value) if isinstance(value, str) else value for name, value in tokens.items()
+        }
+        # Conversions are applied before escaping, see test_literals_are_not_escaped
+        for source in [source for source in FORMAT_STRINGS[:-2] if '!' not in source]:
+            with self.subTest(source=source):
+                expected = CompiledFormat(source).render(escaped)
+                if source.startswith('Attribute'):
+                    expected = expected.replace('<', '&lt;')
+                self.assertEqual(CompiledFormat(source).render(tokens, escape=True), expected)
+                self.assertEqual(''.join(CompiledFormat(source).iter_render(tokens, escape=True)), expected)
+                bound = CompiledFormat(source).bind(list(tokens), escape=True)
+                self.assertEqual(bound(list(tokens.values())), expected)
+
+    def test_bound_rows_render_escaped_values(self):
+        tokens = dict(TOKENS, first_name=self.UNSAFE, token=mark_safe('<i>safe</i>'), person=SimpleNamespace(name='<'))
+        orders = [tuple(tokens), ('token', 'first_name'), ('first_name', 'last_name', 'token'), ()]
+        for source in [source for source in FORMAT_STRINGS[:-2] if '!' not in source]:
+            for names in orders:
+                with self.subTest(source=source, names=names):
+                    row = [tokens[name] for name in names]
+                    try:
+                        expected = CompiledFormat(source).render(dict(zip(names, row)), escape=True)
+                    except (AttributeError, TypeError, ValueError) as error:
+                        with self.assertRaises(type(error)):
+                            CompiledFormat(source).bind(names, escape=True)(row)
+                    else:
+                        self.assertEqual(CompiledFormat(source).bind(names, escape=True)(row), expected)
+
+    def test_literals_are_not_escaped(self):
+        self.assertEqual(
+            CompiledFormat('<p title="{token}">{token!s:>3} &amp;</p>').render({'token': '&'}, escape=True),
+            '<p title="&amp;">  &amp; &amp;</p>',
+        )
+
+    def test_fallback_escapes_string_values(self):
+        # Format strings that can't be compiled have their string values escaped before being formatted
+        self.assertEqual(
+            CompiledFormat('{token:{width}}').render({'token': '<', 'width': 5}, escape=True),
+            '&lt; ',
+        )
+
+    def test_render_message_escapes_only_html_body(self):
+        tokens = {'token': 'Tom & Jerry'}
+        msg = MailRenderEngine().render_message(self.TEMPLATE, tokens, ['to@example.com'], escape=True)
+        self.assertEqual(msg['Subject'], 'Tom & Jerry')
+        text, html = [part.get_content() for part in msg.iter_parts()]
+        self.assertIn('Tom & Jerry', text)
+        self.assertIn('<p>Tom &amp; Jerry</p>', html)
+
+    @override_settings(OSIS_MAIL_TEMPLATE_ESCAPE_TOKENS=True)
+    def test_escaping_setting(self):
+        msg = MailRenderEngine().render_message(self.TEMPLATE, {'token': '<'}, ['to@example.com'])
+        self.assertIn('<p>&lt;</p>', list(msg.iter_parts())[1].get_content())
+
+
+class TransformHtmlChunksToTextTestCase(SimpleTestCase):
+    HTML = (
+        '<p>Hello  <b>John</b> &amp; <a href="http://test.com">Jane</a>,</p>\n<ul><li>first item</li>'
+        '<li>second item that is long enough to be wrapped after eighty characters, is it not?</li></ul>'
+        '<table><tr><td>cell &lt;1&gt;</td><td>cell 2</td></tr></table>'
+    )
+
+    def test_same_as_whole_document(self):
+        expected = transform_html_to_text(self.HTML)
+        for size in [1, 3, 7, 50]:
+            with self.subTest(size=size):
+                chunks = [self.HTML[i:i + size] for i in range(0, len(self.HTML), size)]
+                self.assertEqual(transform_html_chunks_to_text(chunks), expected)
+
+    def test_text_given_by_pieces(self):
+        html_content = self.HTML * 20
+        with patch('osis_mail_template.rendering.FEED_CHARACTERS', 100):
+            pieces = list(iter_html_chunks_to_text([html_content]))
+        self.assertGreater(len(pieces), 1)
+        self.assertEqual(''.join(pieces), transform_html_to_text(html_content))
+
+
+class RenderBudgetTestCase(SimpleTestCase):
+    def setUp(self):
+        self.engine = MailRenderEngine()
+        self.template = MailTemplate(
+            identifier='test-budget',
+            language='en',
+            version=1,
+            subject='Subject {token}',
+            body='<p>Hello &amp; welcome,</p><table><tr><td>{token}</td><td>B</td></tr></table><p>Bye<br>John</p>',
+        )
+        self.addCleanup(_slow_plain_text.clear)
+
+    def test_strip_html_to_text(self):
+        self.assertEqual(strip_html_to_text(self.template.body), 'Hello & welcome,\n{token} B\n\nBye\nJohn\n')
+
+    def test_timings(self):
+        rendered = self.engine.render(self.template, {'token': 'A'}, ['to@example.com'])
+        rendered.as_message()
+        self.assertEqual(set(rendered.timings), {'format_map', 'wrapper', 'html2text'})
+
+    @override_settings(OSIS_MAIL_TEMPLATE_RENDER_BUDGETS={'html2text': 0})
+    def test_slow_render_is_logged(self):
+        with self.assertLogs('osis_mail_template.rendering', 'WARNING') as logs:
+            plain_text = self.engine.render(self.template, {'token': 'A'}).plain_text
+        self.assertIn('test-budget (en): html2text took', logs.output[0])
+        self.assertEqual(plain_text, transform_html_to_text(self.template.body.format(token='A')))
+
+    @override_settings(OSIS_MAIL_TEMPLATE_RENDER_BUDGETS={'html2text': 0}, OSIS_MAIL_TEMPLATE_PLAIN_TEXT_FALLBACK=True)
+    def test_plain_text_fallback(self):
+        with self.assertLogs('osis_mail_template.rendering', 'WARNING'):
+            self.engine.render(self.template, {'token': 'A'}).plain_text
+            with patch('osis_mail_template.rendering.transform_html_to_text') as transform:
+                plain_text = self.engine.render(self.template, {'token': 'B'}).plain_text
+        transform.assert_not_called()
+        self.assertEqual(plain_text, 'Hello & welcome,\nB B\n\nBye\nJohn\n')
+
+        # Until the mail template changes
+        self.template.version = 2
+        with self.assertLogs('osis_mail_template.rendering', 'WARNING'):
+            with patch('osis_mail_template.rendering.transform_html_to_text', return_value='') as transform:
+                self.engine.render(self.template, {'token': 'C'}).plain_text
+        transform.assert_called_once()
+
+
+class LazyTokenResolverTestCase(SimpleTestCase):
+    def test_lazy_values_are_resolved_once_per_language(self):
+        calls = []
+
+        def translate_english():
+            calls.append(translation.get_language())
+            return gettext("English")
+
+        english = lazy(translate_english, str)()
+        resolver = LazyTokenResolver()
+        for _i in range(3):
+            self.assertEqual(resolver.resolve({'lang': english, 'other': 1}, 'fr-be'), {'lang': 'Anglais', 'other': 1})
+            self.assertEqual(resolver.resolve({'lang': english}, 'en'), {'lang': 'English'})
+        self.assertEqual(calls, ['fr-be', 'en'])
+
+    def test_tokens_without_lazy_values_are_not_copied(self):
+        tokens = {'token': 'value'}
+        self.assertIs(LazyTokenResolver().resolve(tokens, 'en'), tokens)
+
+
+class MailRenderEngineTestCase(SimpleTestCase):
+    def setUp(self):
+        self.engine = MailRenderEngine()
+        self.templates = [
+            MailTemplate(
+                identifier='test-identifier',
+                language=language,
+                subject='Subject {token} in {language}',
+                body='<p>Hello {name},</p><p>See <a href="http://test.com">{token}</a> in {language}</p>',
+            )
+            for language in ['en', 'fr-be']
+        ]
+
+    def render(self, template, i):
+        return self.engine.render_message(template, {
+            'token': i,
+            'name': 'Person {}'.format(i),
+            'language': _("English"),
+        }, ['to{}@example.com'.format(i)])
+
+    def test_compiled_template_is_cached_until_changed(self):
+        template = self.templates[0]
+        compiled = self.engine.compile(template)
+        self.assertIs(self.engine.compile(template), compiled)
+        template.subject = 'Another subject'
+        self.assertIsNot(self.engine.compile(template), compiled)
+
+    def test_render_to_stream(self):
+        for template in self.templates:
+            tokens = {'token': 'x' * 1000, 'name': 'Jane <Doe>', 'language': _("English")}
+            sink = BytesIO()
+            self.engine.render_to_stream(template, tokens, ['to@example.com'], sink)
+            streamed = message_from_bytes(sink.getvalue(), policy=policy.default)
+            self.assertEqual(
+                message_parts(streamed),
+                message_parts(self.engine.render_message(template, tokens, ['to@example.com'])),
+            )
+            self.assertEqual(streamed['From'], settings.DEFAULT_FROM_EMAIL)
+
+    def test_concurrent_rendering_matches_sequential_rendering(self):
+        expected = {
+            (template.language, i): message_parts(self.render(template, i))
+            for template in self.templates for i in range(20)
+        }
+        self.engine.clear()
+        results = {}
+        errors = []
+
+        def worker(thread_number):
+            try:
+                for _round in range(5):
+                    for template in self.templates:
+                        for i in range(thread_number, 20, 4):
+                            parts = message_parts(self.render(template, i))
+                            results.setdefault((template.language, i), []).append(parts)
+            except Exception as e:  # pragma: no cover
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(set(results), set(expected))
+        for key, renders in results.items():
+            for parts in renders:
+                self.assertEqual(parts, expected[key])
+        # Lazy translations are resolved in each thread's own language
+        self.assertIn(b'Anglais', expected[('fr-be', 0)][2])
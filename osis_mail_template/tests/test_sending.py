@@ -0,0 +1,322 @@
+# ##############################################################################
+#
+#    OSIS stands for Open Student Information System. It's an application
+#    designed to manage the core business of higher education institutions,
+#    such as universities, faculties, institutes and professional schools.
+#    The core business involves the administration of students, teachers,
+#    courses, programs and so on.
+#
+#    Copyright (C) 2015-2021 Université catholique de Louvain (http://www.uclouvain.be)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    A copy of this license - GNU General Public License - is available
+#    at the root of the source code of this program.  If not,
+#    see http://www.gnu.org/licenses/.
+#
+# ##############################################################################
+import smtplib
+import tempfile
+from pathlib import Path
+from unittest.mock import patch
+
+from django.test import TestCase
+from django.utils.translation import gettext_lazy as _
+
+from osis_mail_template.exceptions import (
+    EmptyMailTemplateContent,
+    PreflightError,
+    UnknownLanguage,
+    UnknownMailTemplateIdentifier,
+)
+from osis_mail_template.models import MailTemplate
+from osis_mail_template.rendering import engine
+from osis_mail_template.sending import (
+    FileConnection,
+    MailJob,
+    SMTPConnectionPool,
+    digest_jobs,
+    generate_emails_multi,
+    preflight,
+    send_emails,
+)
+from osis_mail_template.tests.utils import FakeConnection
+
+
+class SendEmailsTestCase(TestCase):
+    TEMPLATE_ID = 'test-identifier'
+
+    def setUp(self):
+        engine.clear()
+        MailTemplate.objects.create(
+            identifier=self.TEMPLATE_ID,
+            language='en',
+            subject='This is a subject with {token}',
+            body='<p>This is a body with {token}</p>',
+        )
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def make_jobs(self, count, language='en'):
+        return [
+            MailJob(self.TEMPLATE_ID, language, {'token': 'value {}'.format(i)}, ['to{}@example.com'.format(i)])
+            for i in range(count)
+        ]
+
+    def test_send_through_file_connections(self):
+        # One query per batch to check the template version, and one to fetch it
+        with self.assertNumQueries(4):
+            report = send_emails(
+                self.make_jobs(5),
+                pool_size=2,
+                batch_size=2,
+                connection_factory=lambda: FileConnection(self.directory.name),
+            )
+        self.assertEqual(len(report.sent), 5)
+        self.assertEqual(report.failed, [])
+        self.assertGreater(report.throughput, 0)
+        files = list(Path(self.directory.name).iterdir())
+        self.assertEqual(len(files), 5)
+        self.assertIn(b'This is a subject with value', files[0].read_bytes())
+
+    def test_rendering_errors_are_reported_per_job(self):
+        report = send_emails(
+            self.make_jobs(2) + self.make_jobs(1, language='de'),
+            connection_factory=lambda: FileConnection(self.directory.name),
+        )
+        self.assertEqual(len(report.sent), 2)
+        self.assertEqual(len(report.failed), 1)
+        self.assertIsInstance(report.failed[0][1], UnknownLanguage)
+
+    def test_mixed_languages_keep_jobs_order(self):
+        MailTemplate.objects.create(
+            identifier=self.TEMPLATE_ID,
+            language='fr-be',
+            subject='Ceci est un sujet avec {token}',
+            body='<p>Ceci est un corps avec {token}</p>',
+        )
+        connection = FakeConnection()
+        jobs = [
+            MailJob(self.TEMPLATE_ID, language, {'token': _("English")}, ['to@example.com'])
+            for language in ['en', 'fr-be', 'en']
+        ]
+        send_emails(jobs, pool_size=1, connection_factory=lambda: connection)
+        self.assertEqual([msg['Subject'] for msg, _recipients in connection.sent], [
+            'This is a subject with English',
+            'Ceci est un sujet avec Anglais',
+            'This is a subject with English',
+        ])
+
+    def test_connections_are_reused(self):
+        connections = []
+
+        def factory():
+            connections.append(FakeConnection())
+            return connections[-1]
+
+        report = send_emails(self.make_jobs(10), pool_size=2, batch_size=4, connection_factory=factory)
+        self.assertEqual(len(report.sent), 10)
+        self.assertLessEqual(len(connections), 2)
+        self.assertEqual(sum(len(c.sent) for c in connections), 10)
+
+    def test_transient_failure_is_retried_on_a_new_connection(self):
+        connections = [
+            FakeConnection(errors=[smtplib.SMTPServerDisconnected()]),
+            FakeConnection(),
+        ]
+        report = send_emails(self.make_jobs(1), pool_size=1, connection_factory=lambda: connections.pop(0))
+        self.assertEqual(len(report.sent), 1)
+        self.assertEqual(connections, [])
+
+    def test_permanent_failure_is_not_retried(self):
+        connection = FakeConnection(errors=[smtplib.SMTPRecipientsRefused({})])
+        report = send_emails(self.make_jobs(2), pool_size=1, connection_factory=lambda: connection)
+        self.assertEqual(len(report.sent), 1)
+        self.assertIsInstance(report.failed[0][1], smtplib.SMTPRecipientsRefused)
+
+    def test_unexpected_error_fails_its_message_only(self):
+        connection = FakeConnection(errors=[UnicodeEncodeError('ascii', 'é', 0, 1, 'not ascii')])
+        report = send_emails(self.make_jobs(3), pool_size=1, connection_factory=lambda: connection)
+        self.assertEqual(len(report.sent), 2)
+        self.assertIsInstance(report.failed[0][1], UnicodeEncodeError)
+
+
+@patch('osis_mail_template.templates')
+class GenerateEmailsMultiTestCase(TestCase):
+    def setUp(self):
+        engine.clear()
+        for identifier in ['test-reminder', 'test-rejection']:
+            for language in ['en', 'fr-be']:
+                MailTemplate.objects.create(
+                    identifier=identifier,
+                    language=language,
+                    subject='{} {} {{token}}'.format(identifier, language),
+                    body='<p>{token}</p>',
+                )
+
+    def test_generate_in_jobs_order(self, tpl):
+        tpl.get_mail_templates.return_value = {'test-reminder': None, 'test-rejection': None, 'test-empty': None}
+        jobs = [
+            MailJob('test-reminder', 'fr-be', {'token': 'a'}, ['a@example.com']),
+            MailJob('test-unknown', 'en', {}, ['b@example.com']),
+            MailJob('test-rejection', 'en', {'token': 'c'}, ['c@example.com']),
+            MailJob('test-empty', 'en', {}, ['d@example.com']),
+            MailJob('test-reminder', 'en', {'token': 'e'}, ['e@example.com']),
+        ]
+        # One query to check the versions of all mail templates, and one to fetch them
+        with self.assertNumQueries(2):
+            results = list(generate_emails_multi(jobs))
+        self.assertEqual([job for job, _result in results], jobs)
+        self.assertEqual(results[0][1]['Subject'], 'test-reminder fr-be a')
+        self.assertIsInstance(results[1][1], UnknownMailTemplateIdentifier)
+        self.assertEqual(results[2][1]['Subject'], 'test-rejection en c')
+        self.assertIsInstance(results[3][1], EmptyMailTemplateContent)
+        self.assertEqual(results[4][1]['Subject'], 'test-reminder en e')
+
+    def test_generate_by_batches(self, tpl):
+        tpl.get_mail_templates.return_value = {'test-reminder': None}
+        rendered = []
+
+        def jobs():
+            for i in range(5):
+                rendered.append(i)
+                yield MailJob('test-reminder', 'en', {'token': i}, ['to@example.com'])
+
+        results = generate_emails_multi(jobs(), batch_size=2)
+        self.assertEqual(rendered, [])
+        self.assertEqual(next(results)[1]['Subject'], 'test-reminder en 0')
+        # Only the first batch was consumed (and rendered)
+        self.assertEqual(rendered, [0, 1])
+        self.assertEqual(len(list(results)), 4)
+
+
+@patch('osis_mail_template.templates')
+class DigestJobsTestCase(TestCase):
+    def setUp(self):
+        engine.clear()
+        for identifier in ['test-reminder', 'test-rejection']:
+            MailTemplate.objects.create(
+                identifier=identifier,
+                language='en',
+                subject='{} {{course}}'.format(identifier),
+                body='<p>{token}</p>',
+            )
+        MailTemplate.objects.create(
+            identifier='test-digest',
+            language='en',
+            subject='{count} notifications',
+            body='<div>{items}</div>',
+        )
+
+    def test_jobs_are_merged_by_recipient_and_language(self, tpl):
+        tpl.get_mail_templates.return_value = {'test-reminder': None, 'test-rejection': None, 'test-digest': None}
+        regulation = b'%PDF'
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        rules = Path(directory.name) / 'rules.pdf'
+        rules.write_bytes(b'%PDF')
+        jobs = [
+            MailJob('test-reminder', 'en', {'course': 'LINFO1101', 'token': 'a'}, ['a@example.com'],
+                    attachments=[regulation, rules]),
+            MailJob('test-reminder', 'en', {'course': 'LINFO1102', 'token': 'b'}, ['b@example.com']),
+            MailJob('test-rejection', 'en', {'course': '<LINFO1103>', 'token': 'c'}, ['a@example.com'],
+                    attachments=[regulation, str(rules)]),
+            MailJob('test-reminder', 'de', {'course': 'LINFO1104', 'token': 'd'}, ['a@example.com']),
+            MailJob('test-reminder', 'de', {'course': 'LINFO1105', 'token': 'e'}, ['a@example.com']),
+        ]
+        # One query to check the versions of all the merged mail templates, and one to fetch them
+        with self.assertNumQueries(2):
+            digests = digest_jobs(jobs, 'test-digest')
+        self.assertEqual(len(digests), 4)
+        self.assertEqual(digests[0].identifier, 'test-digest')
+        self.assertEqual(digests[0].recipients, ['a@example.com'])
+        self.assertEqual(digests[0].tokens['count'], 2)
+        # The same content and the same path are attached once
+        self.assertEqual([attachment.content for attachment in digests[0].attachments], [regulation, None])
+        self.assertEqual(digests[0].attachments[1].path, str(rules))
+        self.assertIs(digests[1], jobs[1])
+        # Mails in an unknown language can't be merged, their error is reported when sending
+        self.assertEqual(digests[2:], jobs[3:])
+
+        msg = dict(generate_emails_multi(digests[:1]))[digests[0]]
+        self.assertEqual(msg['Subject'], '2 notifications')
+        self.assertIn(
+            '<div><h3>test-reminder LINFO1101</h3>\n<p>a</p>\n'
+            '<h3>test-rejection &lt;LINFO1103&gt;</h3>\n<p>c</p>\n</div>',
+            msg.get_body(('html',)).get_content(),
+        )
+
+    def test_send_emails_with_digest(self, tpl):
+        tpl.get_mail_templates.return_value = {'test-reminder': None, 'test-digest': None}
+        connection = FakeConnection()
+        jobs = [
+            MailJob('test-reminder', 'en', {'course': i, 'token': i}, ['a@example.com'])
+            for i in range(3)
+        ]
+        report = send_emails(jobs, connection_factory=lambda: connection, digest='test-digest')
+        self.assertEqual(len(report.sent), 1)
+        self.assertEqual([msg['Subject'] for msg, _recipients in connection.sent], ['3 notifications'])
+
+
+@patch('osis_mail_template.templates')
+class PreflightTestCase(TestCase):
+    def setUp(self):
+        engine.clear()
+        MailTemplate.objects.create(
+            identifier='test-reminder',
+            language='en',
+            subject='Reminder for {first_name}',
+            body='<p>Dear {first_name} {last_name},</p>',
+        )
+
+    def test_complete_report_in_one_query(self, tpl):
+        tpl.get_mail_templates.return_value = {'test-reminder': None}
+        pairs = [('test-reminder', 'en'), ('test-reminder', 'fr-be'), ('test-unknown', 'en'), ('test-reminder', 'de')]
+        with self.assertNumQueries(2):
+            report = preflight(pairs, token_names=['first_name'])
+        self.assertFalse(report.ok)
+        self.assertIsInstance(report.errors['test-reminder', 'fr-be'], EmptyMailTemplateContent)
+        self.assertIsInstance(report.errors['test-unknown', 'en'], UnknownMailTemplateIdentifier)
+        self.assertIsInstance(report.errors['test-reminder', 'de'], UnknownLanguage)
+        self.assertEqual(report.missing_tokens, {('test-reminder', 'en'): ['last_name']})
+        self.assertIn('test-reminder-en: missing tokens last_name', str(report))
+
+        # Compiled mail templates are kept for the send
+        with self.assertNumQueries(1):
+            self.assertTrue(preflight([('test-reminder', 'en')]).ok)
+
+    def test_send_emails_fails_fast(self, tpl):
+        tpl.get_mail_templates.return_value = {'test-reminder': None}
+        connection = FakeConnection()
+        jobs = [
+            MailJob('test-reminder', 'en', {'first_name': 'John', 'last_name': 'Doe'}, ['to@example.com']),
+            MailJob('test-reminder', 'en', {'first_name': 'Jane'}, ['to@example.com']),
+        ]
+        with self.assertRaises(PreflightError) as context:
+            send_emails(iter(jobs), connection_factory=lambda: connection, check=True)
+        self.assertEqual(context.exception.report.missing_tokens, {('test-reminder', 'en'): ['last_name']})
+        self.assertEqual(connection.sent, [])
+
+
+class SMTPConnectionPoolTestCase(TestCase):
+    def test_pool_reuses_released_connections(self):
+        pool = SMTPConnectionPool(size=2, connection_factory=FakeConnection)
+        first = pool.acquire()
+        second = pool.acquire()
+        self.assertIsNot(first, second)
+        pool.release(first)
+        self.assertIs(pool.acquire(), first)
+
+    def test_pool_replaces_discarded_connections(self):
+        pool = SMTPConnectionPool(size=1, connection_factory=FakeConnection)
+        first = pool.acquire()
+        pool.release(first, discard=True)
+        self.assertIsNot(pool.acquire(), first)
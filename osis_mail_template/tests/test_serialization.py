@@ -0,0 +1,112 @@
+# ##############################################################################
+#
+#    OSIS stands for Open Student Information System. It's an application
+#    designed to manage the core business of higher education institutions,
+#    such as universities, faculties, institutes and professional schools.
+#    The core business involves the administration of students, teachers,
+#    courses, programs and so on.
+#
+#    Copyright (C) 2015-2021 Université catholique de Louvain (http://www.uclouvain.be)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    A copy of this license - GNU General Public License - is available
+#    at the root of the source code of this program.  If not,
+#    see http://www.gnu.org/licenses/.
+#
+# ##############################################################################
+import email
+import re
+from email import policy
+
+from django.test import SimpleTestCase, override_settings
+
+from osis_mail_template.exceptions import InvalidSerializedMail
+from osis_mail_template.models import MailTemplate
+from osis_mail_template.rendering import engine
+from osis_mail_template.serialization import FORMAT_VERSION, MAGIC, dump_mail, load_mail
+
+
+def without_boundaries(data: bytes) -> bytes:
+    return re.sub(rb'===============\d+==', b'BOUNDARY', data)
+
+
+class SerializationTestCase(SimpleTestCase):
+    def setUp(self):
+        self.template = MailTemplate(
+            identifier='test-serialization',
+            language='en',
+            subject='Résumé of {name}',
+            body='<p>Hello {name},</p><p>Here is your résumé</p>',
+        )
+        self.rendered = engine.render(
+            self.template, {'name': 'Zoë'}, ['to@example.com', 'cc@example.com'], 'from@example.com',
+            attachments=[('resume.pdf', b'%PDF-1.4 ' + bytes(range(256)), 'application/pdf'), b'raw'],
+        )
+
+    def test_round_trip(self):
+        data = self.rendered.serialize()
+        self.assertTrue(data.startswith(MAGIC + bytes([FORMAT_VERSION])))
+        loaded = load_mail(data)
+        self.assertEqual(loaded.subject, 'Résumé of Zoë')
+        self.assertEqual(loaded.sender, 'from@example.com')
+        self.assertEqual(loaded.recipients, ['to@example.com', 'cc@example.com'])
+        self.assertEqual(loaded.plain_text, self.rendered.plain_text)
+        self.assertEqual(loaded.wrapped_html, self.rendered.wrapped_html)
+        self.assertEqual([(a.filename, a.mimetype) for a in loaded.attachments],
+                         [('resume.pdf', 'application/pdf'), (None, 'application/octet-stream')])
+        self.assertEqual(without_boundaries(loaded.as_message().as_bytes()),
+                         without_boundaries(self.rendered.as_message().as_bytes()))
+        self.assertIs(loaded.as_message(), loaded.as_message())
+        # A loaded mail can be serialized again
+        self.assertEqual(dump_mail(loaded), data)
+
+    def test_smaller_than_the_message(self):
+        self.assertLess(len(self.rendered.serialize()), len(self.rendered.as_message().as_bytes()))
+
+    @override_settings(DEFAULT_FROM_EMAIL='default@example.com')
+    def test_default_sender(self):
+        loaded = load_mail(engine.render(self.template, {'name': 'Zoë'}, ['to@example.com']).serialize())
+        self.assertEqual(loaded.sender, 'default@example.com')
+        self.assertEqual(loaded.attachments, [])
+
+    def test_smtp_bytes(self):
+        smtp_bytes = load_mail(self.rendered.serialize()).smtp_bytes
+        self.assertNotIn(b'\n', smtp_bytes.replace(b'\r\n', b''))
+        parsed = email.message_from_bytes(smtp_bytes, policy=policy.SMTP)
+        expected = self.rendered.as_message()
+        for header in ['Subject', 'From', 'To']:
+            self.assertEqual(parsed[header], expected[header])
+        for subtype in ['plain', 'html']:
+            self.assertEqual(parsed.get_body((subtype,)).get_content().splitlines(),
+                             expected.get_body((subtype,)).get_content().splitlines())
+
+        def attachments(msg):
+            return [
+                (part.get_filename(), part.get_content_type(), part.get_content()) for part in msg.iter_attachments()
+            ]
+
+        self.assertEqual(attachments(parsed), attachments(expected))
+        self.assertFalse([part.defects for part in parsed.walk() if part.defects])
+
+    def test_invalid_data(self):
+        data = self.rendered.serialize()
+        invalid = [
+            b'',
+            b'GIF89a' + data[6:],
+            MAGIC + bytes([FORMAT_VERSION + 1]) + data[4:],
+            data[:12],
+            data[:-1],
+            data + b'\x00',
+        ]
+        for value in invalid:
+            with self.subTest(value=value[:12]), self.assertRaises(InvalidSerializedMail):
+                load_mail(value)
@@ -0,0 +1,110 @@
+# ##############################################################################
+#
+#    OSIS stands for Open Student Information System. It's an application
+#    designed to manage the core business of higher education institutions,
+#    such as universities, faculties, institutes and professional schools.
+#    The core business involves the administration of students, teachers,
+#    courses, programs and so on.
+#
+#    Copyright (C) 2015-2021 Université catholique de Louvain (http://www.uclouvain.be)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    A copy of this license - GNU General Public License - is available
+#    at the root of the source code of this program.  If not,
+#    see http://www.gnu.org/licenses/.
+#
+# ##############################################################################
+from django.core.cache import cache, caches
+from django.test import TestCase, TransactionTestCase, override_settings
+
+from osis_mail_template import store
+from osis_mail_template.models import MailTemplate
+from osis_mail_template.rendering import CompiledMailTemplate, engine
+
+CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+PAIR = ('test-identifier', 'en')
+
+
+class CompiledMailTemplateSerializationTestCase(TestCase):
+    def test_dump_and_load(self):
+        compiled = CompiledMailTemplate('test-identifier', 'en', 3, 'Subject {token}', '<p>{token!r:>10} {{}}</p>')
+        loaded = CompiledMailTemplate.load(compiled.dump())
+        self.assertEqual(loaded.version, 3)
+        tokens = {'token': 'value'}
+        self.assertEqual(loaded.subject.render(tokens), compiled.subject.render(tokens))
+        self.assertEqual(loaded.body.render(tokens), compiled.body.render(tokens))
+
+
+@override_settings(OSIS_MAIL_TEMPLATE_CACHE='default', CACHES=CACHES)
+class SharedStoreTestCase(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        engine.clear()
+        self.template = MailTemplate.objects.create(
+            identifier=PAIR[0],
+            language=PAIR[1],
+            subject='This is a subject with {token}',
+            body='<p>This is a body with {token}</p>',
+        )
+
+    def test_lookup_order(self):
+        # From the database, then shared
+        with self.assertNumQueries(2):
+            MailTemplate.objects.get_compiled_template(*PAIR)
+
+        # Another process gets it from the shared cache
+        engine.clear()
+        with self.assertNumQueries(0):
+            compiled = MailTemplate.objects.get_compiled_template(*PAIR)
+        self.assertEqual(compiled.subject.render({'token': 'value'}), 'This is a subject with value')
+
+        # Then from its own memory
+        with self.assertNumQueries(0):
+            self.assertIs(MailTemplate.objects.get_compiled_template(*PAIR), compiled)
+
+    def test_saving_invalidates_shared_version(self):
+        MailTemplate.objects.get_compiled_template(*PAIR)
+        self.template.subject = 'Changed {token}'
+        self.template.save()
+        with self.assertNumQueries(2):
+            compiled = MailTemplate.objects.get_compiled_template(*PAIR)
+        self.assertEqual(compiled.version, 2)
+        self.assertEqual(compiled.subject.source, 'Changed {token}')
+
+    def test_outdated_share_does_not_replace_current_version(self):
+        MailTemplate.objects.get_compiled_template(*PAIR)
+        # A process that read the mail template before it changed shares it late, with the same version
+        store.share([CompiledMailTemplate(PAIR[0], PAIR[1], 1, 'Outdated', '')])
+        engine.clear()
+        with self.assertNumQueries(0):
+            compiled = MailTemplate.objects.get_compiled_template(*PAIR)
+        self.assertEqual(compiled.subject.source, 'This is a subject with {token}')
+
+    @override_settings(OSIS_MAIL_TEMPLATE_CACHE_VERSION_TIMEOUT=0)
+    def test_current_version_expires(self):
+        MailTemplate.objects.get_compiled_template(*PAIR)
+        engine.clear()
+        with self.assertNumQueries(2):
+            MailTemplate.objects.get_compiled_template(*PAIR)
+
+    def test_without_shared_cache(self):
+        with self.settings(OSIS_MAIL_TEMPLATE_CACHE=None):
+            MailTemplate.objects.get_compiled_template(*PAIR)
+            self.assertEqual(store.get_shared_compiled_templates([PAIR]), {})
+        self.assertEqual(store.get_shared_compiled_templates([PAIR]), {})
+
+    def test_using_shared_cache(self):
+        with store.using_shared_cache(None):
+            self.assertIsNone(store.get_shared_cache())
+        with self.settings(OSIS_MAIL_TEMPLATE_CACHE=None), store.using_shared_cache('default'):
+            self.assertIs(store.get_shared_cache(), caches['default'])
+        self.assertIs(store.get_shared_cache(), caches['default'])
@@ -23,11 +23,20 @@
 #    see http://www.gnu.org/licenses/.
 #
 # ##############################################################################
+from unittest.mock import patch
+
 from django.conf import settings
 from django.test import SimpleTestCase, TestCase
 
 from osis_mail_template.models import MailTemplate
-from osis_mail_template.utils import transform_html_to_text, generate_email, render_email_content
+from osis_mail_template.rendering import engine
+from osis_mail_template.utils import (
+    transform_html_to_text,
+    generate_email,
+    render_columns,
+    render_email,
+    render_email_content,
+)
 
 LINK_PARAGRAPH_HTML = """
 <p>This is a <a href="http://test.com">link</a>, it should be rendered after the paragraph</p>
@@ -107,3 +116,82 @@ class RenderEmailContentTestCase(TestCase):
         subject, body = render_email_content(self.TEMPLATE_ID, 'en', {'token': 'my real value'})
         self.assertEqual('This is a subject with my real value', subject)
         self.assertIn('my real value</p>', body)
+
+
+class RenderEmailTestCase(TestCase):
+    TEMPLATE_ID = 'test-identifier'
+
+    def setUp(self):
+        engine.clear()
+        MailTemplate.objects.create(
+            identifier=self.TEMPLATE_ID,
+            language='en',
+            subject='This is a subject with {token}',
+            body='<p>This is a body with {token}</p>',
+        )
+
+    @patch('osis_mail_template.rendering.render_wrapper')
+    @patch('osis_mail_template.rendering.transform_html_to_text')
+    def test_parts_are_rendered_when_needed(self, transform, wrapper):
+        rendered = render_email(self.TEMPLATE_ID, 'en', {'token': 'my real value'})
+        self.assertEqual(rendered.subject, 'This is a subject with my real value')
+        self.assertEqual(rendered.html_body, '<p>This is a body with my real value</p>')
+        transform.assert_not_called()
+        wrapper.assert_not_called()
+
+    def test_parts_are_kept(self):
+        rendered = render_email(self.TEMPLATE_ID, 'en', {'token': 'my real value'}, ['to@example.com'])
+        self.assertEqual(rendered.plain_text, 'This is a body with my real value\n\n')
+        self.assertIn('<p>This is a body with my real value</p>', rendered.wrapped_html)
+        with patch('osis_mail_template.rendering.transform_html_to_text') as transform:
+            message = rendered.as_message()
+            self.assertIs(rendered.as_message(), message)
+            transform.assert_not_called()
+        self.assertEqual(message['To'], 'to@example.com')
+        self.assertEqual(message.get_body(('plain',)).get_content(), rendered.plain_text)
+
+    def test_same_as_generate_email(self):
+        tokens = {'token': 'my real value'}
+        rendered = render_email(self.TEMPLATE_ID, 'en', tokens, ['to@example.com']).as_message()
+        message = generate_email(self.TEMPLATE_ID, 'en', tokens, ['to@example.com'])
+        self.assertEqual(rendered.get_body(('html',)).get_content(), message.get_body(('html',)).get_content())
+        self.assertEqual(rendered['Subject'], message['Subject'])
+
+
+class RenderColumnsTestCase(TestCase):
+    TEMPLATE_ID = 'test-identifier'
+
+    def setUp(self):
+        engine.clear()
+        MailTemplate.objects.create(
+            identifier=self.TEMPLATE_ID,
+            language='en',
+            subject='Hello {first_name}',
+            body='<p>Dear {first_name} {last_name},</p>',
+        )
+
+    def test_render_columns(self):
+        rendered = list(render_columns(self.TEMPLATE_ID, 'en', columns={
+            'last_name': ['Doe', 'Smith'],
+            'first_name': ['John', 'Jane'],
+        }))
+        self.assertEqual([subject for subject, _, _ in rendered], ['Hello John', 'Hello Jane'])
+        self.assertEqual(rendered[1][1], '<p>Dear Jane Smith,</p>')
+        self.assertEqual(rendered[1][2], 'Dear Jane Smith,\n\n')
+
+    def test_render_rows(self):
+        rendered = render_columns(self.TEMPLATE_ID, 'en', rows=[('John',)], token_names=['first_name'])
+        self.assertEqual(next(rendered)[:2], ('Hello John', '<p>Dear John TOKEN_last_name_UNDEFINED,</p>'))
+
+    def test_same_as_render_email_content(self):
+        tokens = {'first_name': 'John', 'last_name': 'Doe'}
+        subject, body, _ = next(render_columns(self.TEMPLATE_ID, 'en', columns={k: [v] for k, v in tokens.items()}))
+        self.assertEqual((subject, body), render_email_content(self.TEMPLATE_ID, 'en', tokens))
+
+    def test_columns_of_different_lengths(self):
+        with self.assertRaises(ValueError):
+            render_columns(self.TEMPLATE_ID, 'en', columns={'last_name': ['Doe', 'Smith'], 'first_name': ['John']})
+
+    def test_rows_without_names(self):
+        with self.assertRaises(TypeError):
+            render_columns(self.TEMPLATE_ID, 'en', rows=[('John',)])
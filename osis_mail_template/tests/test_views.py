@@ -24,6 +24,7 @@
 #
 # ##############################################################################
 import json
+from datetime import datetime, timezone
 from unittest.mock import patch
 
 from django.contrib.auth.models import Permission
@@ -55,6 +56,8 @@ class TestMailTemplateViews(TestCase):
             'get_example_values.return_value': {
                 'token': 'Example value',
             },
+            'get_content_hash.return_value': 'registry-hash',
+            'updated_at': datetime(2021, 1, 1, tzinfo=timezone.utc),
         })
         cls.url = reverse('osis_mail_template:change', kwargs={'identifier': cls.TEMPLATE_ID})
         cls.registry.start()
@@ -76,11 +79,18 @@ class TestMailTemplateViews(TestCase):
     @classmethod
     def tearDownClass(cls):
         cls.registry.stop()
+        super().tearDownClass()
 
     def test_list(self):
         response = self.client.get(reverse('osis_mail_template:list'))
         self.assertContains(response, "Custom description")
 
+    def test_list_conditional(self):
+        response = self.client.get(reverse('osis_mail_template:list'))
+        self.assertTrue(response.has_header('ETag'))
+        response = self.client.get(reverse('osis_mail_template:list'), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
     def test_get(self):
         response = self.client.get(self.url)
         self.assertContains(response, "Some mail template")
@@ -122,12 +132,15 @@ class TestMailTemplateAutocompleteViews(TestCase):
                 'identifier-1-2': ('Description 1 - 2', [], 'Tag 1'),
                 'identifier-2-1': ('Description 2 - 1', [], 'Tag 2'),
             },
+            'get_content_hash.return_value': 'registry-hash',
+            'updated_at': datetime(2021, 1, 1, tzinfo=timezone.utc),
         })
         cls.registry.start()
 
     @classmethod
     def tearDownClass(cls):
         cls.registry.stop()
+        super().tearDownClass()
 
     def test_autocomplete(self):
         response = self.client.get(reverse('osis_mail_template:autocomplete'))
@@ -143,6 +156,11 @@ class TestMailTemplateAutocompleteViews(TestCase):
             {"id": "identifier-2-1", "text": "Description 2 - 1"},
         ]}))
 
+    def test_autocomplete_conditional(self):
+        response = self.client.get(reverse('osis_mail_template:autocomplete'))
+        response = self.client.get(reverse('osis_mail_template:autocomplete'), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
     def test_autocomplete_filtered_by_tag(self):
         response = self.client.get(
             reverse('osis_mail_template:autocomplete'),
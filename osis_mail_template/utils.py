@@ -24,16 +24,25 @@
 #
 # ##############################################################################
 from email.message import EmailMessage
-from typing import List, Dict, Tuple
+from typing import BinaryIO, Iterable, Iterator, List, Dict, Mapping, Sequence, Tuple
 
-import html2text
-from django.conf import settings
-from django.template.loader import render_to_string
-from django.utils import translation
+from osis_mail_template.rendering import MissingTokenDict, RenderedMail, engine, transform_html_to_text
+
+__all__ = [
+    'MissingTokenDict',
+    'RenderedMail',
+    'generate_email',
+    'generate_email_from_template',
+    'render_columns',
+    'render_email',
+    'render_email_content',
+    'stream_email',
+    'transform_html_to_text',
+]
 
 
 def generate_email(mail_template_id: str, language: str, tokens: Dict[str, str], recipients: List[str],
-                   sender=None) -> EmailMessage:
+                   sender=None, escape: bool = None, attachments: Iterable = None) -> EmailMessage:
     """
     Generate a pre-configured EmailMessage ready for sending
 
@@ -42,72 +51,117 @@ def generate_email(mail_template_id: str, language: str, tokens: Dict[str, str],
     :param tokens: A dictionary of tokens with their corresponding value
     :param recipients: A list of recipients
     :param sender: The sender's email address (defaults to settings.DEFAULT_FROM_EMAIL)
+    :param escape: Whether token values are escaped in the HTML body (defaults to OSIS_MAIL_TEMPLATE_ESCAPE_TOKENS)
+    :param attachments: Attachment instances (encoded once, whatever the number of messages), file paths, bytes or
+        (filename, content, mimetype) tuples
     :return: an EmailMessage() object for sending
     """
     from osis_mail_template.models import MailTemplate
 
-    # Get the mail template
-    template = MailTemplate.objects.get_mail_template(mail_template_id, language)
-
-    # Format the content in the provided language (in case of lazy translations in tokens)
-    with translation.override(language):
-        subject = template.render_subject(tokens)
-        html_content = render_to_string('osis_mail_template/base_email.html', {
-            'subject': subject,
-            'language': language,
-            'recipients': recipients,
-            'sender': sender,
-            'content': template.body_as_html(tokens),
-        })
-        text_content = template.body_as_plain(tokens)
-
-    # Construct the message
-    msg = EmailMessage()
-    msg.set_charset(settings.DEFAULT_CHARSET)
-    msg['Subject'] = subject
-    msg['From'] = sender or settings.DEFAULT_FROM_EMAIL
-    msg['To'] = recipients
-    msg.set_content(text_content)
-    msg.add_alternative(html_content, subtype="html")
-    return msg
-
-
-def render_email_content(mail_template_id: str, language: str, tokens: Dict[str, str]) -> Tuple[str, str]:
+    # Get the compiled mail template
+    template = MailTemplate.objects.get_compiled_template(mail_template_id, language)
+    return engine.render_message(template, tokens, recipients, sender, escape=escape, attachments=attachments)
+
+
+def generate_email_from_template(template, tokens: Dict[str, str], recipients: List[str],
+                                 sender=None, escape: bool = None, attachments: Iterable = None) -> EmailMessage:
+    """
+    Generate a pre-configured EmailMessage from an already fetched mail template instance
+
+    :param template: The MailTemplate instance, its language is used for rendering
+    :param tokens: A dictionary of tokens with their corresponding value
+    :param recipients: A list of recipients
+    :param sender: The sender's email address (defaults to settings.DEFAULT_FROM_EMAIL)
+    :param escape: Whether token values are escaped in the HTML body (defaults to OSIS_MAIL_TEMPLATE_ESCAPE_TOKENS)
+    :param attachments: Attachment instances (encoded once, whatever the number of messages), file paths, bytes or
+        (filename, content, mimetype) tuples
+    :return: an EmailMessage() object for sending
+    """
+    return engine.render_message(template, tokens, recipients, sender, escape=escape, attachments=attachments)
+
+
+def stream_email(mail_template_id: str, language: str, tokens: Dict[str, str], recipients: List[str],
+                 sink: BinaryIO, sender=None, escape: bool = None) -> None:
+    """
+    Write a message ready for sending to a binary sink (e.g. a file), as it is rendered, for very large contents
+
+    :param mail_template_id: The mail template identifier (must exist)
+    :param language: The mail template language (must exist)
+    :param tokens: A dictionary of tokens with their corresponding value
+    :param recipients: A list of recipients
+    :param sink: A binary file-like object the message bytes are written to
+    :param sender: The sender's email address (defaults to settings.DEFAULT_FROM_EMAIL)
+    :param escape: Whether token values are escaped in the HTML body (defaults to OSIS_MAIL_TEMPLATE_ESCAPE_TOKENS)
+    """
+    from osis_mail_template.models import MailTemplate
+
+    template = MailTemplate.objects.get_compiled_template(mail_template_id, language)
+    engine.render_to_stream(template, tokens, recipients, sink, sender, escape=escape)
+
+
+def render_email_content(mail_template_id: str, language: str, tokens: Dict[str, str],
+                         escape: bool = None) -> Tuple[str, str]:
     """
     Render a mail template subject and body ready to use (e.g. in an user-facing form)
 
     :param mail_template_id: The mail template identifier (must exist)
     :param language: The mail template language (must exist)
     :param tokens: A dictionary of tokens with their corresponding value
+    :param escape: Whether token values are escaped in the HTML body (defaults to OSIS_MAIL_TEMPLATE_ESCAPE_TOKENS)
     :return:
     """
+    rendered = render_email(mail_template_id, language, tokens, escape=escape)
+    return rendered.subject, rendered.html_body
+
+
+def render_email(mail_template_id: str, language: str, tokens: Dict[str, str], recipients: List[str] = None,
+                 sender=None, escape: bool = None, attachments: Iterable = None) -> RenderedMail:
+    """
+    Render a mail template, each part (subject, HTML body, wrapped HTML, plain text, message) being computed only
+    when first accessed
+
+    :param mail_template_id: The mail template identifier (must exist)
+    :param language: The mail template language (must exist)
+    :param tokens: A dictionary of tokens with their corresponding value
+    :param recipients: A list of recipients, only needed for the wrapped HTML and the message
+    :param sender: The sender's email address (defaults to settings.DEFAULT_FROM_EMAIL)
+    :param escape: Whether token values are escaped in the HTML body (defaults to OSIS_MAIL_TEMPLATE_ESCAPE_TOKENS)
+    :param attachments: Attachment instances (encoded once, whatever the number of messages), file paths, bytes or
+        (filename, content, mimetype) tuples
+    :return: a RenderedMail, with subject, html_body, wrapped_html and plain_text properties, and as_message()
+    """
     from osis_mail_template.models import MailTemplate
 
-    # Get the mail template
-    template = MailTemplate.objects.get_mail_template(mail_template_id, language)
+    template = MailTemplate.objects.get_compiled_template(mail_template_id, language)
+    return engine.render(template, tokens, recipients, sender, escape=escape, attachments=attachments)
 
-    # Render subject and body
-    subject = template.render_subject(tokens)
-    body = template.body_as_html(tokens)
-    return subject, body
 
+def render_columns(mail_template_id: str, language: str, columns: Mapping[str, Sequence] = None,
+                   rows: Iterable[Sequence] = None, token_names: Sequence[str] = None,
+                   escape: bool = None) -> Iterator[Tuple[str, str, str]]:
+    """
+    Render a mail template for many recipients from columnar data, without building a dictionary per recipient
 
-def transform_html_to_text(html: str) -> str:
-    """Transforms html markup to plain text for email sending
+    Token values are given either as columns, or as rows with the names of the tokens in the order of their values.
 
-    :param html: THe html markup string to transform
-    :return: The plain text formatted string
+    :param mail_template_id: The mail template identifier (must exist)
+    :param language: The mail template language (must exist)
+    :param columns: A mapping of token names to sequences of values (all of the same length)
+    :param rows: An iterable of sequences of token values, in the order of token_names
+    :param token_names: The names of the tokens of the rows
+    :param escape: Whether token values are escaped in the HTML body (defaults to OSIS_MAIL_TEMPLATE_ESCAPE_TOKENS)
+    :return: a lazy iterator of (subject, HTML body, plain text body) for each recipient
+    :raise ValueError: if the columns are not all of the same length
     """
-    h = html2text.HTML2Text()
-    h.links_each_paragraph = True
-    h.body_width = 80
-    h.inline_links = False
-    h.wrap_links = False
-    h.wrap_list_items = True
-    h.use_automatic_links = True
-    return h.handle(html)
-
-
-class MissingTokenDict(dict):
-    def __missing__(self, key):
-        return "TOKEN_{}_UNDEFINED".format(key)
+    from osis_mail_template.models import MailTemplate
+
+    if columns is not None:
+        if len({len(values) for values in columns.values()}) > 1:
+            raise ValueError("The columns must all be of the same length")
+        token_names = list(columns.keys())
+        rows = zip(*columns.values())
+    elif rows is None or token_names is None:
+        raise TypeError("Either columns, or rows and token_names must be given")
+
+    template = MailTemplate.objects.get_compiled_template(mail_template_id, language)
+    return engine.render_rows(template, token_names, rows, escape=escape)
@@ -0,0 +1,63 @@
+# ##############################################################################
+#
+#    OSIS stands for Open Student Information System. It's an application
+#    designed to manage the core business of higher education institutions,
+#    such as universities, faculties, institutes and professional schools.
+#    The core business involves the administration of students, teachers,
+#    courses, programs and so on.
+#
+#    Copyright (C) 2015-2021 Université catholique de Louvain (http://www.uclouvain.be)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    A copy of this license - GNU General Public License - is available
+#    at the root of the source code of this program.  If not,
+#    see http://www.gnu.org/licenses/.
+#
+# ##############################################################################
+import hashlib
+
+from django.db.models import Max
+from django.utils import translation
+
+# Used by the models as well as by MailTemplateMigration, which only gets historical models: kept apart from the
+# models, so that what migrations do doesn't change along with them
+__all__ = [
+    'compute_content_hash',
+    'get_registered_tag',
+    'next_version',
+]
+
+
+def compute_content_hash(subject: str, body: str) -> str:
+    """A hash of the content of a mail template, to find out whether it changed without comparing it"""
+    content = hashlib.sha1(subject.encode())
+    content.update(b'\0')
+    content.update(body.encode())
+    return content.hexdigest()
+
+
+def next_version(revision_model, identifier: str, language: str) -> int:
+    """The version a newly created mail template should have, given the revisions kept for it"""
+    last_version = revision_model.objects.filter(
+        identifier=identifier,
+        language=language,
+    ).aggregate(last_version=Max('version'))['last_version']
+    return (last_version or 0) + 1
+
+
+def get_registered_tag(identifier: str) -> str:
+    """The tag a mail template is registered with (untranslated), empty if it is not registered"""
+    from osis_mail_template import templates
+
+    # The stored tag must not depend on the language of the request or command saving the mail template
+    with translation.override(None):
+        return str(templates.get_mail_templates().get(identifier, (None, None, ''))[2])
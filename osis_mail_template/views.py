@@ -27,14 +27,46 @@ from dal import autocomplete
 from django.contrib import messages
 from django.http import JsonResponse
 from django.shortcuts import resolve_url
+from django.utils import translation
+from django.utils.decorators import method_decorator
 from django.utils.translation import gettext_lazy as _
 from django.views import generic
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
 
 from osis_mail_template.forms import MailTemplateConfigureForm
 from osis_mail_template.models import MailTemplate
 from osis_role.contrib.views import PermissionRequiredMixin
 
 
+def _is_registry_cacheable(request) -> bool:
+    # Pending messages are displayed once, the response must be rendered to show them
+    return not len(messages.get_messages(request))
+
+
+def registry_etag(request, *args, **kwargs):
+    """An ETag changing with the registered templates, the language and the user"""
+    from osis_mail_template import templates
+
+    if _is_registry_cacheable(request):
+        return '{}-{}-{}'.format(templates.get_content_hash(), translation.get_language(), request.user.pk)
+
+
+def registry_last_modified(request, *args, **kwargs):
+    from osis_mail_template import templates
+
+    if _is_registry_cacheable(request):
+        return templates.updated_at
+
+
+# Clients must always revalidate, as the registered templates may change on the next deployment
+registry_conditional = [
+    cache_control(private=True, no_cache=True),
+    condition(etag_func=registry_etag, last_modified_func=registry_last_modified),
+]
+
+
+@method_decorator(registry_conditional, name='get')
 class MailTemplateListView(PermissionRequiredMixin, generic.TemplateView):
     template_name = 'osis_mail_template/list.html'
     permission_required = 'osis_mail_template.configure'
@@ -44,6 +76,7 @@ class MailTemplateListView(PermissionRequiredMixin, generic.TemplateView):
 
         context = super().get_context_data(**kwargs)
         context['tagged'] = templates.get_list_by_tag()
+        context['registry_hash'] = templates.get_content_hash()
         return context
 
 
@@ -77,6 +110,9 @@ class MailTemplateChangeView(PermissionRequiredMixin, generic.FormView):
             for form in forms:
                 form.save()
             messages.info(self.request, _("Mail template saved successfully."))
+            saved = sum(form.saved_bytes for form in forms)
+            if saved > 0:
+                messages.info(self.request, _("HTML content reduced by %(bytes)s bytes.") % {'bytes': saved})
             return self.form_valid(forms)
         return self.form_invalid(forms)
 
@@ -112,6 +148,7 @@ class MailTemplatePreview(PermissionRequiredMixin, generic.TemplateView):
         return context
 
 
+@method_decorator(registry_conditional, name='get')
 class MailTemplateAutocomplete(autocomplete.Select2ListView):
     def get(self, request, *args, **kwargs):
         from osis_mail_template import templates